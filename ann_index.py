@@ -0,0 +1,229 @@
+import argparse
+import config
+import db_pool
+
+# Distance name -> (pgvector operator, operator class used by the index)
+DISTANCE_OPS = {
+    "l2": ("<->", "vector_l2_ops"),
+    "cosine": ("<=>", "vector_cosine_ops"),
+    "ip": ("<#>", "vector_ip_ops"),
+}
+INDEX_TYPES = ("hnsw", "ivfflat")
+# pgvector's built-in hnsw.ef_search
+DEFAULT_EF_SEARCH = 40
+
+# Storage mode -> (indexed column, column type, generated-column expression, operator class
+# prefix). Quantized columns are generated from the full-precision embedding, so every
+# writer (COPY ingest, sync, /db) keeps them in step without code changes; searches use
+# them for a coarse top-k and re-rank the candidates on the full-precision column.
+STORAGE_MODES = {
+    "vector": ("embedding", "vector({dim})", None, "vector"),
+    "halfvec": ("embedding_half", "halfvec({dim})", "embedding::halfvec({dim})", "halfvec"),
+    "binary": ("embedding_bin", "bit({dim})", "binary_quantize(embedding)::bit({dim})", "bit"),
+}
+HAMMING_OPERATOR = "<~>"
+
+
+def distance_operator(distance=None) -> str:
+    """Return the pgvector operator for a distance name (default config.VECTOR_DISTANCE)."""
+    distance = distance or config.VECTOR_DISTANCE
+    if distance not in DISTANCE_OPS:
+        raise ValueError(f"Unknown distance '{distance}', expected one of {sorted(DISTANCE_OPS)}")
+    return DISTANCE_OPS[distance][0]
+
+
+def storage_mode(mode=None) -> str:
+    """Validate a storage mode name (default config.STORAGE_MODE)."""
+    mode = mode or config.STORAGE_MODE
+    if mode not in STORAGE_MODES:
+        raise ValueError(f"Unknown storage mode '{mode}', expected one of {sorted(STORAGE_MODES)}")
+    return mode
+
+
+def storage_column(mode=None) -> str:
+    """Column searched (coarsely, for quantized modes) by the given storage mode."""
+    return STORAGE_MODES[storage_mode(mode)][0]
+
+
+def quantized_column_definition(mode=None, table_name=None) -> str:
+    """ALTER TABLE statement adding the generated quantized column of a storage mode."""
+    column, column_type, expression, _ = STORAGE_MODES[storage_mode(mode)]
+    if expression is None:
+        raise ValueError("The 'vector' storage mode has no quantized column")
+    dim = int(config.EMBEDDING_DIM)
+    return (
+        f"ALTER TABLE {table_name or config.TABLE_NAME} ADD COLUMN IF NOT EXISTS {column} "
+        f"{column_type.format(dim=dim)} GENERATED ALWAYS AS ({expression.format(dim=dim)}) STORED"
+    )
+
+
+def operator_class(distance=None, column="embedding") -> str:
+    """Index operator class for a column; binary columns always use Hamming distance."""
+    distance = distance or config.VECTOR_DISTANCE
+    prefix = next((spec[3] for spec in STORAGE_MODES.values() if spec[0] == column), "vector")
+    if prefix == "bit":
+        return "bit_hamming_ops"
+    return prefix + DISTANCE_OPS[distance][1][len("vector"):]
+
+
+def index_name(table_name=None, column="embedding") -> str:
+    return f"{table_name or config.TABLE_NAME}_{column}_ann_idx"
+
+
+def index_definition(index_type=None, distance=None, table_name=None, column="embedding", name=None) -> str:
+    """
+    Build the CREATE INDEX CONCURRENTLY statement for an HNSW or IVFFlat index,
+    with build parameters taken from config.
+    """
+    index_type = index_type or config.VECTOR_INDEX_TYPE
+    distance = distance or config.VECTOR_DISTANCE
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{index_type}', expected one of {INDEX_TYPES}")
+    opclass = operator_class(distance, column)
+    if index_type == "hnsw":
+        params = f"m = {int(config.HNSW_M)}, ef_construction = {int(config.HNSW_EF_CONSTRUCTION)}"
+    else:
+        params = f"lists = {int(config.IVFFLAT_LISTS)}"
+    return (
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name or index_name(table_name, column)} "
+        f"ON {table_name or config.TABLE_NAME} USING {index_type} ({column} {opclass}) WITH ({params})"
+    )
+
+
+def _run_maintenance(statements):
+    """
+    Run index maintenance statements in autocommit mode (required by CONCURRENTLY)
+    with the configured maintenance memory. The pooled connection is handed back
+    with its setting reset and its autocommit mode restored.
+    """
+    with db_pool.connection() as conn:
+        autocommit = conn.autocommit
+        conn.autocommit = True
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT set_config('maintenance_work_mem', %s, false)", (config.INDEX_MAINTENANCE_WORK_MEM,))
+            for statement in statements:
+                print(statement)
+                cur.execute(statement)
+        finally:
+            try:
+                cur.execute("RESET maintenance_work_mem")
+            finally:
+                cur.close()
+                conn.autocommit = autocommit
+
+
+def create_vector_index(index_type=None, distance=None, table_name=None, column=None):
+    """
+    Build the ANN index without blocking writes. An invalid index left behind by an
+    interrupted concurrent build is dropped first. column defaults to the column of
+    config.STORAGE_MODE.
+    """
+    column = column or storage_column()
+    name = index_name(table_name, column)
+    statements = []
+    if _is_invalid(name):
+        statements.append(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    statements.append(index_definition(index_type, distance, table_name, column))
+    _run_maintenance(statements)
+
+
+def rebuild_vector_index(index_type=None, distance=None, table_name=None, column=None):
+    """
+    Rebuild the ANN index (e.g. after bulk changes, or to apply new build parameters
+    or a new type/distance): build a replacement concurrently, then swap it in. The
+    old index stays usable until the swap: both renames run as one statement string
+    (a single implicit transaction), and the old index is dropped only afterwards.
+    """
+    column = column or storage_column()
+    name = index_name(table_name, column)
+    new_name = f"{name}_new"
+    old_name = f"{name}_old"
+    _run_maintenance([
+        f"DROP INDEX CONCURRENTLY IF EXISTS {new_name}",
+        f"DROP INDEX CONCURRENTLY IF EXISTS {old_name}",
+        index_definition(index_type, distance, table_name, column, name=new_name),
+        f"ALTER INDEX IF EXISTS {name} RENAME TO {old_name}; ALTER INDEX {new_name} RENAME TO {name}",
+        f"DROP INDEX CONCURRENTLY IF EXISTS {old_name}",
+    ])
+
+
+def drop_vector_index(table_name=None, column=None):
+    column = column or storage_column()
+    _run_maintenance([f"DROP INDEX CONCURRENTLY IF EXISTS {index_name(table_name, column)}"])
+
+
+def index_status(table_name=None):
+    """Return name, definition, validity and size of the ANN indexes on the table."""
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT c.relname, pg_get_indexdef(i.indexrelid), i.indisvalid,
+                   pg_size_pretty(pg_relation_size(i.indexrelid))
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            JOIN pg_am am ON am.oid = c.relam
+            WHERE i.indrelid = %s::regclass AND am.amname IN ('hnsw', 'ivfflat')
+            """,
+            (table_name or config.TABLE_NAME,)
+        )
+        rows = cur.fetchall()
+        cur.close()
+    return [{"name": name, "definition": definition, "valid": valid, "size": size}
+            for name, definition, valid, size in rows]
+
+
+def search_settings(ef_search=None, probes=None, index_type=None):
+    """
+    Return (sql, params) that apply per-query HNSW ef_search / IVFFlat probes for the
+    current transaction only, or (None, ()) when nothing needs setting. Explicit values
+    are always applied; the config defaults only for the index type in use
+    (config.VECTOR_INDEX_TYPE), and None leaves the server default.
+    """
+    index_type = index_type or config.VECTOR_INDEX_TYPE
+    if ef_search is None and index_type == "hnsw":
+        ef_search = config.HNSW_EF_SEARCH
+    if probes is None and index_type == "ivfflat":
+        probes = config.IVFFLAT_PROBES
+    settings = {"hnsw.ef_search": ef_search, "ivfflat.probes": probes}
+    settings = {name: value for name, value in settings.items() if value is not None}
+    if not settings:
+        return None, ()
+    sql = "SELECT " + ", ".join("set_config(%s, %s, true)" for _ in settings)
+    params = []
+    for name, value in settings.items():
+        params.extend([name, str(int(value))])
+    return sql, tuple(params)
+
+
+def _is_invalid(name) -> bool:
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT NOT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s",
+            (name,)
+        )
+        row = cur.fetchone()
+        cur.close()
+    return bool(row and row[0])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Manage the pgvector ANN index on the documents table.")
+    parser.add_argument("command", choices=["create", "rebuild", "drop", "status"])
+    parser.add_argument("--type", choices=INDEX_TYPES, default=None, help="index type (default config.VECTOR_INDEX_TYPE)")
+    parser.add_argument("--distance", choices=sorted(DISTANCE_OPS), default=None, help="distance (default config.VECTOR_DISTANCE)")
+    parser.add_argument("--storage", choices=sorted(STORAGE_MODES), default=None,
+                        help="index the column of this storage mode (default config.STORAGE_MODE)")
+    args = parser.parse_args()
+
+    column = storage_column(args.storage)
+    if args.command == "create":
+        create_vector_index(args.type, args.distance, column=column)
+    elif args.command == "rebuild":
+        rebuild_vector_index(args.type, args.distance, column=column)
+    elif args.command == "drop":
+        drop_vector_index(column=column)
+    for index in index_status():
+        print(index)
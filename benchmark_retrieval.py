@@ -0,0 +1,97 @@
+import argparse
+import json
+import random
+import time
+import numpy as np
+import config
+import db_pool
+import embeddings
+import mmap_index
+from retrieval import build_query_sql, search_pgvector
+
+# Compare retrieval latency and recall of the retrieval backends and storage modes:
+# pgvector over the full-precision or quantized (halfvec / binary + re-rank) columns,
+# and the in-process memory-mapped index. Query embeddings are computed once up front,
+# so only the search is timed. Recall is measured against an exact sequential scan.
+
+
+def sample_queries(file_path, count, seed=0):
+    """Use the opening words of random documents as queries."""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        contents = [json.loads(line).get("content") or "" for line in f if line.strip()]
+    contents = [content for content in contents if content.strip()]
+    random.Random(seed).shuffle(contents)
+    return [" ".join(content.split()[:12]) for content in contents[:count]]
+
+
+def exact_search(embedding, top_n):
+    """Ground truth: exact nearest neighbours with index scans disabled for the transaction."""
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT set_config('enable_indexscan', 'off', true), set_config('enable_bitmapscan', 'off', true)")
+            cur.execute(build_query_sql(), (embeddings.to_vector_literal(embedding), top_n))
+            rows = cur.fetchall()
+        finally:
+            cur.close()
+    return [{"id": row[0]} for row in rows]
+
+
+def time_search(search, vectors, top_n, warmup=3):
+    for vector in vectors[:warmup]:
+        search(vector, top_n)
+    timings, results = [], []
+    for vector in vectors:
+        start = time.perf_counter()
+        results.append([row["id"] for row in search(vector, top_n)])
+        timings.append((time.perf_counter() - start) * 1000)
+    return np.asarray(timings), results
+
+
+def recall(results, truth):
+    return float(np.mean([len(set(found) & set(exact)) / max(len(exact), 1) for found, exact in zip(results, truth)]))
+
+
+def report(name, timings, results, truth):
+    print(f"{name:>16}: mean {timings.mean():.2f} ms, p50 {np.percentile(timings, 50):.2f} ms, "
+          f"p95 {np.percentile(timings, 95):.2f} ms, p99 {np.percentile(timings, 99):.2f} ms, "
+          f"recall {recall(results, truth):.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark retrieval backends and storage modes.")
+    parser.add_argument("--file", default=config.JSONL_FILE, help="JSONL file to sample queries from")
+    parser.add_argument("--queries", type=int, default=200, help="number of queries")
+    parser.add_argument("--top-n", type=int, default=3)
+    parser.add_argument("--storage", nargs="+", default=[config.STORAGE_MODE],
+                        help="pgvector storage modes to benchmark (their columns and indexes must exist)")
+    parser.add_argument("--candidates", type=int, default=None,
+                        help="coarse candidates for quantized modes (default config.RERANK_CANDIDATES)")
+    parser.add_argument("--no-mmap", action="store_true", help="skip the in-process index")
+    parser.add_argument("--dtype", choices=["float32", "float16"], default=None,
+                        help="re-export the in-process index with this precision before benchmarking")
+    args = parser.parse_args()
+
+    queries = sample_queries(args.file, args.queries)
+    vectors = list(embeddings.encode(queries))
+    print(f"{len(queries)} queries, top_n={args.top_n}")
+    _, truth = time_search(exact_search, vectors, args.top_n, warmup=0)
+
+    baseline = None
+    for storage in args.storage:
+        timings, results = time_search(
+            lambda vector, top_n: search_pgvector(vector, top_n, storage=storage, candidates=args.candidates),
+            vectors, args.top_n
+        )
+        report(f"pgvector/{storage}", timings, results, truth)
+        baseline = baseline if baseline is not None else np.percentile(timings, 50)
+
+    if not args.no_mmap:
+        if args.dtype:
+            mmap_index.export_index(dtype=args.dtype)
+        index = mmap_index.get_index()
+        print(f"in-process index: {index.stats()}")
+        timings, results = time_search(index.search, vectors, args.top_n)
+        report(f"mmap/{index.stats()['dtype']}", timings, results, truth)
+        if baseline is not None:
+            print(f"speedup vs pgvector/{args.storage[0]} (p50): {baseline / np.percentile(timings, 50):.1f}x")
@@ -1,6 +1,6 @@
 # config.py
 
-from sentence_transformers import SentenceTransformer
+import threading
 # Database connection configuration
 DB_HOST = 'localhost' 
 #change the following according to your database credentials
@@ -9,15 +9,171 @@ DB_NAME = 'rag_db'
 DB_USER = 'test1234'
 DB_PASSWORD = '1234'
 
+# Connection pool configuration (shared by all database access, see db_pool.py)
+DB_POOL_MIN_SIZE = 1
+DB_POOL_MAX_SIZE = 10
+DB_POOL_TIMEOUT = 30          # seconds to wait for a free connection
+DB_POOL_CHECK_AFTER = 30      # run a SELECT 1 health check on connections idle longer than this (seconds)
+DB_POOL_MAX_IDLE = 300        # close idle connections above DB_POOL_MIN_SIZE after this (seconds)
+DB_POOL_MAX_LIFETIME = 3600   # recycle connections older than this (seconds)
+DB_ASYNC_POOL_MAX_SIZE = 20   # asyncio pool used by the async /query pipeline
+
 # Table configuration
 TABLE_NAME = 'dune_docs'
 
-embedding_model = SentenceTransformer('sentence-transformers/all-mpnet-base-v2') # Dimension for the embedding vector
+EMBEDDING_MODEL_NAME = 'sentence-transformers/all-mpnet-base-v2'
+# Inference backend: 'torch', or 'onnx' (ONNX Runtime on CPU; needs sentence-transformers[onnx]).
+# EMBEDDING_ONNX_FILE picks a file from the model repo, e.g. 'onnx/model_qint8_avx512_vnni.onnx'
+# for int8-quantized weights; None uses the unquantized 'onnx/model.onnx'.
+EMBEDDING_BACKEND = 'torch'
+EMBEDDING_ONNX_FILE = None
+
+# The model is loaded on first use (get_embedding_model), not at import, so modules
+# and scripts that never encode do not pay for torch and the model weights.
+_embedding_model = None
+_embedding_model_lock = threading.Lock()
+
+def get_embedding_model():
+    """Return the shared SentenceTransformer, loading it on first use."""
+    global _embedding_model
+    if _embedding_model is None:
+        with _embedding_model_lock:
+            if _embedding_model is None:
+                from sentence_transformers import SentenceTransformer
+                if EMBEDDING_BACKEND == 'onnx':
+                    model_kwargs = {"file_name": EMBEDDING_ONNX_FILE} if EMBEDDING_ONNX_FILE else None
+                    _embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME, backend='onnx',
+                                                           model_kwargs=model_kwargs)
+                else:
+                    _embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+    return _embedding_model
+
+def __getattr__(name):
+    # Backwards compatible config.embedding_model, resolved lazily
+    if name == 'embedding_model':
+        return get_embedding_model()
+    raise AttributeError(f"module 'config' has no attribute '{name}'")
 
 # JSONL file to ingest (update with the full path to your JSONL file)
 JSONL_FILE = '/Users/praveenmohandas/Documents/dune_challenge/dune_docs.jsonl'#mention the file path for jsonl file
 OPENAI_API_KEY="your API key"
+
+# LLM #3 chat history window (see llm_calls.select_history)
+HISTORY_WINDOW_MESSAGES = 20    # most recent messages read from the database
+HISTORY_TOKEN_BUDGET = 1500     # estimated tokens of verbatim history sent to LLM #3
+CHARS_PER_TOKEN = 4             # used to estimate tokens from text length
+SUMMARY_BATCH_MESSAGES = 50     # older messages folded into the rolling summary per update
+SUMMARY_MAX_TOKENS = 300
+
+# Context packing (see context_packing.py): retrieved rows sent to LLM #2 / LLM #3 are cut
+# down to their most query-relevant passages when they exceed the token budget
+CONTEXT_PACKING_ENABLED = True
+CONTEXT_TOKEN_BUDGET = 1500       # estimated tokens for all retrieved rows together
+CONTEXT_PASSAGE_CHARS = 800       # passage size rows are split into
+CONTEXT_DEDUP_SIMILARITY = 0.95   # cosine similarity above which a passage is a near-duplicate
+CONTEXT_DEDUP_SHINGLE_WORDS = 8    # word runs this long seen earlier in the rows are dropped (navigation, footers)
+
+# OpenAI prices in dollars per 1K (prompt, completion) tokens, for the cost metric at /metrics
+LLM_PRICES = {
+    'gpt-4-0613': (0.03, 0.06),
+}
+# Include the per-stage timing breakdown in every /query response (or pass include_timings=true)
+INCLUDE_TIMINGS = False
+
+# Logging (see structured_logging.py): records are queued and written by a listener thread
+LOG_FILE = 'logs/query_service.log'
+LOG_LEVEL = 'DEBUG'
+LOG_JSON = True                       # one JSON object per line; False for plain text
+LOG_MAX_FIELD_CHARS = 2000            # cap per logged string value (e.g. a document's content)
+LOG_MAX_MESSAGE_CHARS = 8000          # cap for the formatted message
+LOG_MAX_ITEMS = 20                    # items kept per logged list/dict
+LOG_PAYLOAD_SAMPLE_RATE = 0.1         # share of requests whose heavy payload records are logged
+LOG_QUEUE_SIZE = 10000                # records are dropped (and counted) when the queue is full
+LOG_FILE_MAX_BYTES = 50 * 1024 * 1024
+LOG_FILE_BACKUPS = 5
+
+# Response cache for LLM #1 / LLM #2 (see llm_calls.py)
+LLM_CACHE_ENABLED = True
+LLM_CACHE_SIZE = 1000   # entries
+LLM_CACHE_TTL = 3600    # seconds
 EMBEDDING_DIM = 768
+# Threads used to run the embedding model off the event loop in the async pipeline
+EMBEDDING_WORKERS = 2
+
+# Micro-batching of concurrent encode requests (see embeddings.MicroBatcher)
+EMBEDDING_BATCHING = True
+EMBEDDING_BATCH_WINDOW = 0.005      # seconds to wait for more requests after the first
+EMBEDDING_BATCH_MAX_SIZE = 64       # texts per model call; larger requests run on their own
+
+# Pipeline mode for /query and /query/stream (overridable per request with ?mode=):
+# 'two_pass' runs LLM #1 -> retrieval -> LLM #2; 'single_pass' retrieves first and makes
+# one function-calling request (config.db_operation_function) for intent, action and content
+PIPELINE_MODE = 'two_pass'
+
+# Local intent router (see intent_router.py): answers LLM #1 for general and retrieve-only
+# queries when a kNN/centroid classifier over labelled example queries is confident.
+# Off by default: enable it once intent_router_report.py shows enough precision on
+# your exemplars (a misrouted change request is silently answered instead of applied)
+INTENT_ROUTER_ENABLED = False
+INTENT_EXEMPLARS_FILE = 'intent_exemplars.jsonl'
+INTENT_ROUTER_METHOD = 'knn'          # 'knn' or 'centroid'
+INTENT_ROUTER_K = 5                   # neighbours voting in knn mode
+INTENT_ROUTER_MIN_CONFIDENCE = 0.8    # share of neighbour votes (knn) / centroid margin needed to skip LLM #1
+INTENT_ROUTER_MIN_SIMILARITY = 0.5    # cosine similarity of the closest exemplar needed to skip LLM #1
+INTENT_ROUTER_CHANGE_MIN_CONFIDENCE = 0.95  # min confidence instead when an add/replace/delete exemplar is among the neighbours
+
+# Speculative retrieval: run LLM #1 and a retrieval on the raw user query alongside the
+# similarity check, and reuse those rows when the refined query is close enough
+SPECULATIVE_RETRIEVAL = True
+SPECULATIVE_REUSE_DISTANCE = 0.1    # max cosine distance between raw and refined query embeddings
+
+# /query/batch: maximum number of items whose LLM calls run at the same time
+BATCH_MAX_CONCURRENCY = 8
+
+# Conversation sessions (see ConversationManagerPool in conversation_hist.py)
+MAX_SESSIONS = 10000            # session managers kept in memory (LRU)
+SESSION_IDLE_TIMEOUT = 1800     # seconds before an idle session manager is dropped
+
+# Embedding cache (see embeddings.py): entries are keyed by model (name, backend, ONNX file) + text hash
+EMBEDDING_CACHE_SIZE = 10000              # in-memory LRU entries
+EMBEDDING_CACHE_BACKEND = None            # persistent tier: None, 'sqlite' or 'postgres'
+EMBEDDING_CACHE_PATH = 'cache/embeddings.sqlite3'  # used when EMBEDDING_CACHE_BACKEND = 'sqlite'
+EMBEDDING_CACHE_TABLE = 'embedding_cache'          # used when EMBEDDING_CACHE_BACKEND = 'postgres'
+# pgvector ANN index (see ann_index.py). The distance must match the index operator class.
+VECTOR_DISTANCE = 'l2'            # 'l2' (<->), 'cosine' (<=>) or 'ip' (<#>)
+VECTOR_INDEX_TYPE = 'hnsw'        # 'hnsw' or 'ivfflat'; None skips index creation after ingest
+HNSW_M = 16                       # HNSW build: max connections per layer
+HNSW_EF_CONSTRUCTION = 64         # HNSW build: candidate list size
+HNSW_EF_SEARCH = None             # HNSW query: candidate list size (recall vs latency), None = server default (40)
+IVFFLAT_LISTS = 100               # IVFFlat build: number of lists (about rows / 1000)
+IVFFLAT_PROBES = 10               # IVFFlat query: lists searched (recall vs latency), None = server default
+INDEX_MAINTENANCE_WORK_MEM = '512MB'
+
+# Vector storage (see ann_index.STORAGE_MODES): 'vector' indexes the full float32 column;
+# 'halfvec' (half precision) and 'binary' (1 bit per dimension, Hamming distance) add a
+# generated quantized column, index it instead, and re-rank a coarse top-k exactly
+STORAGE_MODE = 'vector'
+RERANK_CANDIDATES = 40            # coarse candidates fetched per query before the exact re-rank
+
+# Retrieval backend: 'pgvector' queries Postgres, 'mmap' searches an in-process,
+# memory-mapped copy of the embeddings (see mmap_index.py)
+RETRIEVAL_BACKEND = 'pgvector'
+MMAP_INDEX_DIR = 'cache/mmap_index'
+MMAP_INDEX_DTYPE = 'float32'      # 'float32' or 'float16' (half the memory, small score error)
+MMAP_INDEX_COMPACT_AFTER = 64     # re-export the snapshot after this many rows changed through /db
+
+# Retrieval result cache (see retrieval_cache.py): invalidated by a knowledge base version
+# bumped on /db mutations and propagated to other workers with LISTEN/NOTIFY
+RETRIEVAL_CACHE_ENABLED = True
+RETRIEVAL_CACHE_SIZE = 5000               # entries
+RETRIEVAL_CACHE_TTL = 3600                # seconds; safety net if a notification is missed
+RETRIEVAL_CACHE_QUANTIZATION = None       # embedding rounding step shared by near-duplicates (e.g. 0.01), None = exact
+RETRIEVAL_CACHE_CHANNEL = 'kb_changes'    # Postgres NOTIFY channel
+RETRIEVAL_CACHE_RECONNECT_DELAY = 5       # seconds between LISTEN reconnect attempts
+RETRIEVAL_CACHE_LISTEN_TIMEOUT = 1        # seconds the listener waits for notifications before checking for shutdown
+
+# Number of JSONL records encoded and written per ingest batch/transaction
+INGEST_BATCH_SIZE = 64
 
 # config.py
 
@@ -65,25 +221,45 @@ If action=add/replace/delete, likely call_to_db=true.
 If it's a general query, call_to_db=false and the new_content would be null
 No extra text or keys.
 """
+# Rolling conversation summary (older turns that no longer fit the LLM #3 history window)
+SUMMARY_PROMPT = """
+You maintain a running summary of a conversation between a user and a Dune assistant.
+You receive:
+{
+  "summary": the current summary or null,
+  "new_messages": [ { "role": "user" or "assistant", "content": "..." }, ... ]
+}
+Return only the updated summary as plain text. Fold the new messages into the existing summary,
+keeping the user's requests, the database changes made (actions and row ids) and the facts given in answers.
+Be concise.
+"""
+
 #for tooluse
+# Single-pass pipeline mode (PIPELINE_MODE = 'single_pass'): retrieval runs first and one
+# function-calling request replaces LLM #1 + LLM #2, filling every field below at once.
+SINGLE_PASS_PROMPT = """
+You are a Dune assistant. The user may have a general query that is to be answered or want to interact with knowledge base content (knowledge base contains infomation on Dune website).
+You receive:
+{
+  "query": the user's query,
+  "retrieved_context": [
+    { "id": 1, "content": "...", "url": "..." },
+    ...
+  ]
+}
+retrieved_context are the knowledge base rows most similar to the query. Call db_operation exactly once with your decision.
+"""
+
 db_operation_function = {
     "type": "function",
     "function": {
         "name": "db_operation",
         "description": (
-            "You are a Dune assistant. You receive:\n"
-            "    {\n"
-            "        \"intent\": \"...\",\n"
-            "        \"action\": \"...\",\n"
-            "        \"old_feature\": \"...\",\n"
-            "        \"new_feature\": \"...\",\n"
-            "        \"retrieved_context\": [\n"
-            "            { \"id\": 1, \"content\": \"...\", \"url\": \"...\" } or null,\n"
-            "            ...\n"
-            "        ]\n"
-            "    }\n"
-            "You have to guide to do the database operation according to the input. "
-            "Supported actions: 'add', 'replace', or 'delete'.\n"
+            "Classify the user's query and decide the knowledge base operation, in one step.\n"
+            " - intent is general_purpose for questions (action 'retrieve' when the retrieved context helps "
+            "answer them, null when no knowledge base content is needed), and change_knowledgebase when the user "
+            "wants to add, replace or delete content.\n"
+            "Supported database actions: 'add', 'replace', or 'delete'.\n"
             " - For 'add': you must provide new_content.\n"
             " - For 'replace': you must provide both row_ids and new_content.\n"
             " - For 'delete': you must provide row_ids."
@@ -91,9 +267,23 @@ db_operation_function = {
         "parameters": {
             "type": "object",
             "properties": {
-                "action": {
+                "intent": {
                     "type": "string",
-                    "description": "Must be one of: 'add', 'replace', or 'delete'."
+                    "enum": ["general_purpose", "change_knowledgebase"],
+                    "description": "general_purpose for questions, change_knowledgebase to change knowledge base content."
+                },
+                "action": {
+                    "type": ["string", "null"],
+                    "enum": ["add", "replace", "delete", "retrieve", None],
+                    "description": "Must be one of: 'add', 'replace', 'delete', 'retrieve', or null."
+                },
+                "old_feature": {
+                    "type": ["string", "null"],
+                    "description": "The old feature mentioned in the query that is likely to be replaced or deleted."
+                },
+                "new_feature": {
+                    "type": ["string", "null"],
+                    "description": "The new feature mentioned in the query that is likely to be added or to replace the old one."
                 },
                 "call_to_db": {
                     "type": "boolean",
@@ -105,20 +295,20 @@ db_operation_function = {
                 },
                 "row_ids": {
                     "type": "array",
-                    "description": "List of integer row IDs if action is 'delete' or 'replace'.",
+                    "description": "Ids from retrieved_context to change if action is 'delete' or 'replace'.",
                     "items": {
                         "type": "integer"
                     }
                 },
                 "new_content": {
-                    "type": "string",
+                    "type": ["string", "null"],
                     "description": (
                         "The new content to add or replace. This should be generated based on new_feature. "
                         "If the action is replace, generate new content for the first retrieved context."
                     )
                 }
             },
-            "required": ["action"]
+            "required": ["intent", "action", "call_to_db"]
         }
     }
 }
@@ -0,0 +1,171 @@
+import json
+import logging
+import re
+import textwrap
+import numpy as np
+import config
+import embeddings
+import metrics
+from llm_calls import estimate_tokens
+
+# Token-budgeted packing of retrieved rows before they are sent to LLM #2 / LLM #3.
+# Word runs repeated across rows (site navigation, footers; ingest stores each page as
+# one line, so they are found with word shingles rather than lines) are kept once; the
+# rest is split into passages at sentence ends, passages are scored by cosine
+# similarity to the query with the cached sentence embeddings, near-duplicates are
+# dropped, and the best passages are packed into config.CONTEXT_TOKEN_BUDGET. Every
+# row keeps its id and url, so LLM #2 can still pick rows to replace or delete.
+
+logger = logging.getLogger("context_packing")
+
+CONTEXT_TOKENS = metrics.Counter(
+    "context_packing_tokens_total", "Estimated tokens of retrieved rows before and after packing, and saved.", ["kind"]
+)
+CONTEXT_PASSAGES = metrics.Counter(
+    "context_packing_passages_total", "Passages kept or dropped by context packing.", ["outcome"]
+)
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def _row_tokens(rows) -> int:
+    return estimate_tokens(json.dumps(rows, default=str)) if rows else 0
+
+
+def split_passages(segments, max_chars: int = None):
+    """
+    Group text segments into passages of up to max_chars; a segment longer than that is
+    split at sentence ends (and at word boundaries, if a single sentence is too long).
+    """
+    max_chars = max_chars or config.CONTEXT_PASSAGE_CHARS
+    pieces = []
+    for segment in segments:
+        if len(segment) <= max_chars:
+            pieces.append(segment)
+            continue
+        for sentence in _SENTENCE_END.split(segment):
+            pieces.extend(textwrap.wrap(sentence, max_chars))
+    passages, current = [], ""
+    for piece in pieces:
+        if current and len(current) + len(piece) + 1 > max_chars:
+            passages.append(current)
+            current = ""
+        current = f"{current}\n{piece}" if current else piece
+    if current:
+        passages.append(current)
+    return passages
+
+
+def dedupe_words(words, seen, shingle_words: int = None):
+    """
+    Drop every run of at least shingle_words words that already appeared (as a
+    case-insensitive shingle in `seen`, which is updated). Returns (segments of the
+    remaining words, number of words dropped).
+    """
+    size = shingle_words or config.CONTEXT_DEDUP_SHINGLE_WORDS
+    keys = [word.lower() for word in words]
+    repeated = [False] * len(words)
+    for start in range(len(words) - size + 1):
+        shingle = tuple(keys[start:start + size])
+        if shingle in seen:
+            repeated[start:start + size] = [True] * size
+        else:
+            seen.add(shingle)
+    segments, current = [], []
+    for word, drop in zip(words, repeated):
+        if drop:
+            if current:
+                segments.append(" ".join(current))
+                current = []
+        else:
+            current.append(word)
+    if current:
+        segments.append(" ".join(current))
+    return segments, sum(repeated)
+
+
+def prepare_passages(rows):
+    """
+    Split every row's content into passages, dropping word runs already seen in an
+    earlier row (or earlier in the same row). Returns ([(row index, passage), ...],
+    words dropped).
+    """
+    seen = set()
+    passages = []
+    duplicates = 0
+    for index, row in enumerate(rows):
+        segments, dropped = dedupe_words(str(row.get("content") or "").split(), seen)
+        duplicates += dropped
+        passages.extend((index, passage) for passage in split_passages(segments))
+    return passages, duplicates
+
+
+def select_passages(passages, scores, vectors, budget: int, dedup_similarity: float = None):
+    """
+    Indexes of the passages to keep: first the best passage of each row (in row order),
+    then the rest by score, while the token budget allows. A passage whose embedding is
+    within dedup_similarity (cosine) of a kept one is skipped as a near-duplicate.
+    Returns (kept indexes, near-duplicates skipped).
+    """
+    dedup_similarity = config.CONTEXT_DEDUP_SIMILARITY if dedup_similarity is None else dedup_similarity
+    order = sorted(range(len(passages)), key=lambda i: -scores[i])
+    best_per_row = {}
+    for i in order:
+        best_per_row.setdefault(passages[i][0], i)
+    candidates = [best_per_row[row] for row in sorted(best_per_row)]
+    firsts = set(candidates)
+    candidates += [i for i in order if i not in firsts]
+
+    kept, used, near_duplicates = [], 0, 0
+    for i in candidates:
+        if kept and float(np.max(vectors[kept] @ vectors[i])) >= dedup_similarity:
+            near_duplicates += 1
+            continue
+        tokens = estimate_tokens(passages[i][1])
+        if used + tokens > budget:
+            continue
+        kept.append(i)
+        used += tokens
+    return kept, near_duplicates
+
+
+async def apack_rows(query: str, rows, budget: int = None):
+    """
+    Pack rows for an LLM prompt. Returns (packed rows, report), where the report has
+    the estimated tokens before and after packing, tokens saved and passage counts.
+    Rows that already fit the budget are returned unchanged without encoding anything.
+    """
+    budget = config.CONTEXT_TOKEN_BUDGET if budget is None else budget
+    tokens_before = _row_tokens(rows)
+    report = {"tokens_before": tokens_before, "tokens_after": tokens_before, "tokens_saved": 0,
+              "passages": 0, "kept": 0, "duplicate_words": 0, "near_duplicates": 0}
+    if not config.CONTEXT_PACKING_ENABLED or not rows or not query or tokens_before <= budget:
+        return rows, report
+
+    passages, report["duplicate_words"] = prepare_passages(rows)
+    report["passages"] = len(passages)
+    if not passages:
+        return rows, report
+    vectors = np.asarray(await embeddings.aencode([query] + [passage for _, passage in passages]), dtype=np.float32)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    scores = vectors[1:] @ vectors[0]
+    # The ids, urls and JSON structure of the rows count against the budget too
+    overhead = _row_tokens([dict(row, content="") for row in rows])
+    kept, report["near_duplicates"] = select_passages(passages, scores, vectors[1:], max(budget - overhead, 0))
+    report["kept"] = len(kept)
+
+    selected = [[] for _ in rows]
+    for i in sorted(kept):
+        selected[passages[i][0]].append(passages[i][1])
+    packed = [dict(row, content="\n...\n".join(parts)) for row, parts in zip(rows, selected)]
+
+    report["tokens_after"] = _row_tokens(packed)
+    report["tokens_saved"] = max(tokens_before - report["tokens_after"], 0)
+    CONTEXT_TOKENS.inc(tokens_before, kind="retrieved")
+    CONTEXT_TOKENS.inc(report["tokens_after"], kind="packed")
+    CONTEXT_TOKENS.inc(report["tokens_saved"], kind="saved")
+    CONTEXT_PASSAGES.inc(report["kept"], outcome="kept")
+    CONTEXT_PASSAGES.inc(report["near_duplicates"], outcome="near_duplicate")
+    CONTEXT_PASSAGES.inc(report["passages"] - report["kept"] - report["near_duplicates"], outcome="over_budget")
+    logger.debug("Packed %d rows: %s", len(rows), report)
+    return packed, report
@@ -1,51 +1,235 @@
-import psycopg
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
 from langchain_postgres import PostgresChatMessageHistory
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
-import numpy as np
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, messages_from_dict
 import config
+import db_pool
+import embeddings
 import logging
 
 class ConversationManager:
     """
     Manages storing and retrieving conversation messages
     via langchain_postgres' PostgresChatMessageHistory.
+    Connections are borrowed from the shared chat pool for each operation.
     """
 
-    def __init__(self, connection_string: str, table_name: str, session_id: str, logger: logging.Logger = None):
+    def __init__(self, table_name: str, session_id: str, logger: logging.Logger = None, pool: db_pool.ConnectionPool = None,
+                 async_pool: db_pool.AsyncConnectionPool = None, create_tables: bool = True):
         # Use the provided logger, or fallback to module logger.
         self.logger = logger or logging.getLogger(__name__)
-        
-        # 1) Open a synchronous psycopg connection
-        self.conn = psycopg.connect(connection_string)
+        self.pool = pool or db_pool.get_chat_pool()
+        self.async_pool = async_pool
+        self.table_name = table_name
+        self.session_id = session_id
+        # Embeddings of the user queries, written once in add_user_message
+        self.embedding_table = self.embedding_table_name(table_name)
+        # Rolling summary of the turns that fell out of the LLM #3 history window
+        self.summary_table = self.summary_table_name(table_name)
+
+        # Create the table schema (only needed once, but safe to call each time).
+        # ConversationManagerPool creates it once up front and passes create_tables=False.
+        if create_tables:
+            self.create_tables(table_name, self.pool)
+
+    @staticmethod
+    def embedding_table_name(table_name: str) -> str:
+        return f"{table_name}_query_embeddings"
+
+    @staticmethod
+    def summary_table_name(table_name: str) -> str:
+        return f"{table_name}_summaries"
+
+    @classmethod
+    def create_tables(cls, table_name: str, pool: db_pool.ConnectionPool = None) -> None:
+        """Create the chat history, query embedding and summary tables if they do not exist."""
+        embedding_table = cls.embedding_table_name(table_name)
+        summary_table = cls.summary_table_name(table_name)
+        with (pool or db_pool.get_chat_pool()).connection() as conn:
+            PostgresChatMessageHistory.create_tables(conn, table_name)
+            conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {embedding_table} (
+                id BIGSERIAL PRIMARY KEY,
+                session_id TEXT NOT NULL,
+                query TEXT NOT NULL,
+                embedding vector({config.EMBEDDING_DIM}) NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+            """)
+            conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {embedding_table}_session_idx ON {embedding_table} (session_id);"
+            )
+            conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {summary_table} (
+                session_id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                summarized_until_id BIGINT NOT NULL,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+            """)
+            conn.commit()
+
+    @contextmanager
+    def _chat_history(self):
+        """Yield a chat history object bound to a pooled psycopg connection."""
+        with self.pool.connection() as conn:
+            yield PostgresChatMessageHistory(
+                self.table_name,
+                self.session_id,
+                sync_connection=conn
+            )
 
-        # 2) Create the table schema (only needed once, but safe to call each time)
-        PostgresChatMessageHistory.create_tables(self.conn, table_name)
+    def _async_pool(self):
+        return self.async_pool or db_pool.get_async_pool()
 
-        # 3) Instantiate the chat history object
-        self.chat_history = PostgresChatMessageHistory(
-            "conversation_history",
-            session_id,
-            sync_connection=self.conn
-        )
+    @asynccontextmanager
+    async def _achat_history(self):
+        """Yield a chat history object bound to a pooled async psycopg connection."""
+        async with self._async_pool().connection() as conn:
+            yield PostgresChatMessageHistory(
+                self.table_name,
+                self.session_id,
+                async_connection=conn
+            )
+
+    def _add_message(self, message) -> None:
+        with self._chat_history() as chat_history:
+            chat_history.add_messages([message])
+
+    async def _aadd_message(self, message) -> None:
+        async with self._achat_history() as chat_history:
+            await chat_history.aadd_messages([message])
 
     def add_user_message(self, message_text: str) -> None:
-        """Add a user message to the conversation."""
-        self.chat_history.add_messages([HumanMessage(content=message_text)])
+        """
+        Add a user message to the conversation, storing its embedding alongside
+        so later similarity checks never re-encode previous queries.
+        """
+        embedding_str = embeddings.to_vector_literal(embeddings.encode(message_text))
+        with self.pool.connection() as conn:
+            chat_history = PostgresChatMessageHistory(self.table_name, self.session_id, sync_connection=conn)
+            chat_history.add_messages([HumanMessage(content=message_text)])
+            conn.execute(
+                f"INSERT INTO {self.embedding_table} (session_id, query, embedding) VALUES (%s, %s, %s::vector)",
+                (self.session_id, message_text, embedding_str)
+            )
+            conn.commit()
 
     def add_ai_message(self, message_text: str) -> None:
         """Add an AI/assistant message to the conversation."""
-        self.chat_history.add_messages([AIMessage(content=message_text)])
+        self._add_message(AIMessage(content=message_text))
 
     def add_system_message(self, message_text: str) -> None:
         """Add a system message to the conversation (optional)."""
-        self.chat_history.add_messages([SystemMessage(content=message_text)])
+        self._add_message(SystemMessage(content=message_text))
+
+    async def aadd_user_message(self, message_text: str) -> None:
+        """Async version of add_user_message."""
+        embedding = await embeddings.aencode(message_text)
+        embedding_str = embeddings.to_vector_literal(embedding)
+        async with self._async_pool().connection() as conn:
+            chat_history = PostgresChatMessageHistory(self.table_name, self.session_id, async_connection=conn)
+            await chat_history.aadd_messages([HumanMessage(content=message_text)])
+            await conn.execute(
+                f"INSERT INTO {self.embedding_table} (session_id, query, embedding) VALUES (%s, %s, %s::vector)",
+                (self.session_id, message_text, embedding_str)
+            )
+            await conn.commit()
+
+    async def aadd_ai_message(self, message_text: str) -> None:
+        """Async version of add_ai_message."""
+        await self._aadd_message(AIMessage(content=message_text))
 
     def get_conversation_history(self):
         """
         Return the entire conversation as a list of LangChain
         message objects (SystemMessage, HumanMessage, AIMessage).
         """
-        return self.chat_history.get_messages()
+        with self._chat_history() as chat_history:
+            return chat_history.get_messages()
+
+    async def aget_conversation_history(self):
+        """Async version of get_conversation_history."""
+        async with self._achat_history() as chat_history:
+            return await chat_history.aget_messages()
+
+    def get_recent_messages(self, limit: int):
+        """
+        Return the last `limit` messages of the session, oldest first, as
+        (message_id, message) pairs. Only those rows are read from the database.
+        """
+        with self.pool.connection() as conn:
+            rows = conn.execute(self._recent_messages_sql(), (self.session_id, limit)).fetchall()
+        return self._to_records(reversed(rows))
+
+    async def aget_recent_messages(self, limit: int):
+        """Async version of get_recent_messages."""
+        async with self._async_pool().connection() as conn:
+            cur = await conn.execute(self._recent_messages_sql(), (self.session_id, limit))
+            rows = await cur.fetchall()
+        return self._to_records(reversed(rows))
+
+    async def aget_messages_between(self, after_id: int, before_id: int, limit: int):
+        """
+        Return up to `limit` (message_id, message) pairs with after_id < id < before_id,
+        oldest first. Used to fold turns into the rolling summary.
+        """
+        async with self._async_pool().connection() as conn:
+            cur = await conn.execute(
+                f"""
+                SELECT id, message FROM {self.table_name}
+                WHERE session_id = %s AND id > %s AND id < %s
+                ORDER BY id LIMIT %s
+                """,
+                (self.session_id, after_id, before_id, limit)
+            )
+            rows = await cur.fetchall()
+        return self._to_records(rows)
+
+    def get_summary(self):
+        """Return (summary, summarized_until_id) for the session, or (None, 0)."""
+        with self.pool.connection() as conn:
+            row = conn.execute(self._summary_sql(), (self.session_id,)).fetchone()
+        return (row[0], row[1]) if row else (None, 0)
+
+    async def aget_summary(self):
+        """Async version of get_summary."""
+        async with self._async_pool().connection() as conn:
+            cur = await conn.execute(self._summary_sql(), (self.session_id,))
+            row = await cur.fetchone()
+        return (row[0], row[1]) if row else (None, 0)
+
+    async def asave_summary(self, summary: str, summarized_until_id: int) -> None:
+        """Persist the rolling summary; never moves summarized_until_id backwards."""
+        async with self._async_pool().connection() as conn:
+            await conn.execute(
+                f"""
+                INSERT INTO {self.summary_table} (session_id, summary, summarized_until_id, updated_at)
+                VALUES (%s, %s, %s, now())
+                ON CONFLICT (session_id) DO UPDATE
+                SET summary = EXCLUDED.summary,
+                    summarized_until_id = EXCLUDED.summarized_until_id,
+                    updated_at = EXCLUDED.updated_at
+                WHERE {self.summary_table}.summarized_until_id < EXCLUDED.summarized_until_id
+                """,
+                (self.session_id, summary, summarized_until_id)
+            )
+            await conn.commit()
+
+    def _recent_messages_sql(self) -> str:
+        return f"SELECT id, message FROM {self.table_name} WHERE session_id = %s ORDER BY id DESC LIMIT %s"
+
+    def _summary_sql(self) -> str:
+        return f"SELECT summary, summarized_until_id FROM {self.summary_table} WHERE session_id = %s"
+
+    @staticmethod
+    def _to_records(rows):
+        rows = list(rows)
+        messages = messages_from_dict([message for _, message in rows])
+        return [(message_id, message) for (message_id, _), message in zip(rows, messages)]
 
     def convert_langchain_messages_to_openai(self, messages):
         converted = []
@@ -63,34 +247,143 @@ class ConversationManager:
 
     def clear_session(self):
         """Clear the conversation (deletes all messages for this session_id)."""
-        self.chat_history.clear()
+        with self.pool.connection() as conn:
+            PostgresChatMessageHistory(self.table_name, self.session_id, sync_connection=conn).clear()
+            conn.execute(f"DELETE FROM {self.embedding_table} WHERE session_id = %s", (self.session_id,))
+            conn.execute(f"DELETE FROM {self.summary_table} WHERE session_id = %s", (self.session_id,))
+            conn.commit()
 
     def has_relevant_previous_query(self, current_query: str, threshold: float = 0.70) -> bool:
         """
         Compare the current query to all previous user queries using sentence embeddings.
         Returns True if any previous query has a cosine similarity above the given threshold.
+
+        Previous query embeddings are stored by add_user_message, so only the current
+        query is encoded; the comparison is a single pgvector nearest-neighbour lookup.
         
         Parameters:
             current_query (str): The new user query.
-            threshold (float): The cosine similarity level required (between -1 and 1). Default is 0.92.
+            threshold (float): The cosine similarity level required (between -1 and 1). Default is 0.70.
         
         Returns:
             bool: True if a similar previous query exists, False otherwise.
         """
-        # Compute the embedding for the current query.
-        current_embedding = config.embedding_model.encode(current_query)
         self.logger.debug("Current query: %s", current_query)
-        
-        previous_messages = self.get_conversation_history()
-        for msg in previous_messages:
-            if hasattr(msg, "type") and msg.type == "human":
-                self.logger.debug("Comparing with previous query: %s", msg.content)
-                previous_embedding = config.embedding_model.encode(msg.content)
-                # Compute cosine similarity
-                similarity = np.dot(current_embedding, previous_embedding) / (np.linalg.norm(current_embedding) * np.linalg.norm(previous_embedding))
-                self.logger.debug("Similarity with [%s]: %.4f", msg.content, similarity)
-                if similarity >= threshold:
-                    self.logger.debug("Match found with similarity: %.4f", similarity)
-                    return True
+        embedding_str = embeddings.to_vector_literal(embeddings.encode(current_query))
+        with self.pool.connection() as conn:
+            row = conn.execute(self._most_similar_sql(), {"embedding": embedding_str, "session_id": self.session_id}).fetchone()
+        return self._is_match(current_query, row, threshold)
+
+    async def ahas_relevant_previous_query(self, current_query: str, threshold: float = 0.70) -> bool:
+        """Async version of has_relevant_previous_query; encodes on the embedding executor."""
+        self.logger.debug("Current query: %s", current_query)
+        embedding = await embeddings.aencode(current_query)
+        embedding_str = embeddings.to_vector_literal(embedding)
+        async with self._async_pool().connection() as conn:
+            cur = await conn.execute(self._most_similar_sql(), {"embedding": embedding_str, "session_id": self.session_id})
+            row = await cur.fetchone()
+        return self._is_match(current_query, row, threshold)
+
+    def _most_similar_sql(self) -> str:
+        # Cosine similarity is 1 - cosine distance (the <=> operator)
+        return f"""
+        SELECT query, 1 - (embedding <=> %(embedding)s::vector) AS similarity
+        FROM {self.embedding_table}
+        WHERE session_id = %(session_id)s
+        ORDER BY embedding <=> %(embedding)s::vector
+        LIMIT 1;
+        """
+
+    def _is_match(self, current_query: str, row, threshold: float) -> bool:
+        if row is not None:
+            previous_query, similarity = row
+            self.logger.debug("Most similar previous query [%s]: %.4f", previous_query, similarity)
+            if similarity >= threshold:
+                self.logger.debug("Match found with similarity: %.4f", similarity)
+                return True
         self.logger.debug("No match found for query: %s", current_query)
         return False
+
+
+class ConversationManagerPool:
+    """
+    Per-session ConversationManagers keyed by session id, held in a bounded LRU
+    with idle eviction. Managers hold no connection of their own (they borrow from
+    the shared pools per operation), so thousands of sessions share a handful of
+    database connections. Tables are created once, not per manager.
+    """
+
+    def __init__(self, table_name: str, max_sessions: int = config.MAX_SESSIONS,
+                 idle_timeout: float = config.SESSION_IDLE_TIMEOUT, logger: logging.Logger = None):
+        self.table_name = table_name
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.logger = logger or logging.getLogger(__name__)
+        self._managers = OrderedDict()  # session_id -> (manager, last_used)
+        self._lock = threading.Lock()
+        self._tables_created = False
+        self._stats = {"created": 0, "reused": 0, "evicted_lru": 0, "evicted_idle": 0}
+
+    def create_tables(self) -> None:
+        """Create the conversation tables once for every manager in the pool."""
+        ConversationManager.create_tables(self.table_name)
+        self._tables_created = True
+
+    @staticmethod
+    def normalize_session_id(session_id: str = None) -> str:
+        """
+        Return a canonical session id, generating one when none is given.
+        Raises ValueError if session_id is not a UUID (required by the history table).
+        """
+        if not session_id:
+            return str(uuid.uuid4())
+        return str(uuid.UUID(session_id))
+
+    def get(self, session_id: str) -> ConversationManager:
+        """Return the manager for session_id, creating it if needed."""
+        if not self._tables_created:
+            self.create_tables()
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._managers.pop(session_id, None)
+            if entry is None:
+                manager = ConversationManager(
+                    table_name=self.table_name,
+                    session_id=session_id,
+                    logger=self.logger,
+                    create_tables=False
+                )
+                self._stats["created"] += 1
+            else:
+                manager = entry[0]
+                self._stats["reused"] += 1
+            self._managers[session_id] = (manager, now)
+            while len(self._managers) > self.max_sessions:
+                self._managers.popitem(last=False)
+                self._stats["evicted_lru"] += 1
+        return manager
+
+    def evict_idle(self) -> int:
+        """Drop managers idle longer than idle_timeout; returns the number removed."""
+        with self._lock:
+            return self._evict_idle(time.monotonic())
+
+    def _evict_idle(self, now: float) -> int:
+        removed = 0
+        # Entries are ordered by last use, so stop at the first one still active
+        while self._managers:
+            session_id, (_, last_used) = next(iter(self._managers.items()))
+            if now - last_used <= self.idle_timeout:
+                break
+            del self._managers[session_id]
+            removed += 1
+        self._stats["evicted_idle"] += removed
+        return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["active_sessions"] = len(self._managers)
+        stats["max_sessions"] = self.max_sessions
+        return stats
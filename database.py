@@ -1,85 +1,375 @@
+import argparse
+import hashlib
+import io
 import json
 import os
-import psycopg2
+import struct
+import numpy as np
 from psycopg2.extras import execute_values
+import ann_index
 import config
+import db_pool
+import embeddings
+import mmap_index
+import retrieval_cache
 
-def get_connection():
-    """
-    Establish a connection to the PostgreSQL database using details from config.py.
-    """
-    conn = psycopg2.connect(
-        host=config.DB_HOST,
-        port=config.DB_PORT,
-        dbname=config.DB_NAME,
-        user=config.DB_USER,
-        password=config.DB_PASSWORD
-    )
-    return conn
+# Signature that opens every PostgreSQL binary COPY stream
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+# Table tracking how far each JSONL source has been ingested
+CHECKPOINT_TABLE = 'ingest_checkpoints'
 
 def setup_table():
     """
     Sets up the database table by ensuring the pgvector extension is enabled and
     creating the table with columns: id, content, url, and embedding.
     """
-    conn = get_connection()
-    cur = conn.cursor()
-    # Create the pgvector extension if it does not exist
-    cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
-    # Create the table if it does not exist
-    cur.execute(f"""
-    CREATE TABLE IF NOT EXISTS {config.TABLE_NAME} (
-        id SERIAL PRIMARY KEY,
-        content TEXT,
-        url TEXT,
-        embedding vector({config.EMBEDDING_DIM})
-    );
-    """)
-    conn.commit()
-    cur.close()
-    conn.close()
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        # Create the pgvector extension if it does not exist
+        cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+        # Create the table if it does not exist
+        cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {config.TABLE_NAME} (
+            id SERIAL PRIMARY KEY,
+            content TEXT,
+            url TEXT,
+            embedding vector({config.EMBEDDING_DIM})
+        );
+        """)
+        # Columns used by the incremental sync mode: rows it manages carry the source
+        # file and a hash of their content, and are unique by url
+        cur.execute(f"ALTER TABLE {config.TABLE_NAME} ADD COLUMN IF NOT EXISTS content_hash TEXT;")
+        cur.execute(f"ALTER TABLE {config.TABLE_NAME} ADD COLUMN IF NOT EXISTS source TEXT;")
+        cur.execute(f"""
+        CREATE UNIQUE INDEX IF NOT EXISTS {config.TABLE_NAME}_url_key
+        ON {config.TABLE_NAME} (url) WHERE source IS NOT NULL;
+        """)
+        # Quantized copy of the embedding for the halfvec/binary storage modes
+        if ann_index.storage_mode() != "vector":
+            cur.execute(ann_index.quantized_column_definition())
+        # Create the ingest checkpoint table used to resume interrupted ingests
+        cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE} (
+            source TEXT PRIMARY KEY,
+            byte_offset BIGINT NOT NULL,
+            rows_ingested BIGINT NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        """)
+        conn.commit()
+        cur.close()
     print("Table setup completed.")
 
 def compute_embedding(content):
     """
-    Compute embedding using the SentenceTransformer model from config.embedding_model.
-    The model returns a numpy array that is converted to a list of floats.
+    Compute embedding using the SentenceTransformer model from config.get_embedding_model()
+    (through the shared embedding cache). The numpy array is converted to a list of floats.
     """
-    embedding = config.embedding_model.encode(content)
+    embedding = embeddings.encode(content)
     # Convert numpy array to list if needed
     return embedding.tolist() if hasattr(embedding, 'tolist') else list(embedding)
 
-def ingest_jsonl(file_path=config.JSONL_FILE):
+def iter_jsonl(file_path, start_offset=0):
+    """
+    Lazily read a JSONL file starting at a byte offset.
+    Yields (end_offset, content, url) for each record, where end_offset is the byte
+    position just after the record's line (used as the resume checkpoint).
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(start_offset)
+        offset = start_offset
+        for line in f:
+            offset += len(line)
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            content = (record.get("content") or "").replace("\n", " ")
+            url = record.get("url", "")
+            yield offset, content, url
+
+def iter_batches(records, batch_size):
+    """
+    Group an iterable of records into lists of at most batch_size items.
+    """
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def compute_embeddings(contents):
+    """
+    Encode a list of contents in one call to the embedding model
+    (contents already in the embedding cache are not re-encoded).
+    Returns a float32 numpy array of shape (len(contents), EMBEDDING_DIM).
+    """
+    return np.asarray(embeddings.encode(contents), dtype=np.float32)
+
+def encode_vector_binary(embedding):
     """
-    Reads a JSONL file line by line, computes embeddings for each content, and inserts
-    the records into the database.
+    Encode an embedding in pgvector's binary wire format:
+    int16 dimension, int16 unused, then big-endian float4 values.
+    """
+    embedding = np.asarray(embedding, dtype='>f4')
+    return struct.pack('!hh', embedding.shape[0], 0) + embedding.tobytes()
+
+def build_copy_payload(rows):
+    """
+    Build a binary COPY stream for (content, url, embedding) rows; a None content or
+    url is written as NULL.
+    """
+    buf = io.BytesIO()
+    buf.write(COPY_SIGNATURE + struct.pack('!ii', 0, 0))
+    for content, url, embedding in rows:
+        buf.write(struct.pack('!h', 3))
+        for value in (content, url):
+            if value is None:
+                # NULL field: length -1 and no data
+                buf.write(struct.pack('!i', -1))
+                continue
+            value = value.encode('utf-8')
+            buf.write(struct.pack('!i', len(value)))
+            buf.write(value)
+        value = encode_vector_binary(embedding)
+        buf.write(struct.pack('!i', len(value)))
+        buf.write(value)
+    buf.write(struct.pack('!h', -1))
+    buf.seek(0)
+    return buf
+
+def copy_rows(cur, rows):
+    """
+    Write (content, url, embedding) rows to the table with a binary COPY.
+    """
+    cur.copy_expert(
+        f"COPY {config.TABLE_NAME} (content, url, embedding) FROM STDIN WITH (FORMAT binary)",
+        build_copy_payload(rows)
+    )
+
+def get_checkpoint(cur, source):
+    """
+    Return (byte_offset, rows_ingested) recorded for a source file, or (0, 0).
+    """
+    cur.execute(
+        f"SELECT byte_offset, rows_ingested FROM {CHECKPOINT_TABLE} WHERE source = %s",
+        (source,)
+    )
+    row = cur.fetchone()
+    return (row[0], row[1]) if row else (0, 0)
+
+def save_checkpoint(cur, source, byte_offset, rows_ingested):
+    """
+    Record ingest progress for a source file. Runs in the same transaction as the
+    batch it describes, so a committed batch and its checkpoint never diverge.
+    """
+    cur.execute(
+        f"""
+        INSERT INTO {CHECKPOINT_TABLE} (source, byte_offset, rows_ingested, updated_at)
+        VALUES (%s, %s, %s, now())
+        ON CONFLICT (source) DO UPDATE
+        SET byte_offset = EXCLUDED.byte_offset,
+            rows_ingested = EXCLUDED.rows_ingested,
+            updated_at = EXCLUDED.updated_at
+        """,
+        (source, byte_offset, rows_ingested)
+    )
+
+def ingest_jsonl(file_path=config.JSONL_FILE, batch_size=config.INGEST_BATCH_SIZE, restart=False):
+    """
+    Streams a JSONL file into the database in batches. Each batch is encoded with a
+    single embedding call and written with a binary COPY in its own transaction,
+    together with a checkpoint of the file offset reached. Re-running resumes after
+    the last committed batch; pass restart=True to ingest the file from the start.
     """
     if not os.path.exists(file_path):
         print(f"File {file_path} does not exist.")
         return
 
-    conn = get_connection()
+    source = os.path.abspath(file_path)
+    with db_pool.connection() as conn:
+        total = _ingest_from_checkpoint(conn, file_path, source, batch_size, restart)
+    print(f"Ingest of {source} complete: {total} records.")
+
+def _ingest_from_checkpoint(conn, file_path, source, batch_size, restart):
     cur = conn.cursor()
-    data_to_insert = []
-    
-    with open(file_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            record = json.loads(line)
-            content = record.get("content", "").replace("\n", " ")
-            url = record.get("url", "")
-            embedding = compute_embedding(content)
-            # Convert the embedding list into the PostgreSQL vector literal format (e.g., [0.1,0.2,...])
-            embedding_str = f'[{",".join(map(str, embedding))}]'
-            data_to_insert.append((content, url, embedding_str))
-    
-    # Bulk insert using execute_values for efficiency
-    insert_query = f"INSERT INTO {config.TABLE_NAME} (content, url, embedding) VALUES %s"
-    execute_values(cur, insert_query, data_to_insert)
-    conn.commit()
-    cur.close()
-    conn.close()
-    print(f"Ingested {len(data_to_insert)} records.")
+    try:
+        if restart:
+            cur.execute(f"DELETE FROM {CHECKPOINT_TABLE} WHERE source = %s", (source,))
+            conn.commit()
+        start_offset, total = get_checkpoint(cur, source)
+        conn.commit()
+        if start_offset:
+            print(f"Resuming {source} at byte {start_offset} ({total} records already ingested).")
+
+        for batch in iter_batches(iter_jsonl(file_path, start_offset), batch_size):
+            contents = [content for _, content, _ in batch]
+            vectors = compute_embeddings(contents)
+            copy_rows(cur, [(content, url, vector) for (_, content, url), vector in zip(batch, vectors)])
+            total += len(batch)
+            save_checkpoint(cur, source, batch[-1][0], total)
+            conn.commit()
+            print(f"Ingested {total} records.")
+    finally:
+        cur.close()
+    return total
+
+def content_hash(content):
+    """Hash of a document's content; matches md5(content) computed in Postgres."""
+    return hashlib.md5(content.encode('utf-8')).hexdigest()
+
+def scan_source(file_path):
+    """
+    First sync pass: map each url to (content_hash, end_offset) of its last record
+    in the file. Contents are not kept, so memory stays small. Records without a url
+    cannot be matched to a row on the next sync, so they are left out and counted.
+    Returns (documents, duplicate_count, missing_url_count).
+    """
+    documents = {}
+    duplicates = 0
+    missing_urls = 0
+    for end_offset, content, url in iter_jsonl(file_path):
+        if not url:
+            missing_urls += 1
+            continue
+        if url in documents:
+            duplicates += 1
+        documents[url] = (content_hash(content), end_offset)
+    return documents, duplicates, missing_urls
+
+def adopt_legacy_rows(cur, source, urls):
+    """
+    Let the sync manage rows written by the append-only ingest (source IS NULL):
+    duplicate rows per url are removed and the remaining row is claimed with the
+    hash of its current content, so unchanged documents keep their embedding.
+    """
+    cur.execute(
+        f"""
+        DELETE FROM {config.TABLE_NAME} a USING {config.TABLE_NAME} b
+        WHERE a.source IS NULL AND b.source IS NULL
+          AND a.url = b.url AND a.id > b.id AND a.url = ANY(%s)
+        """,
+        (urls,)
+    )
+    cur.execute(
+        f"""
+        UPDATE {config.TABLE_NAME} t
+        SET source = %s, content_hash = md5(t.content)
+        WHERE t.source IS NULL AND t.url = ANY(%s)
+          AND NOT EXISTS (
+              SELECT 1 FROM {config.TABLE_NAME} m WHERE m.source IS NOT NULL AND m.url = t.url
+          )
+        """,
+        (source, urls)
+    )
+    return cur.rowcount
+
+def upsert_rows(cur, source, rows):
+    """Insert or update (content, url, content_hash, embedding) rows by url."""
+    execute_values(
+        cur,
+        f"""
+        INSERT INTO {config.TABLE_NAME} (content, url, content_hash, embedding, source) VALUES %s
+        ON CONFLICT (url) WHERE source IS NOT NULL DO UPDATE
+        SET content = EXCLUDED.content,
+            content_hash = EXCLUDED.content_hash,
+            embedding = EXCLUDED.embedding,
+            source = EXCLUDED.source
+        """,
+        [(content, url, digest, embeddings.to_vector_literal(vector), source) for content, url, digest, vector in rows],
+        template="(%s, %s, %s, %s::vector, %s)"
+    )
+
+def sync_jsonl(file_path=config.JSONL_FILE, batch_size=config.INGEST_BATCH_SIZE):
+    """
+    Incrementally sync the table with a JSONL file, keyed by url:
+      - documents whose content hash is unchanged are skipped (no re-embedding),
+      - new and changed documents are embedded in batches and upserted,
+      - rows from this source whose url is no longer in the file are deleted.
+    When a url appears more than once in the file, its last record wins. Records
+    with a null or missing url are skipped with a warning.
+    Returns a dict with inserted/updated/unchanged/deleted counts.
+    """
+    if not os.path.exists(file_path):
+        print(f"File {file_path} does not exist.")
+        return None
+
+    source = os.path.abspath(file_path)
+    documents, duplicates, missing_urls = scan_source(file_path)
+    urls = list(documents)
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0, "deleted": 0, "adopted": 0, "duplicates": duplicates,
+              "missing_url": missing_urls}
+    if missing_urls:
+        print(f"Warning: skipping {missing_urls} records without a url in {source}.")
+
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        try:
+            counts["adopted"] = adopt_legacy_rows(cur, source, urls)
+            conn.commit()
+            cur.execute(
+                f"SELECT url, content_hash FROM {config.TABLE_NAME} WHERE source IS NOT NULL AND url = ANY(%s)",
+                (urls,)
+            )
+            existing = dict(cur.fetchall())
+
+            def changed_records():
+                for end_offset, content, url in iter_jsonl(file_path):
+                    if not url:
+                        continue
+                    digest, winning_offset = documents[url]
+                    if end_offset != winning_offset:
+                        continue
+                    if existing.get(url) == digest:
+                        counts["unchanged"] += 1
+                        continue
+                    counts["updated" if url in existing else "inserted"] += 1
+                    yield content, url, digest
+
+            for batch in iter_batches(changed_records(), batch_size):
+                vectors = compute_embeddings([content for content, _, _ in batch])
+                upsert_rows(cur, source, [(content, url, digest, vector) for (content, url, digest), vector in zip(batch, vectors)])
+                conn.commit()
+                print(f"Synced {counts['inserted'] + counts['updated']} new or changed records.")
+
+            cur.execute(
+                f"DELETE FROM {config.TABLE_NAME} WHERE source = %s AND NOT (url = ANY(%s))",
+                (source, urls)
+            )
+            counts["deleted"] = cur.rowcount
+            conn.commit()
+        finally:
+            cur.close()
+
+    print(
+        f"Sync of {source} complete: {counts['inserted']} inserted, {counts['updated']} updated, "
+        f"{counts['unchanged']} unchanged, {counts['deleted']} deleted "
+        f"({counts['adopted']} existing rows adopted, {counts['duplicates']} duplicate urls and "
+        f"{counts['missing_url']} records without a url in source)."
+    )
+    return counts
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Set up the table and ingest a JSONL file.")
+    parser.add_argument("--file", default=config.JSONL_FILE, help="JSONL file to ingest")
+    parser.add_argument("--batch-size", type=int, default=config.INGEST_BATCH_SIZE, help="records per embedding/COPY batch")
+    parser.add_argument("--restart", action="store_true", help="ignore the saved checkpoint and ingest from the start")
+    parser.add_argument("--sync", action="store_true",
+                        help="incremental sync by url: only embed new/changed documents and delete removed ones")
+    args = parser.parse_args()
+
     setup_table()
-    ingest_jsonl()
+    if args.sync:
+        sync_jsonl(args.file, batch_size=args.batch_size)
+    else:
+        ingest_jsonl(args.file, batch_size=args.batch_size, restart=args.restart)
+    # Build the ANN index after the bulk load; it is kept up to date on later writes
+    if config.VECTOR_INDEX_TYPE:
+        ann_index.create_vector_index()
+    # Publish a fresh snapshot for workers serving retrieval from the in-process index
+    if config.RETRIEVAL_BACKEND == "mmap":
+        print(mmap_index.export_index())
+    # Running query services drop their cached retrieval results
+    retrieval_cache.publish("sync" if args.sync else "ingest")
@@ -2,43 +2,190 @@
 
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
-import psycopg2
+from psycopg2.extras import execute_values
 import config
+import db_pool
+import embeddings
+import logging
 from typing import Optional
 
+logger = logging.getLogger("db_command")
+
 
 router = APIRouter()
 
-def get_connection():
-    return psycopg2.connect(
-        host=config.DB_HOST,
-        port=config.DB_PORT,
-        dbname=config.DB_NAME,
-        user=config.DB_USER,
-        password=config.DB_PASSWORD
-    )
+# Callbacks run after every committed knowledge base mutation, e.g. to invalidate
+# caches. Each is called as callback(action, row_ids).
+_mutation_listeners = []
+# Callbacks run on the mutation's connection just before it commits, as
+# callback(conn, action, row_ids); their statements commit (or roll back) with it.
+_precommit_hooks = []
+
+def add_mutation_listener(callback) -> None:
+    """Register callback(action, row_ids) to run after each committed mutation."""
+    _mutation_listeners.append(callback)
+
+def add_precommit_hook(callback) -> None:
+    """
+    Register callback(conn, action, row_ids) to run in the mutation's transaction
+    before it commits (e.g. a NOTIFY, which Postgres delivers only on commit).
+    An exception aborts the mutation.
+    """
+    _precommit_hooks.append(callback)
+
+def commit_mutation(conn, action: str, row_ids: list) -> None:
+    """Commit a mutation made through the service layer and notify listeners."""
+    for hook in _precommit_hooks:
+        hook(conn, action, row_ids)
+    conn.commit()
+    for callback in _mutation_listeners:
+        try:
+            callback(action, row_ids)
+        except Exception as e:
+            logger.error("Mutation listener %r failed: %s", callback, e)
+
+# Service layer: these functions run on a caller-supplied connection and do not
+# commit, so the pipeline can run them in its own transaction. The HTTP routes
+# below are thin wrappers that borrow a pooled connection and commit.
+
+def embed_contents(contents: list) -> list:
+    """
+    Encode all non-empty contents in one batched call and return pgvector literals
+    (None for empty content, which is stored without an embedding).
+    """
+    present = [index for index, content in enumerate(contents) if content]
+    literals = [None] * len(contents)
+    if present:
+        vectors = embeddings.encode([contents[index] for index in present])
+        for index, vector in zip(present, vectors):
+            literals[index] = embeddings.to_vector_literal(vector)
+    return literals
+
+def bulk_insert(conn, contents: list, urls: Optional[list] = None, vectors: Optional[list] = None) -> list[int]:
+    """
+    Insert rows with their embeddings in one statement and return the new ids,
+    in input order. Pass vectors (from embed_contents) to encode before taking a
+    connection.
+    """
+    if not contents:
+        return []
+    urls = urls or [None] * len(contents)
+    vectors = vectors if vectors is not None else embed_contents(contents)
+    cur = conn.cursor()
+    try:
+        rows = execute_values(
+            cur,
+            f"INSERT INTO {config.TABLE_NAME} (content, url, embedding) VALUES %s RETURNING id",
+            list(zip(contents, urls, vectors)),
+            template="(%s, %s, %s::vector)",
+            fetch=True
+        )
+    finally:
+        cur.close()
+    return [row[0] for row in rows]
+
+def bulk_replace(conn, row_ids: list[int], contents: list, urls: Optional[list] = None,
+                 vectors: Optional[list] = None) -> list[int]:
+    """
+    Replace content (and url, when given) of many rows, re-computing their
+    embeddings, in one statement. Returns the ids that existed and were updated.
+    """
+    if not row_ids:
+        return []
+    urls = urls or [None] * len(row_ids)
+    vectors = vectors if vectors is not None else embed_contents(contents)
+    cur = conn.cursor()
+    try:
+        rows = execute_values(
+            cur,
+            f"""
+            UPDATE {config.TABLE_NAME} AS t
+            SET content = v.content, url = COALESCE(v.url, t.url), embedding = v.embedding::vector
+            FROM (VALUES %s) AS v(id, content, url, embedding)
+            WHERE t.id = v.id
+            RETURNING t.id
+            """,
+            list(zip(row_ids, contents, urls, vectors)),
+            template="(%s::int, %s::text, %s::text, %s::text)",
+            fetch=True
+        )
+    finally:
+        cur.close()
+    return [row[0] for row in rows]
+
+def bulk_delete(conn, row_ids: list[int]) -> list[int]:
+    """Delete rows by id and return the ids that existed and were deleted."""
+    if not row_ids:
+        return []
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            f"DELETE FROM {config.TABLE_NAME} WHERE id = ANY(%s) RETURNING id",
+            (list(row_ids),)
+        )
+        return [row[0] for row in cur.fetchall()]
+    finally:
+        cur.close()
+
+def insert_content(conn, new_content: Optional[str], vectors: Optional[list] = None) -> int:
+    """
+    Insert a new row with new_content (and its embedding) and return its id.
+    Pass vectors (embed_contents([new_content])) to encode before taking a connection.
+    """
+    return bulk_insert(conn, [new_content], vectors=vectors)[0]
+
+def replace_content(conn, row_ids: list[int], new_content: Optional[str], vectors: Optional[list] = None) -> int:
+    """
+    Set content = new_content for the first row_id, refresh its embedding,
+    and return that id. vectors is passed on as in insert_content.
+    """
+    if not row_ids:
+        raise ValueError("No row_ids provided")
+    # Only update the first row_id
+    row_id = row_ids[0]
+    bulk_replace(conn, [row_id], [new_content], vectors=vectors)
+    return row_id
+
+def delete_content(conn, row_ids: list[int]) -> list[int]:
+    """
+    Delete rows by ID and return the ids that were requested for deletion.
+    """
+    if not row_ids:
+        raise ValueError("No row_ids provided")
+    bulk_delete(conn, row_ids)
+    return list(row_ids)
+
+def apply_action(conn, action: Optional[str], new_content: Optional[str] = None, row_ids: Optional[list[int]] = None,
+                 vectors: Optional[list] = None) -> list[int]:
+    """
+    Run an add/replace/delete action on conn and return the changed row ids.
+    Other actions (e.g. retrieve) change nothing and return an empty list.
+    vectors (embed_contents([new_content])) is used by add and replace when given.
+    """
+    action = action.lower() if action else None
+    if action == "add":
+        return [insert_content(conn, new_content, vectors)]
+    if action == "replace":
+        return [replace_content(conn, row_ids or [], new_content, vectors)]
+    if action == "delete":
+        return delete_content(conn, row_ids or [])
+    return []
 
 # 1) ADD
 class AddRequest(BaseModel):
     new_content: Optional[str] = None
 
 @router.post("/add")
-def add_content(body: AddRequest):
+def add_content_endpoint(body: AddRequest):
     """
     Insert a new row with new_content.
-    (In production you'd also compute embedding, etc.)
     """
     try:
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute(
-            f"INSERT INTO {config.TABLE_NAME} (content) VALUES (%s) RETURNING id;",
-            (body.new_content,)
-        )
-        new_id = cur.fetchone()[0]
-        conn.commit()
-        cur.close()
-        conn.close()
+        # Encode before checking out a connection, so the pool is not held during inference
+        vectors = embed_contents([body.new_content])
+        with db_pool.connection() as conn:
+            new_id = insert_content(conn, body.new_content, vectors)
+            commit_mutation(conn, "add", [new_id])
         return {"status": "success", "new_id": new_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -49,7 +196,7 @@ class ReplaceRequest(BaseModel):
     new_content: Optional[str] = None
 
 @router.post("/replace")
-def replace_content(body: ReplaceRequest):
+def replace_content_endpoint(body: ReplaceRequest):
     """
     For each row_id, set content = new_content.
     """
@@ -57,17 +204,10 @@ def replace_content(body: ReplaceRequest):
         return {"status": "no_rows", "message": "No row_ids provided"}
 
     try:
-        conn = get_connection()
-        cur = conn.cursor()
-        # Only update the first row_id
-        row_id = body.row_ids[0]
-        cur.execute(
-            f"UPDATE {config.TABLE_NAME} SET content = %s WHERE id = %s",
-            (body.new_content, row_id)
-        )
-        conn.commit()
-        cur.close()
-        conn.close()
+        vectors = embed_contents([body.new_content])
+        with db_pool.connection() as conn:
+            row_id = replace_content(conn, body.row_ids, body.new_content, vectors)
+            commit_mutation(conn, "replace", [row_id])
         return {"status": "success", "updated_id": row_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -77,7 +217,7 @@ class DeleteRequest(BaseModel):
     row_ids: list[int]
 
 @router.post("/delete")
-def delete_content(body: DeleteRequest):
+def delete_content_endpoint(body: DeleteRequest):
     """
     Delete rows by ID.
     """
@@ -85,15 +225,90 @@ def delete_content(body: DeleteRequest):
         return {"status": "no_rows", "message": "No row_ids provided"}
 
     try:
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute(
-            f"DELETE FROM {config.TABLE_NAME} WHERE id = ANY(%s)",
-            (body.row_ids,)
-        )
-        conn.commit()
-        cur.close()
-        conn.close()
-        return {"status": "success", "deleted_ids": body.row_ids}
+        with db_pool.connection() as conn:
+            deleted_ids = delete_content(conn, body.row_ids)
+            commit_mutation(conn, "delete", deleted_ids)
+        return {"status": "success", "deleted_ids": deleted_ids}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 4) BULK ADD / REPLACE / DELETE
+# Each request is one transaction: embeddings for all items are computed in a
+# single batched encode before a connection is taken, then written in one statement.
+class BulkAddItem(BaseModel):
+    content: str
+    url: Optional[str] = None
+
+class BulkAddRequest(BaseModel):
+    items: list[BulkAddItem]
+
+class BulkReplaceItem(BaseModel):
+    id: int
+    content: str
+    url: Optional[str] = None
+
+class BulkReplaceRequest(BaseModel):
+    items: list[BulkReplaceItem]
+
+class BulkDeleteRequest(BaseModel):
+    row_ids: list[int]
+
+@router.post("/bulk/add")
+def bulk_add_endpoint(body: BulkAddRequest):
+    """
+    Insert many rows with embeddings. Returns one result per item, in order.
+    """
+    contents = [item.content for item in body.items]
+    try:
+        vectors = embed_contents(contents)
+        with db_pool.connection() as conn:
+            new_ids = bulk_insert(conn, contents, [item.url for item in body.items], vectors)
+            commit_mutation(conn, "add", new_ids)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {
+        "status": "success",
+        "results": [{"index": index, "status": "inserted", "id": new_id} for index, new_id in enumerate(new_ids)]
+    }
+
+@router.post("/bulk/replace")
+def bulk_replace_endpoint(body: BulkReplaceRequest):
+    """
+    Replace content (and url, if given) of many rows and refresh their embeddings.
+    Items whose id does not exist are reported as not_found.
+    """
+    row_ids = [item.id for item in body.items]
+    contents = [item.content for item in body.items]
+    try:
+        vectors = embed_contents(contents)
+        with db_pool.connection() as conn:
+            updated = set(bulk_replace(conn, row_ids, contents, [item.url for item in body.items], vectors))
+            commit_mutation(conn, "replace", sorted(updated))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {
+        "status": "success",
+        "results": [
+            {"index": index, "id": row_id, "status": "updated" if row_id in updated else "not_found"}
+            for index, row_id in enumerate(row_ids)
+        ]
+    }
+
+@router.post("/bulk/delete")
+def bulk_delete_endpoint(body: BulkDeleteRequest):
+    """
+    Delete many rows. Ids that do not exist are reported as not_found.
+    """
+    try:
+        with db_pool.connection() as conn:
+            deleted = set(bulk_delete(conn, body.row_ids))
+            commit_mutation(conn, "delete", sorted(deleted))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    return {
+        "status": "success",
+        "results": [
+            {"index": index, "id": row_id, "status": "deleted" if row_id in deleted else "not_found"}
+            for index, row_id in enumerate(body.row_ids)
+        ]
+    }
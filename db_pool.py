@@ -0,0 +1,588 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+import psycopg
+import psycopg2
+import config
+
+logger = logging.getLogger("db_pool")
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the pool timeout."""
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of database connections shared by the whole process.
+
+    Works with any DB-API connection that exposes `closed`, `cursor()`, `rollback()`
+    and `autocommit` (psycopg2 and psycopg 3 both do):
+      - keeps between min_size and max_size connections open,
+      - checks a connection with `SELECT 1` before handing it out if it sat idle
+        longer than check_after seconds,
+      - recycles connections that are broken or older than max_lifetime, and closes
+        idle connections above min_size after max_idle seconds,
+      - counts requests, waits, timeouts, opened and recycled connections.
+    """
+
+    def __init__(self, connect, name, min_size=config.DB_POOL_MIN_SIZE, max_size=config.DB_POOL_MAX_SIZE,
+                 max_lifetime=config.DB_POOL_MAX_LIFETIME, max_idle=config.DB_POOL_MAX_IDLE,
+                 check_after=config.DB_POOL_CHECK_AFTER, timeout=config.DB_POOL_TIMEOUT, autocommit=False):
+        if min_size > max_size:
+            raise ValueError("min_size cannot be larger than max_size")
+        self._connect = connect
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.timeout = timeout
+        self.autocommit = autocommit
+
+        self._cond = threading.Condition()
+        # Idle connections as (conn, created_at, last_used); the right end is the most recently used
+        self._idle = deque()
+        # created_at of every checked-out connection, keyed by id(conn)
+        self._in_use = {}
+        self._size = 0
+        self._waiting = 0
+        self._closed = False
+        self._stats = {
+            "requests": 0,
+            "requests_waited": 0,
+            "wait_time_ms": 0.0,
+            "timeouts": 0,
+            "connections_opened": 0,
+            "connections_recycled": 0,
+            "failed_checks": 0,
+        }
+
+    def open(self):
+        """Open connections up to min_size."""
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            conn = self._new_connection()
+            with self._cond:
+                self._idle.appendleft((conn, time.monotonic(), time.monotonic()))
+                self._cond.notify()
+
+    def getconn(self):
+        """
+        Check a healthy connection out of the pool, opening a new one if the pool
+        is below max_size. Blocks up to `timeout` seconds when the pool is exhausted.
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            conn, created_at, last_used = self._acquire(deadline)
+            if conn is None:
+                conn = self._new_connection()
+                created_at = time.monotonic()
+            elif not self._is_healthy(conn, created_at, last_used):
+                self._discard(conn)
+                continue
+            with self._cond:
+                self._in_use[id(conn)] = created_at
+            return conn
+
+    def putconn(self, conn, discard=False):
+        """
+        Return a connection to the pool. Any open transaction is rolled back;
+        connections that are closed, broken or flagged with discard=True are
+        closed instead of being reused.
+        """
+        with self._cond:
+            created_at = self._in_use.pop(id(conn), None)
+        if created_at is None:
+            raise ValueError(f"connection does not belong to pool '{self.name}'")
+
+        if not discard and not conn.closed:
+            try:
+                conn.rollback()
+                if conn.autocommit != self.autocommit:
+                    conn.autocommit = self.autocommit
+            except Exception as e:
+                logger.warning("Pool '%s': resetting connection failed, discarding it: %s", self.name, e)
+                discard = True
+        if discard or conn.closed or self._closed:
+            self._discard(conn)
+            return
+
+        now = time.monotonic()
+        with self._cond:
+            self._idle.append((conn, created_at, now))
+            expired = self._pop_expired_idle(now)
+            self._cond.notify()
+        for stale in expired:
+            self._discard(stale)
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager that checks out a connection and always returns it.
+        Commit explicitly inside the block; uncommitted work is rolled back.
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+        except (psycopg2.InterfaceError, psycopg2.OperationalError,
+                psycopg.InterfaceError, psycopg.OperationalError):
+            # Connection-level failure: do not hand this connection out again
+            self.putconn(conn, discard=True)
+            raise
+        except BaseException:
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    def stats(self):
+        """Return a snapshot of pool size and usage counters."""
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                "name": self.name,
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": len(self._in_use),
+                "waiting": self._waiting,
+            })
+        return stats
+
+    def close(self):
+        """Close all idle connections; checked-out connections are closed when returned."""
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._close_quietly(conn)
+
+    def _acquire(self, deadline):
+        """
+        Take an idle connection, or reserve a slot for a new one (returns None as conn).
+        """
+        with self._cond:
+            if self._closed:
+                raise PoolTimeout(f"pool '{self.name}' is closed")
+            self._stats["requests"] += 1
+            waited_since = None
+            try:
+                while True:
+                    if self._idle:
+                        return self._idle.pop()
+                    if self._size < self.max_size:
+                        self._size += 1
+                        return None, None, None
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(
+                            f"no connection available in pool '{self.name}' after {self.timeout}s "
+                            f"(max_size={self.max_size})"
+                        )
+                    if waited_since is None:
+                        waited_since = time.monotonic()
+                        self._stats["requests_waited"] += 1
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+            finally:
+                if waited_since is not None:
+                    self._stats["wait_time_ms"] += (time.monotonic() - waited_since) * 1000
+
+    def _new_connection(self):
+        """Open a new connection for a slot already reserved in self._size."""
+        try:
+            conn = self._connect()
+            conn.autocommit = self.autocommit
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._stats["connections_opened"] += 1
+        return conn
+
+    def _is_healthy(self, conn, created_at, last_used):
+        now = time.monotonic()
+        if conn.closed:
+            return False
+        if self.max_lifetime and now - created_at > self.max_lifetime:
+            return False
+        if now - last_used >= self.check_after:
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT 1")
+                cur.close()
+                conn.rollback()
+            except Exception as e:
+                logger.warning("Pool '%s': health check failed, recycling connection: %s", self.name, e)
+                with self._cond:
+                    self._stats["failed_checks"] += 1
+                return False
+        return True
+
+    def _pop_expired_idle(self, now):
+        """Remove idle connections above min_size that exceeded max_idle (caller holds the lock)."""
+        expired = []
+        while self._idle and self._size - len(expired) > self.min_size:
+            conn, _, last_used = self._idle[0]
+            if now - last_used <= self.max_idle:
+                break
+            self._idle.popleft()
+            expired.append(conn)
+        # _discard() adjusts the size for each expired connection
+        return expired
+
+    def _discard(self, conn):
+        self._close_quietly(conn)
+        with self._cond:
+            self._size -= 1
+            self._stats["connections_recycled"] += 1
+            self._cond.notify()
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+class AsyncConnectionPool:
+    """
+    asyncio counterpart of ConnectionPool for psycopg 3 AsyncConnection objects,
+    with the same sizing, health-check, recycling and statistics behaviour.
+    Must be used from a single event loop.
+    """
+
+    def __init__(self, connect, name, min_size=config.DB_POOL_MIN_SIZE, max_size=config.DB_POOL_MAX_SIZE,
+                 max_lifetime=config.DB_POOL_MAX_LIFETIME, max_idle=config.DB_POOL_MAX_IDLE,
+                 check_after=config.DB_POOL_CHECK_AFTER, timeout=config.DB_POOL_TIMEOUT, autocommit=False):
+        if min_size > max_size:
+            raise ValueError("min_size cannot be larger than max_size")
+        self._connect = connect
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.timeout = timeout
+        self.autocommit = autocommit
+
+        self._cond = asyncio.Condition()
+        self._idle = deque()
+        self._in_use = {}
+        self._size = 0
+        self._waiting = 0
+        self._closed = False
+        self._stats = {
+            "requests": 0,
+            "requests_waited": 0,
+            "wait_time_ms": 0.0,
+            "timeouts": 0,
+            "connections_opened": 0,
+            "connections_recycled": 0,
+            "failed_checks": 0,
+        }
+
+    async def open(self):
+        """Open connections up to min_size."""
+        while self._size < self.min_size:
+            self._size += 1
+            conn = await self._new_connection()
+            async with self._cond:
+                self._idle.appendleft((conn, time.monotonic(), time.monotonic()))
+                self._cond.notify()
+
+    async def getconn(self):
+        """
+        Check a healthy connection out of the pool, opening a new one if the pool
+        is below max_size. Waits up to `timeout` seconds when the pool is exhausted.
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            conn, created_at, last_used = await self._acquire(deadline)
+            if conn is None:
+                conn = await self._new_connection()
+                created_at = time.monotonic()
+            elif not await self._is_healthy(conn, created_at, last_used):
+                await self._discard(conn)
+                continue
+            self._in_use[id(conn)] = created_at
+            return conn
+
+    async def putconn(self, conn, discard=False):
+        """
+        Return a connection to the pool, rolling back any open transaction.
+        Broken connections, or ones flagged with discard=True, are closed.
+        """
+        created_at = self._in_use.pop(id(conn), None)
+        if created_at is None:
+            raise ValueError(f"connection does not belong to pool '{self.name}'")
+
+        if not discard and not conn.closed:
+            try:
+                await conn.rollback()
+                if conn.autocommit != self.autocommit:
+                    await conn.set_autocommit(self.autocommit)
+            except Exception as e:
+                logger.warning("Pool '%s': resetting connection failed, discarding it: %s", self.name, e)
+                discard = True
+        if discard or conn.closed or self._closed:
+            await self._discard(conn)
+            return
+
+        now = time.monotonic()
+        expired = []
+        async with self._cond:
+            self._idle.append((conn, created_at, now))
+            while self._idle and self._size - len(expired) > self.min_size:
+                stale, _, last_used = self._idle[0]
+                if now - last_used <= self.max_idle:
+                    break
+                self._idle.popleft()
+                expired.append(stale)
+            self._cond.notify()
+        for stale in expired:
+            await self._discard(stale)
+
+    @asynccontextmanager
+    async def connection(self):
+        """
+        Async context manager that checks out a connection and always returns it.
+        Commit explicitly inside the block; uncommitted work is rolled back.
+        """
+        conn = await self.getconn()
+        try:
+            yield conn
+        except (psycopg.InterfaceError, psycopg.OperationalError):
+            await self.putconn(conn, discard=True)
+            raise
+        except BaseException:
+            await self.putconn(conn)
+            raise
+        else:
+            await self.putconn(conn)
+
+    def stats(self):
+        """Return a snapshot of pool size and usage counters."""
+        stats = dict(self._stats)
+        stats.update({
+            "name": self.name,
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "size": self._size,
+            "idle": len(self._idle),
+            "in_use": len(self._in_use),
+            "waiting": self._waiting,
+        })
+        return stats
+
+    async def close(self):
+        """Close all idle connections; checked-out connections are closed when returned."""
+        self._closed = True
+        idle = [conn for conn, _, _ in self._idle]
+        self._idle.clear()
+        self._size -= len(idle)
+        for conn in idle:
+            try:
+                await conn.close()
+            except Exception:
+                pass
+
+    async def _acquire(self, deadline):
+        if self._closed:
+            raise PoolTimeout(f"pool '{self.name}' is closed")
+        self._stats["requests"] += 1
+        waited_since = None
+        async with self._cond:
+            try:
+                while True:
+                    if self._idle:
+                        return self._idle.pop()
+                    if self._size < self.max_size:
+                        self._size += 1
+                        return None, None, None
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(
+                            f"no connection available in pool '{self.name}' after {self.timeout}s "
+                            f"(max_size={self.max_size})"
+                        )
+                    if waited_since is None:
+                        waited_since = time.monotonic()
+                        self._stats["requests_waited"] += 1
+                    self._waiting += 1
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                    finally:
+                        self._waiting -= 1
+            finally:
+                if waited_since is not None:
+                    self._stats["wait_time_ms"] += (time.monotonic() - waited_since) * 1000
+
+    async def _new_connection(self):
+        """Open a new connection for a slot already reserved in self._size."""
+        try:
+            conn = await self._connect()
+            await conn.set_autocommit(self.autocommit)
+        except Exception:
+            self._size -= 1
+            async with self._cond:
+                self._cond.notify()
+            raise
+        self._stats["connections_opened"] += 1
+        return conn
+
+    async def _is_healthy(self, conn, created_at, last_used):
+        now = time.monotonic()
+        if conn.closed:
+            return False
+        if self.max_lifetime and now - created_at > self.max_lifetime:
+            return False
+        if now - last_used >= self.check_after:
+            try:
+                await conn.execute("SELECT 1")
+                await conn.rollback()
+            except Exception as e:
+                logger.warning("Pool '%s': health check failed, recycling connection: %s", self.name, e)
+                self._stats["failed_checks"] += 1
+                return False
+        return True
+
+    async def _discard(self, conn):
+        try:
+            await conn.close()
+        except Exception:
+            pass
+        self._size -= 1
+        self._stats["connections_recycled"] += 1
+        async with self._cond:
+            self._cond.notify()
+
+
+def _connect_psycopg2():
+    return psycopg2.connect(
+        host=config.DB_HOST,
+        port=config.DB_PORT,
+        dbname=config.DB_NAME,
+        user=config.DB_USER,
+        password=config.DB_PASSWORD
+    )
+
+
+def _connect_psycopg():
+    return psycopg.connect(
+        host=config.DB_HOST,
+        port=config.DB_PORT,
+        dbname=config.DB_NAME,
+        user=config.DB_USER,
+        password=config.DB_PASSWORD
+    )
+
+
+async def _connect_psycopg_async():
+    return await psycopg.AsyncConnection.connect(
+        host=config.DB_HOST,
+        port=config.DB_PORT,
+        dbname=config.DB_NAME,
+        user=config.DB_USER,
+        password=config.DB_PASSWORD
+    )
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _get_or_create(name, connect):
+    with _pools_lock:
+        pool = _pools.get(name)
+        if pool is None:
+            pool = ConnectionPool(connect, name)
+            _pools[name] = pool
+    return pool
+
+
+def get_pool():
+    """Shared psycopg2 pool used by database.py, db_command.py and retrieval.py."""
+    return _get_or_create("main", _connect_psycopg2)
+
+
+def get_chat_pool():
+    """Shared psycopg 3 pool used for conversation history (langchain_postgres needs psycopg 3)."""
+    return _get_or_create("chat", _connect_psycopg)
+
+
+def get_async_pool():
+    """Shared psycopg 3 asyncio pool used by the async query pipeline (retrieval and chat history)."""
+    with _pools_lock:
+        pool = _pools.get("async")
+        if pool is None:
+            pool = AsyncConnectionPool(_connect_psycopg_async, "async", max_size=config.DB_ASYNC_POOL_MAX_SIZE)
+            _pools["async"] = pool
+    return pool
+
+
+def connection():
+    """Shortcut for get_pool().connection()."""
+    return get_pool().connection()
+
+
+def dedicated_connection(autocommit=True):
+    """
+    New unpooled psycopg 3 connection for long-lived work that must not hold a pool
+    slot (e.g. LISTEN). The caller closes it.
+    """
+    conn = _connect_psycopg()
+    conn.autocommit = autocommit
+    return conn
+
+
+def pool_stats():
+    """Return statistics for every pool created in this process."""
+    with _pools_lock:
+        pools = list(_pools.values())
+    return {pool.name: pool.stats() for pool in pools}
+
+
+def close_pools():
+    """Close every thread-safe pool created in this process."""
+    with _pools_lock:
+        pools = [pool for pool in _pools.values() if isinstance(pool, ConnectionPool)]
+        for pool in pools:
+            del _pools[pool.name]
+    for pool in pools:
+        pool.close()
+
+
+async def aclose_pools():
+    """Close every pool created in this process, including asyncio pools."""
+    with _pools_lock:
+        async_pools = [pool for pool in _pools.values() if isinstance(pool, AsyncConnectionPool)]
+        for pool in async_pools:
+            del _pools[pool.name]
+    for pool in async_pools:
+        await pool.close()
+    close_pools()
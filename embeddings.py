@@ -0,0 +1,397 @@
+import asyncio
+import hashlib
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+import config
+import db_pool
+from cache import LRUCache
+
+logger = logging.getLogger("embeddings")
+
+# Dedicated threads for CPU-bound encoding, so async handlers never run the model
+# on the event loop and encoding does not compete with the default executor.
+_executor = ThreadPoolExecutor(max_workers=config.EMBEDDING_WORKERS, thread_name_prefix="embedding")
+
+
+class SqliteEmbeddingStore:
+    """Persistent embedding tier in a local SQLite file."""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embedding_cache (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)"
+            )
+            self._conn.commit()
+
+    def get_many(self, keys):
+        if not keys:
+            return {}
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT key, embedding FROM embedding_cache WHERE key IN ({','.join('?' * len(keys))})",
+                list(keys)
+            ).fetchall()
+        return {key: blob for key, blob in rows}
+
+    def put_many(self, items):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache (key, embedding) VALUES (?, ?)", items
+            )
+            self._conn.commit()
+
+
+class PostgresEmbeddingStore:
+    """Persistent embedding tier in a Postgres table, shared by every worker and node."""
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                f"CREATE TABLE IF NOT EXISTS {table_name} (key TEXT PRIMARY KEY, embedding BYTEA NOT NULL)"
+            )
+            conn.commit()
+            cur.close()
+
+    def get_many(self, keys):
+        if not keys:
+            return {}
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f"SELECT key, embedding FROM {self.table_name} WHERE key = ANY(%s)", (list(keys),))
+            rows = cur.fetchall()
+            cur.close()
+        return {key: bytes(blob) for key, blob in rows}
+
+    def put_many(self, items):
+        with db_pool.connection() as conn:
+            cur = conn.cursor()
+            cur.executemany(
+                f"INSERT INTO {self.table_name} (key, embedding) VALUES (%s, %s) ON CONFLICT (key) DO NOTHING",
+                items
+            )
+            conn.commit()
+            cur.close()
+
+
+class EmbeddingCache:
+    """
+    Content-hash-keyed embedding cache: a bounded in-memory LRU in front of an
+    optional persistent store. Keys include the model name and inference backend, so
+    changing config.EMBEDDING_MODEL_NAME, EMBEDDING_BACKEND or EMBEDDING_ONNX_FILE never
+    returns vectors from another model or weight file.
+    """
+
+    def __init__(self, maxsize, store=None):
+        self.memory = LRUCache(maxsize)
+        self.store = store
+        self._lock = threading.Lock()
+        self._stats = {"store_hits": 0, "store_errors": 0, "encoded": 0}
+
+    @staticmethod
+    def model_id():
+        """Model name, plus the ONNX file for the onnx backend (torch keys are unchanged)."""
+        if config.EMBEDDING_BACKEND == 'onnx':
+            return f"{config.EMBEDDING_MODEL_NAME}\0onnx\0{config.EMBEDDING_ONNX_FILE or 'onnx/model.onnx'}"
+        return config.EMBEDDING_MODEL_NAME
+
+    @classmethod
+    def key(cls, text, model_name=None):
+        model_name = model_name or cls.model_id()
+        return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def encode(self, texts):
+        """
+        Return a (len(texts), dim) float32 array, encoding only texts that are
+        neither in memory nor in the persistent store (in one model call).
+        """
+        keys = [self.key(text) for text in texts]
+        found = {}
+        for key in set(keys):
+            embedding = self.memory.get(key)
+            if embedding is not None:
+                found[key] = embedding
+
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        if missing and self.store is not None:
+            try:
+                stored = self.store.get_many(missing)
+            except Exception:
+                stored = {}
+                self._count("store_errors")
+            for key, blob in stored.items():
+                embedding = np.frombuffer(blob, dtype=np.float32)
+                self.memory.set(key, embedding)
+                found[key] = embedding
+            self._count("store_hits", len(stored))
+
+        to_encode = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                to_encode.setdefault(key, text)
+        if to_encode:
+            vectors = config.get_embedding_model().encode(list(to_encode.values()), convert_to_numpy=True)
+            vectors = np.asarray(vectors, dtype=np.float32)
+            new_items = []
+            for key, vector in zip(to_encode, vectors):
+                vector.setflags(write=False)
+                self.memory.set(key, vector)
+                found[key] = vector
+                new_items.append((key, vector.tobytes()))
+            self._count("encoded", len(new_items))
+            if self.store is not None:
+                try:
+                    self.store.put_many(new_items)
+                except Exception:
+                    self._count("store_errors")
+
+        return np.stack([found[key] for key in keys]) if keys else np.empty((0, config.EMBEDDING_DIM), dtype=np.float32)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["memory"] = self.memory.stats()
+        stats["store"] = type(self.store).__name__ if self.store is not None else None
+        return stats
+
+    def clear(self):
+        self.memory.clear()
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+
+class MicroBatcher:
+    """
+    Collects encode requests from concurrent callers and runs them as one model call.
+    A dedicated worker thread takes the first waiting request, keeps collecting for up
+    to `window` seconds or until `max_batch` texts are queued, encodes the batch
+    through encode_batch (the embedding cache) and resolves each caller's future with
+    its rows of the result.
+    """
+
+    def __init__(self, encode_batch, window, max_batch):
+        self.encode_batch = encode_batch
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+        self._stats = {"requests": 0, "texts": 0, "batches": 0, "max_batch_size": 0,
+                       "total_wait_ms": 0.0, "total_encode_ms": 0.0, "errors": 0, "cancelled": 0}
+
+    def submit(self, texts) -> Future:
+        """Queue texts for encoding; the future resolves to a (len(texts), dim) array."""
+        future = Future()
+        self._ensure_worker()
+        self._queue.put((list(texts), future, time.perf_counter()))
+        return future
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+
+    def _take(self, item) -> bool:
+        """
+        Claim a dequeued request; False if its caller already cancelled the future
+        (e.g. a discarded speculative retrieval), in which case it is skipped.
+        """
+        if item[1].set_running_or_notify_cancel():
+            return True
+        self._count(cancelled=1)
+        return False
+
+    def _collect(self):
+        item = self._queue.get()
+        while not self._take(item):
+            item = self._queue.get()
+        batch = [item]
+        size = len(item[0])
+        deadline = time.perf_counter() + self.window
+        while size < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if not self._take(item):
+                continue
+            batch.append(item)
+            size += len(item[0])
+        return batch, size
+
+    def _run(self):
+        # The worker must survive anything a single batch does, or every later caller hangs
+        while True:
+            batch = []
+            try:
+                batch, size = self._collect()
+                started = time.perf_counter()
+                texts = [text for item_texts, _, _ in batch for text in item_texts]
+                vectors = self.encode_batch(texts)
+                finished = time.perf_counter()
+                offset = 0
+                for item_texts, future, _ in batch:
+                    future.set_result(vectors[offset:offset + len(item_texts)])
+                    offset += len(item_texts)
+                self._count(
+                    requests=len(batch), texts=size, batches=1,
+                    total_wait_ms=sum((started - queued) * 1000 for _, _, queued in batch),
+                    total_encode_ms=(finished - started) * 1000,
+                    max_batch_size=size,
+                )
+            except Exception as e:
+                self._count(errors=1)
+                logger.error("Embedding batch failed: %s", e)
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _count(self, **amounts):
+        with self._lock:
+            for name, amount in amounts.items():
+                if name == "max_batch_size":
+                    self._stats[name] = max(self._stats[name], amount)
+                else:
+                    self._stats[name] += amount
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        batches = stats["batches"] or 1
+        stats["queue_depth"] = self._queue.qsize()
+        stats["avg_batch_size"] = stats["texts"] / batches
+        stats["avg_requests_per_batch"] = stats["requests"] / batches
+        stats["avg_wait_ms"] = stats["total_wait_ms"] / (stats["requests"] or 1)
+        stats["avg_encode_ms"] = stats["total_encode_ms"] / batches
+        return stats
+
+
+def _build_store():
+    if config.EMBEDDING_CACHE_BACKEND == "sqlite":
+        return SqliteEmbeddingStore(config.EMBEDDING_CACHE_PATH)
+    if config.EMBEDDING_CACHE_BACKEND == "postgres":
+        return PostgresEmbeddingStore(config.EMBEDDING_CACHE_TABLE)
+    return None
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Return the process-wide embedding cache, creating it on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache(config.EMBEDDING_CACHE_SIZE, _build_store())
+    return _cache
+
+
+_batcher = None
+
+
+def get_batcher():
+    """Return the process-wide micro-batcher, or None when config.EMBEDDING_BATCHING is off."""
+    global _batcher
+    if not config.EMBEDDING_BATCHING:
+        return None
+    with _cache_lock:
+        if _batcher is None:
+            _batcher = MicroBatcher(
+                lambda texts: get_cache().encode(texts),
+                config.EMBEDDING_BATCH_WINDOW,
+                config.EMBEDDING_BATCH_MAX_SIZE,
+            )
+    return _batcher
+
+
+def _submit(texts):
+    """Future for the encoding of texts, batched with concurrent callers when enabled."""
+    batcher = get_batcher()
+    if batcher is None or len(texts) >= config.EMBEDDING_BATCH_MAX_SIZE:
+        # Large requests (e.g. ingest batches) are already a full batch
+        future = Future()
+        future.set_result(get_cache().encode(texts))
+        return future
+    return batcher.submit(texts)
+
+
+def encode(text):
+    """
+    Encode a string (or list of strings) with the configured embedding model through the
+    embedding cache and the micro-batcher. Returns a numpy array (1-D for a string,
+    2-D for a list).
+    """
+    if isinstance(text, str):
+        return _submit([text]).result()[0]
+    return _submit(list(text)).result()
+
+def to_vector_literal(embedding) -> str:
+    """Format an embedding as a pgvector literal, e.g. [0.1,0.2,...]."""
+    return f'[{",".join(map(str, embedding))}]'
+
+def cosine_distance(a, b) -> float:
+    """1 - cosine similarity of two embeddings (pgvector's <=> distance)."""
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    denominator = float(np.linalg.norm(a) * np.linalg.norm(b))
+    return 1.0 - float(a @ b) / denominator if denominator else 1.0
+
+async def aencode(text):
+    """
+    Async version of encode(). With batching on, the request joins the micro-batcher
+    without occupying a thread while it waits; otherwise the model runs on the
+    embedding executor.
+    """
+    if get_batcher() is None:
+        return await run_in_executor(encode, text)
+    texts = [text] if isinstance(text, str) else list(text)
+    if len(texts) >= config.EMBEDDING_BATCH_MAX_SIZE:
+        vectors = await run_in_executor(get_cache().encode, texts)
+    else:
+        vectors = await asyncio.wrap_future(get_batcher().submit(texts))
+    return vectors[0] if isinstance(text, str) else vectors
+
+async def run_in_executor(func, *args):
+    """Run a CPU-bound function (e.g. one that encodes) on the embedding executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, func, *args)
+
+def is_model_loaded() -> bool:
+    return config._embedding_model is not None
+
+def warm_up():
+    """Load the model and run one encode so the first request does not pay for it."""
+    config.get_embedding_model().encode(["warm up"], convert_to_numpy=True)
+
+def start_warm_up():
+    """Warm the model up on the embedding executor without blocking the caller."""
+    return _executor.submit(warm_up)
+
+def batch_stats():
+    """Queue depth and batch size counters of the micro-batcher (None when disabled)."""
+    return _batcher.stats() if _batcher is not None else None
+
+def cache_stats():
+    """Hit/miss counters of the embedding cache, and whether the model is loaded yet."""
+    stats = get_cache().stats()
+    stats["model_loaded"] = is_model_loaded()
+    return stats
@@ -0,0 +1,176 @@
+import json
+import logging
+import threading
+import numpy as np
+import config
+import embeddings
+import metrics
+from llm_calls import acall_llm1
+
+# Local fast path for LLM #1: a kNN (or nearest-centroid) classifier over the
+# sentence-transformer embeddings of labelled example queries. When it is confident
+# about a label that needs nothing else from LLM #1 (general questions and
+# retrieve-only queries), it answers in the shape of LLM #1's output; anything else,
+# including every knowledge base change (which needs old_feature/new_feature
+# extraction), goes to LLM #1.
+
+logger = logging.getLogger("intent_router")
+
+# (intent, action) labels the router may answer on its own
+ROUTABLE_LABELS = {("general_purpose", None), ("general_purpose", "retrieve")}
+
+# Actions of knowledge base changes: a query close to one of these needs
+# config.INTENT_ROUTER_CHANGE_MIN_CONFIDENCE to be routed locally
+CHANGE_ACTIONS = {"add", "replace", "delete"}
+
+ROUTER_DECISIONS = metrics.Counter(
+    "intent_router_decisions_total", "Intent router outcomes (routed locally or sent to LLM #1).", ["outcome", "label"]
+)
+
+
+def load_exemplars(path=None):
+    """Read labelled queries ({"query", "intent", "action"} per JSONL line)."""
+    with open(path or config.INTENT_EXEMPLARS_FILE, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class IntentRouter:
+    """
+    Classify a query into an (intent, action) label with a confidence score.
+    method 'knn' weights the k most similar exemplars by cosine similarity;
+    'centroid' compares against the mean embedding of each label.
+    """
+
+    def __init__(self, exemplars, method=None, k=None, min_confidence=None, min_similarity=None,
+                 change_min_confidence=None):
+        self.method = method or config.INTENT_ROUTER_METHOD
+        self.k = k or config.INTENT_ROUTER_K
+        self.min_confidence = config.INTENT_ROUTER_MIN_CONFIDENCE if min_confidence is None else min_confidence
+        self.min_similarity = config.INTENT_ROUTER_MIN_SIMILARITY if min_similarity is None else min_similarity
+        self.change_min_confidence = (
+            config.INTENT_ROUTER_CHANGE_MIN_CONFIDENCE if change_min_confidence is None else change_min_confidence
+        )
+        self.labels = sorted({(e["intent"], e.get("action")) for e in exemplars}, key=str)
+        self._label_index = {label: index for index, label in enumerate(self.labels)}
+        self.exemplar_labels = np.asarray([self._label_index[(e["intent"], e.get("action"))] for e in exemplars])
+        self.vectors = _normalize(embeddings.encode([e["query"] for e in exemplars]))
+        self.centroids = self._centroids()
+
+    def _centroids(self, exclude=None):
+        keep = np.ones(len(self.vectors), dtype=bool)
+        if exclude is not None:
+            keep[exclude] = False
+        dim = self.vectors.shape[1]
+        return _normalize(np.stack([
+            self.vectors[keep & (self.exemplar_labels == index)].mean(axis=0)
+            if np.any(keep & (self.exemplar_labels == index)) else np.zeros(dim, dtype=np.float32)
+            for index in range(len(self.labels))
+        ]))
+
+    def classify(self, query: str, exclude=None):
+        """
+        Return (label, confidence, similarity): the best label, its share of the
+        neighbour votes (knn) or its relative margin over the runner-up centroid
+        (centroid), and the cosine similarity of the closest exemplar. exclude drops
+        one exemplar index (used for leave-one-out evaluation).
+        """
+        return self._classify(query, exclude)[:3]
+
+    def decide(self, query: str, exclude=None):
+        """
+        Return (label, confidence, similarity, routable), where routable says whether
+        route() would answer locally. When a change exemplar is among the k nearest
+        (knn) or is the runner-up centroid, change_min_confidence is required instead
+        of min_confidence.
+        """
+        label, confidence, similarity, change_nearby = self._classify(query, exclude)
+        min_confidence = max(self.min_confidence, self.change_min_confidence) if change_nearby else self.min_confidence
+        routable = label in ROUTABLE_LABELS and confidence >= min_confidence and similarity >= self.min_similarity
+        return label, confidence, similarity, routable
+
+    def _classify(self, query, exclude):
+        vector = _normalize(embeddings.encode(query))
+        similarities = self.vectors @ vector
+        labels = self.exemplar_labels
+        if exclude is not None:
+            keep = np.arange(len(similarities)) != exclude
+            similarities, labels = similarities[keep], labels[keep]
+        nearest = float(similarities.max()) if len(similarities) else 0.0
+
+        if self.method == "centroid":
+            centroids = self.centroids if exclude is None else self._centroids(exclude)
+            scores = centroids @ vector
+            order = np.argsort(-scores)
+            best = int(order[0])
+            runner_up = float(scores[order[1]]) if len(order) > 1 else 0.0
+            # Confidence: how far the best centroid is ahead of the next one, scaled to [0, 1]
+            confidence = float(np.clip((scores[best] - runner_up) / max(abs(float(scores[best])), 1e-6), 0.0, 1.0))
+            change_nearby = len(order) > 1 and self.labels[int(order[1])][1] in CHANGE_ACTIONS
+            return self.labels[best], confidence, nearest, change_nearby
+
+        top = np.argsort(-similarities)[:self.k]
+        votes = np.zeros(len(self.labels), dtype=np.float32)
+        for index in top:
+            votes[labels[index]] += max(float(similarities[index]), 0.0)
+        total = float(votes.sum())
+        best = int(votes.argmax())
+        change_nearby = any(self.labels[labels[index]][1] in CHANGE_ACTIONS for index in top)
+        return self.labels[best], (float(votes[best]) / total if total else 0.0), nearest, change_nearby
+
+    def route(self, query: str):
+        """
+        Return an LLM #1-shaped dict when the classifier is confident about a routable
+        label (see decide), otherwise None.
+        """
+        label, confidence, similarity, routable = self.decide(query)
+        if routable:
+            ROUTER_DECISIONS.inc(outcome="routed", label=f"{label[0]}/{label[1]}")
+            intent, action = label
+            return {
+                "intent": intent,
+                "action": action,
+                "old_feature": None,
+                "new_feature": None,
+                "refined_query": None,
+                "router_confidence": round(confidence, 4),
+            }
+        ROUTER_DECISIONS.inc(outcome="fallback", label=f"{label[0]}/{label[1]}")
+        return None
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    """Return the process-wide router, built from config.INTENT_EXEMPLARS_FILE on first use."""
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = IntentRouter(load_exemplars())
+    return _router
+
+
+async def aroute(user_query: str):
+    """Async route(); None when the router is disabled or not confident."""
+    if not config.INTENT_ROUTER_ENABLED:
+        return None
+    try:
+        return await embeddings.run_in_executor(lambda: get_router().route(user_query))
+    except Exception as e:
+        logger.error("Intent router failed, falling back to LLM #1: %s", e)
+        return None
+
+
+async def aresolve_intent(user_query: str) -> dict:
+    """LLM #1 output for user_query: from the local router when confident, else from acall_llm1."""
+    routed = await aroute(user_query)
+    if routed is not None:
+        return routed
+    return await acall_llm1(user_query)
@@ -0,0 +1,77 @@
+import argparse
+import time
+from collections import Counter
+import numpy as np
+import config
+import intent_router
+from llm_calls import call_llm1
+
+# Offline accuracy / coverage / latency report for the local intent router.
+# Without --eval, every exemplar is classified against the others (leave-one-out).
+# With --llm, LLM #1 is also called on each query to compare labels and latency.
+
+
+def label_of(record):
+    return (record["intent"], record.get("action"))
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Evaluate the local intent router.")
+    parser.add_argument("--exemplars", default=config.INTENT_EXEMPLARS_FILE, help="labelled exemplar JSONL file")
+    parser.add_argument("--eval", default=None, help="held-out labelled JSONL file (default: leave-one-out on exemplars)")
+    parser.add_argument("--method", choices=["knn", "centroid"], default=None)
+    parser.add_argument("--k", type=int, default=None)
+    parser.add_argument("--min-confidence", type=float, default=None)
+    parser.add_argument("--min-similarity", type=float, default=None)
+    parser.add_argument("--change-min-confidence", type=float, default=None)
+    parser.add_argument("--llm", action="store_true", help="also call LLM #1 for agreement and latency")
+    args = parser.parse_args()
+
+    exemplars = intent_router.load_exemplars(args.exemplars)
+    start = time.perf_counter()
+    router = intent_router.IntentRouter(exemplars, args.method, args.k, args.min_confidence, args.min_similarity,
+                                        args.change_min_confidence)
+    print(f"Router built from {len(exemplars)} exemplars in {time.perf_counter() - start:.2f}s "
+          f"(method={router.method}, k={router.k}, min_confidence={router.min_confidence}, "
+          f"min_similarity={router.min_similarity}, change_min_confidence={router.change_min_confidence})")
+
+    held_out = intent_router.load_exemplars(args.eval) if args.eval else exemplars
+    correct = routed = routed_correct = 0
+    latencies, llm_latencies = [], []
+    confusion = Counter()
+    llm_agree = 0
+    for index, record in enumerate(held_out):
+        start = time.perf_counter()
+        label, confidence, similarity, confident = router.decide(record["query"], exclude=None if args.eval else index)
+        latencies.append((time.perf_counter() - start) * 1000)
+        expected = label_of(record)
+        confusion[(expected, label)] += 1
+        correct += label == expected
+        if confident:
+            routed += 1
+            routed_correct += label == expected
+        if args.llm:
+            start = time.perf_counter()
+            try:
+                parsed = call_llm1(record["query"])
+                llm_agree += (parsed.get("intent"), parsed.get("action")) == expected
+            except Exception as e:
+                print(f"LLM #1 failed for {record['query']!r}: {e}")
+            llm_latencies.append((time.perf_counter() - start) * 1000)
+
+    total = len(held_out) or 1
+    print(f"accuracy (all labels): {correct / total:.3f}")
+    print(f"routed locally: {routed}/{len(held_out)} ({routed / total:.1%}), "
+          f"precision of routed: {routed_correct / (routed or 1):.3f}")
+    print(f"router latency: p50 {percentile(latencies, 50):.2f} ms, p95 {percentile(latencies, 95):.2f} ms")
+    if args.llm:
+        print(f"LLM #1 agreement with labels: {llm_agree / total:.3f}; "
+              f"latency p50 {percentile(llm_latencies, 50):.0f} ms, p95 {percentile(llm_latencies, 95):.0f} ms")
+    print("confusion (expected -> predicted: count):")
+    for (expected, predicted), count in sorted(confusion.items(), key=str):
+        marker = "" if expected == predicted else "  <-- error"
+        print(f"  {expected[0]}/{expected[1]} -> {predicted[0]}/{predicted[1]}: {count}{marker}")
@@ -1,89 +1,401 @@
 import openai
+import asyncio
+import hashlib
 import json
+import time
 import config
 import logging
+import metrics
+from structured_logging import PAYLOAD
+from cache import LRUCache
 
 logger = logging.getLogger("llm_calls")
 logger.setLevel(logging.DEBUG)
 
-def call_openai(messages, temperature=0.0, max_tokens=500):
+MODEL = "gpt-4-0613"
+
+# Response cache for the deterministic (temperature=0) calls LLM #1 and LLM #2.
+# Keys are (label, digest) so entries of one call can be invalidated on their own.
+_response_cache = LRUCache(config.LLM_CACHE_SIZE, ttl=config.LLM_CACHE_TTL)
+
+def _record_usage(call: str, started: float, resp=None, status: str = "ok") -> None:
+    """Record latency and token usage (resp.usage) of one OpenAI request in metrics."""
+    usage = resp.get("usage") if resp is not None else None
+    metrics.record_openai(
+        call, time.perf_counter() - started,
+        usage.get("prompt_tokens", 0) if usage else 0,
+        usage.get("completion_tokens", 0) if usage else 0,
+        status, config.LLM_PRICES.get(MODEL)
+    )
+
+def call_openai(messages, temperature=0.0, max_tokens=500, call="openai"):
     """
-    Generic function to call the OpenAI API.
+    Generic function to call the OpenAI API. call labels the request in metrics.
     """
     openai.api_key = config.OPENAI_API_KEY
-    resp = openai.ChatCompletion.create(
-        model="gpt-4-0613",
-        messages=messages,
-        temperature=temperature,
-        max_tokens=max_tokens
-    )
+    started = time.perf_counter()
+    try:
+        resp = openai.ChatCompletion.create(
+            model=MODEL,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens
+        )
+    except Exception:
+        _record_usage(call, started, status="error")
+        raise
+    _record_usage(call, started, resp)
     result = resp.choices[0].message.content.strip()
     return result
 
-def call_llm1(user_query: str) -> dict:
+async def acall_openai(messages, temperature=0.0, max_tokens=500, call="openai"):
     """
-    LLM #1: Determine intent, action, and optionally refine the query.
-    Returns a parsed JSON object.
+    Async version of call_openai; awaits the OpenAI API without blocking a thread.
     """
-    messages = [
+    openai.api_key = config.OPENAI_API_KEY
+    started = time.perf_counter()
+    try:
+        resp = await openai.ChatCompletion.acreate(
+            model=MODEL,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens
+        )
+    except asyncio.CancelledError:
+        _record_usage(call, started, status="cancelled")
+        raise
+    except Exception:
+        _record_usage(call, started, status="error")
+        raise
+    _record_usage(call, started, resp)
+    result = resp.choices[0].message.content.strip()
+    return result
+
+async def acall_openai_function(messages, function, temperature=0.0, max_tokens=500, call="openai") -> str:
+    """
+    Call the OpenAI API forcing a call to one function (a tools entry such as
+    config.db_operation_function) and return the raw JSON arguments it was called with.
+    """
+    openai.api_key = config.OPENAI_API_KEY
+    started = time.perf_counter()
+    try:
+        resp = await openai.ChatCompletion.acreate(
+            model=MODEL,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            tools=[function],
+            tool_choice={"type": "function", "function": {"name": function["function"]["name"]}}
+        )
+    except asyncio.CancelledError:
+        _record_usage(call, started, status="cancelled")
+        raise
+    except Exception:
+        _record_usage(call, started, status="error")
+        raise
+    _record_usage(call, started, resp)
+    return resp.choices[0].message.tool_calls[0].function.arguments
+
+async def astream_openai(messages, temperature=0.0, max_tokens=500, call="openai"):
+    """
+    Stream a chat completion from the OpenAI API, yielding content deltas as they arrive.
+    Streamed responses carry no usage, so tokens are estimated for metrics (one per
+    content chunk, prompt from estimate_tokens).
+    """
+    openai.api_key = config.OPENAI_API_KEY
+    started = time.perf_counter()
+    resp = await openai.ChatCompletion.acreate(
+        model=MODEL,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stream=True
+    )
+    chunks = 0
+    async for chunk in resp:
+        delta = chunk.choices[0].delta.get("content")
+        if delta:
+            chunks += 1
+            yield delta
+    prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+    metrics.record_openai(call, time.perf_counter() - started, prompt_tokens, chunks,
+                          prices=config.LLM_PRICES.get(MODEL))
+
+def _llm1_messages(user_query: str):
+    return [
         {"role": "system", "content": config.INTENT_PROMPT.strip()},
         {"role": "user", "content": user_query}
     ]
-    llm1_raw = call_openai(messages, temperature=0.0, max_tokens=500)
-    logger.debug("LLM #1 raw output: %s", llm1_raw)
+
+def _llm2_messages(user_input: dict):
+    return [
+        {"role": "system", "content": config.SECOND_LLM_PROMPT.strip()},
+        {"role": "user", "content": json.dumps(user_input)}
+    ]
+
+def _single_pass_messages(user_query: str, rows):
+    return [
+        {"role": "system", "content": config.SINGLE_PASS_PROMPT.strip()},
+        {"role": "user", "content": json.dumps({"query": user_query, "retrieved_context": rows}, default=str)}
+    ]
+
+def _llm3_messages(user_query: str, previous_messages, conversation_manager, additional_context: dict = None,
+                   summary: str = None):
+    previous_messages = conversation_manager.convert_langchain_messages_to_openai(previous_messages)
+    chat_history_str = "Chat History:\n" + "\n".join(
+        [f"{msg['role']}: {msg['content']}" for msg in previous_messages]
+    )
+    if summary:
+        chat_history_str = f"Summary of earlier conversation:\n{summary}\n\n{chat_history_str}"
+    chat_history_message = {"role": "system", "content": chat_history_str}
+    system_prompt = {"role": "system", "content": config.THIRD_LLM_PROMPT.strip()}
+
+    # Merge the current query with any additional context
+    payload = {"query": user_query}
+    if additional_context:
+        payload.update(additional_context)
+    final_user_message = {"role": "user", "content": json.dumps(payload)}
+
+    return [system_prompt, final_user_message, chat_history_message]
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (about config.CHARS_PER_TOKEN characters per token)."""
+    return len(text) // config.CHARS_PER_TOKEN + 1
+
+def select_history(records, summarized_until_id: int = 0, budget: int = None):
+    """
+    Keep the newest (message_id, message) records that fit the token budget and
+    are not already covered by the summary. Returns them oldest first.
+    """
+    budget = config.HISTORY_TOKEN_BUDGET if budget is None else budget
+    kept = []
+    used = 0
+    for message_id, message in reversed(records):
+        if message_id <= summarized_until_id:
+            break
+        tokens = estimate_tokens(message.content)
+        if kept and used + tokens > budget:
+            break
+        kept.append((message_id, message))
+        used += tokens
+    kept.reverse()
+    return kept
+
+# Sessions whose summary is being updated, and the tasks doing it (kept referenced
+# so they are not garbage collected before they finish).
+_summaries_in_progress = set()
+_background_tasks = set()
+
+async def aupdate_summary(conversation_manager, before_id: int) -> None:
+    """
+    Fold the unsummarized turns older than before_id into the session's rolling
+    summary (at most config.SUMMARY_BATCH_MESSAGES per call) and persist it.
+    """
+    summary, summarized_until_id = await conversation_manager.aget_summary()
+    records = await conversation_manager.aget_messages_between(
+        summarized_until_id, before_id, config.SUMMARY_BATCH_MESSAGES
+    )
+    if not records:
+        return
+    new_messages = conversation_manager.convert_langchain_messages_to_openai([message for _, message in records])
+    messages = [
+        {"role": "system", "content": config.SUMMARY_PROMPT.strip()},
+        {"role": "user", "content": json.dumps({"summary": summary, "new_messages": new_messages})}
+    ]
+    new_summary = await acall_openai(messages, temperature=0.0, max_tokens=config.SUMMARY_MAX_TOKENS, call="summary")
+    await conversation_manager.asave_summary(new_summary, records[-1][0])
+    logger.debug("Summary for session %s updated through message %s", conversation_manager.session_id, records[-1][0])
+
+def schedule_summary_update(conversation_manager, before_id: int) -> None:
+    """Run aupdate_summary in the background, at most once at a time per session."""
+    session_id = conversation_manager.session_id
+    if session_id in _summaries_in_progress:
+        return
+    _summaries_in_progress.add(session_id)
+
+    async def run():
+        try:
+            await aupdate_summary(conversation_manager, before_id)
+        except Exception as e:
+            logger.error("Summary update for session %s failed: %s", session_id, e)
+        finally:
+            _summaries_in_progress.discard(session_id)
+
+    task = asyncio.create_task(run())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+def _normalize_query(text: str) -> str:
+    """Collapse whitespace and case so trivially different phrasings share a cache entry."""
+    return " ".join(text.split()).casefold()
+
+def _cache_key(label: str, messages, temperature, max_tokens, user_payload: str):
+    system_hash = hashlib.sha256(messages[0]["content"].encode("utf-8")).hexdigest()
+    digest = hashlib.sha256(
+        json.dumps([MODEL, system_hash, temperature, max_tokens, user_payload]).encode("utf-8")
+    ).hexdigest()
+    return (label, digest)
+
+def _cached_json(key, label: str):
+    """Return the parsed cached response for key, or None on a miss."""
+    if not config.LLM_CACHE_ENABLED:
+        return None
+    raw = _response_cache.get(key)
+    if raw is None:
+        return None
+    logger.debug("%s cache hit", label)
+    return json.loads(raw)
+
+def _store_json(key, raw: str, parsed: dict) -> dict:
+    """Cache a response only once it parsed as valid JSON."""
+    if config.LLM_CACHE_ENABLED:
+        _response_cache.set(key, raw)
+    return parsed
+
+def invalidate_knowledge_base_cache(*_args) -> int:
+    """
+    Drop cached LLM #2 and single-pass responses, whose output depends on knowledge
+    base content.
+    Registered as a db_command mutation listener. Returns the number of entries removed.
+    """
+    removed = _response_cache.discard_where(lambda key: key[0] in ("llm2", "single_pass"))
+    logger.debug("Invalidated %d cached LLM #2 / single-pass responses", removed)
+    return removed
+
+def cache_stats() -> dict:
+    """Hit/miss counters of the LLM response cache."""
+    return _response_cache.stats()
+
+def _parse_json(raw: str, label: str) -> dict:
     try:
-        parsed = json.loads(llm1_raw)
+        return json.loads(raw)
     except Exception as e:
-        raise Exception(f"LLM #1 invalid JSON: {e}")
-    return parsed
+        raise Exception(f"{label} invalid JSON: {e}")
+
+def call_llm1(user_query: str) -> dict:
+    """
+    LLM #1: Determine intent, action, and optionally refine the query.
+    Returns a parsed JSON object.
+    """
+    messages = _llm1_messages(user_query)
+    key = _cache_key("llm1", messages, 0.0, 500, _normalize_query(user_query))
+    cached = _cached_json(key, "LLM #1")
+    if cached is not None:
+        return cached
+    llm1_raw = call_openai(messages, temperature=0.0, max_tokens=500, call="llm1")
+    logger.debug("LLM #1 raw output: %s", llm1_raw, extra=PAYLOAD)
+    return _store_json(key, llm1_raw, _parse_json(llm1_raw, "LLM #1"))
+
+async def acall_llm1(user_query: str) -> dict:
+    """Async version of call_llm1."""
+    messages = _llm1_messages(user_query)
+    key = _cache_key("llm1", messages, 0.0, 500, _normalize_query(user_query))
+    cached = _cached_json(key, "LLM #1")
+    if cached is not None:
+        return cached
+    llm1_raw = await acall_openai(messages, temperature=0.0, max_tokens=500, call="llm1")
+    logger.debug("LLM #1 raw output: %s", llm1_raw, extra=PAYLOAD)
+    return _store_json(key, llm1_raw, _parse_json(llm1_raw, "LLM #1"))
 
 def call_llm2(user_input: dict) -> dict:
     """
     LLM #2: Process the intent, action, and retrieved context.
     Returns a parsed JSON object.
     """
-    messages = [
-        {"role": "system", "content": config.SECOND_LLM_PROMPT.strip()},
-        {"role": "user", "content": json.dumps(user_input)}
-    ]
-    llm2_raw = call_openai(messages, temperature=0.0, max_tokens=1500)
-    logger.debug("LLM #2 raw output: %s", llm2_raw)
-    try:
-        parsed = json.loads(llm2_raw)
-    except Exception as e:
-        raise Exception(f"LLM #2 invalid JSON: {e}")
-    return parsed
+    messages = _llm2_messages(user_input)
+    key = _cache_key("llm2", messages, 0.0, 1500, messages[1]["content"])
+    cached = _cached_json(key, "LLM #2")
+    if cached is not None:
+        return cached
+    llm2_raw = call_openai(messages, temperature=0.0, max_tokens=1500, call="llm2")
+    logger.debug("LLM #2 raw output: %s", llm2_raw, extra=PAYLOAD)
+    return _store_json(key, llm2_raw, _parse_json(llm2_raw, "LLM #2"))
+
+async def acall_llm2(user_input: dict) -> dict:
+    """Async version of call_llm2."""
+    messages = _llm2_messages(user_input)
+    key = _cache_key("llm2", messages, 0.0, 1500, messages[1]["content"])
+    cached = _cached_json(key, "LLM #2")
+    if cached is not None:
+        return cached
+    llm2_raw = await acall_openai(messages, temperature=0.0, max_tokens=1500, call="llm2")
+    logger.debug("LLM #2 raw output: %s", llm2_raw, extra=PAYLOAD)
+    return _store_json(key, llm2_raw, _parse_json(llm2_raw, "LLM #2"))
+
+async def acall_single_pass(user_query: str, rows) -> dict:
+    """
+    Single-pass mode: one function-calling request that returns intent, action,
+    old_feature, new_feature, row_ids, new_content and call_to_db for a query and
+    its retrieved rows (replaces LLM #1 + LLM #2).
+    """
+    messages = _single_pass_messages(user_query, rows)
+    key = _cache_key("single_pass", messages, 0.0, 1500, messages[1]["content"])
+    cached = _cached_json(key, "Single-pass LLM")
+    if cached is not None:
+        return cached
+    raw = await acall_openai_function(messages, config.db_operation_function, temperature=0.0, max_tokens=1500,
+                                      call="single_pass")
+    logger.debug("Single-pass LLM raw output: %s", raw, extra=PAYLOAD)
+    return _store_json(key, raw, _parse_json(raw, "Single-pass LLM"))
 
 def call_llm3(user_query: str, conversation_manager, additional_context: dict = None) -> str:
     """
     LLM #3: Generate the final response by including conversation history.
+    Only the last config.HISTORY_WINDOW_MESSAGES messages are read, trimmed to
+    config.HISTORY_TOKEN_BUDGET, and preceded by the session's rolling summary.
     This function expects the conversation_manager to provide access to the chat history.
-    
+
     Parameters:
         user_query: The current user query.
         conversation_manager: An instance of ConversationManager.
         additional_context: A dictionary containing additional details from previous pipeline steps.
-        
+
     Returns:
         The raw output from LLM #3.
     """
-    previous_messages = conversation_manager.get_conversation_history()
-    previous_messages = conversation_manager.convert_langchain_messages_to_openai(previous_messages)
-    chat_history_str = "Chat History:\n" + "\n".join(
-        [f"{msg['role']}: {msg['content']}" for msg in previous_messages]
+    records = conversation_manager.get_recent_messages(config.HISTORY_WINDOW_MESSAGES)
+    summary, summarized_until_id = conversation_manager.get_summary()
+    kept = select_history(records, summarized_until_id)
+    messages_for_llm3 = _llm3_messages(
+        user_query, [message for _, message in kept], conversation_manager, additional_context, summary
     )
-    chat_history_message = {"role": "system", "content": chat_history_str}
-    system_prompt = {"role": "system", "content": config.THIRD_LLM_PROMPT.strip()}
-    
-    # Merge the current query with any additional context
-    payload = {"query": user_query}
-    if additional_context:
-        payload.update(additional_context)
-    final_user_message = {"role": "user", "content": json.dumps(payload)}
-    
-    messages_for_llm3 = [system_prompt, final_user_message, chat_history_message]
-    logger.debug("LLM #3 input: %s", messages_for_llm3)
-    
-    llm3_raw = call_openai(messages_for_llm3, temperature=0.8, max_tokens=200)
-    logger.debug("LLM #3 raw output: %s", llm3_raw)
+    logger.debug("LLM #3 input: %s", messages_for_llm3, extra=PAYLOAD)
+
+    llm3_raw = call_openai(messages_for_llm3, temperature=0.8, max_tokens=200, call="llm3")
+    logger.debug("LLM #3 raw output: %s", llm3_raw, extra=PAYLOAD)
+    return llm3_raw
+
+async def _aprepare_llm3(user_query: str, conversation_manager, additional_context: dict = None):
+    """Build the LLM #3 messages from the history window; returns (messages, records, kept)."""
+    records = await conversation_manager.aget_recent_messages(config.HISTORY_WINDOW_MESSAGES)
+    summary, summarized_until_id = await conversation_manager.aget_summary()
+    kept = select_history(records, summarized_until_id)
+    messages_for_llm3 = _llm3_messages(
+        user_query, [message for _, message in kept], conversation_manager, additional_context, summary
+    )
+    logger.debug("LLM #3 input: %s", messages_for_llm3, extra=PAYLOAD)
+    return messages_for_llm3, records, kept
+
+def _fold_old_history(conversation_manager, records, kept) -> None:
+    if (kept and len(kept) < len(records)) or len(records) >= config.HISTORY_WINDOW_MESSAGES:
+        # Older turns are no longer sent verbatim: summarize everything before the oldest kept message
+        schedule_summary_update(conversation_manager, kept[0][0] if kept else records[-1][0] + 1)
+
+async def acall_llm3(user_query: str, conversation_manager, additional_context: dict = None) -> str:
+    """
+    Async version of call_llm3; reads the chat history through the async pool.
+    Turns that do not fit the history window are folded into the session summary
+    in the background, so they never add latency to this call.
+    """
+    messages_for_llm3, records, kept = await _aprepare_llm3(user_query, conversation_manager, additional_context)
+    llm3_raw = await acall_openai(messages_for_llm3, temperature=0.8, max_tokens=200, call="llm3")
+    logger.debug("LLM #3 raw output: %s", llm3_raw, extra=PAYLOAD)
+    _fold_old_history(conversation_manager, records, kept)
     return llm3_raw
+
+async def astream_llm3(user_query: str, conversation_manager, additional_context: dict = None):
+    """Streaming version of acall_llm3: yields the response text as tokens arrive."""
+    messages_for_llm3, records, kept = await _aprepare_llm3(user_query, conversation_manager, additional_context)
+    async for token in astream_openai(messages_for_llm3, temperature=0.8, max_tokens=200, call="llm3"):
+        yield token
+    _fold_old_history(conversation_manager, records, kept)
@@ -0,0 +1,198 @@
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# In-process metrics rendered in the Prometheus text exposition format at /metrics.
+# Counters and histograms are updated by the pipeline; collectors registered with
+# add_collector() report point-in-time values (cache and pool statistics) on scrape.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []
+_collectors = []
+
+# Per-request {stage: seconds} breakdown, set by start_request(). Tasks and threads
+# started by the request share the same dict, since they copy the context.
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=None) -> str:
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter with optional labels."""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values = {}   # key -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            state = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, list(state)) for key, state in self._values.items())
+        for key, state in items:
+            for bound, count in zip(self.buckets, state):
+                le = "+Inf" if bound == math.inf else repr(float(bound))
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', le)])} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(state[-2])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {state[-1]}")
+        return lines
+
+
+def gauge_lines(name, documentation, samples):
+    """Render a gauge from [(labels dict, value), ...]; used by collectors."""
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} gauge"]
+    for labels, value in samples:
+        if value is None:
+            continue
+        lines.append(f"{name}{_labels(list(labels), list(labels.values()))} {_number(value)}")
+    return lines
+
+
+def stats_lines(prefix, samples):
+    """
+    Render the numeric fields of stats dicts as gauges named <prefix>_<field>, from
+    [(labels dict, stats dict), ...] (e.g. one entry per connection pool).
+    """
+    names = []
+    for _, stats in samples:
+        for field, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and field not in names:
+                names.append(field)
+    lines = []
+    for field in names:
+        lines.extend(gauge_lines(
+            f"{prefix}_{field}", f"{prefix} {field.replace('_', ' ')}.",
+            [(labels, stats.get(field)) for labels, stats in samples]
+        ))
+    return lines
+
+
+def add_collector(collect) -> None:
+    """Register collect() -> list of exposition lines, called on every scrape."""
+    _collectors.append(collect)
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        try:
+            lines.extend(collect())
+        except Exception as e:
+            lines.append(f"# collector {getattr(collect, '__name__', collect)} failed: {_escape(e)}")
+    return "\n".join(lines) + "\n"
+
+
+# Pipeline and OpenAI metrics
+
+STAGE_SECONDS = Histogram(
+    "pipeline_stage_seconds", "Time spent in each /query pipeline stage.", ["stage"]
+)
+OPENAI_REQUESTS = Counter(
+    "openai_requests_total", "OpenAI chat completion requests.", ["call", "status"]
+)
+OPENAI_SECONDS = Histogram(
+    "openai_request_seconds", "Latency of OpenAI chat completion requests.", ["call"]
+)
+OPENAI_TOKENS = Counter(
+    "openai_tokens_total", "Tokens reported by OpenAI usage (estimated for streamed responses).", ["call", "kind"]
+)
+OPENAI_COST = Counter(
+    "openai_cost_dollars_total", "Estimated OpenAI cost from token usage and configured prices.", ["call"]
+)
+
+
+def start_request() -> dict:
+    """Start collecting a per-request stage breakdown; returns the dict being filled."""
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+
+def record_stage(stage: str, seconds: float) -> None:
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = round(timings.get(stage, 0.0) + seconds, 6)
+
+
+@contextmanager
+def timed(stage: str):
+    """Time the enclosed block as a pipeline stage (works around awaits as well)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def record_openai(call: str, seconds: float, prompt_tokens: int, completion_tokens: int,
+                  status: str = "ok", prices=None) -> None:
+    """Record one OpenAI request; prices is (dollars per 1K prompt, per 1K completion tokens)."""
+    OPENAI_REQUESTS.inc(call=call, status=status)
+    OPENAI_SECONDS.observe(seconds, call=call)
+    if status != "ok":
+        return
+    OPENAI_TOKENS.inc(prompt_tokens, call=call, kind="prompt")
+    OPENAI_TOKENS.inc(completion_tokens, call=call, kind="completion")
+    if prices:
+        OPENAI_COST.inc((prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1000, call=call)
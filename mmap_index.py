@@ -0,0 +1,440 @@
+import argparse
+import fcntl
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+import numpy as np
+import config
+import db_pool
+
+# In-process retrieval backend: the embeddings of the documents table are exported
+# to .npy files that every worker memory-maps (the OS page cache holds one copy),
+# and nearest neighbours are found with a NumPy matrix-vector product.
+#
+# Files in config.MMAP_INDEX_DIR, one set per export generation:
+#   vectors-<gen>.npy  (rows, dim) float32/float16 matrix
+#   norms-<gen>.npy    squared L2 norm of each row (float32)
+#   ids-<gen>.npy      row ids (int64)
+#   docs-<gen>.json    [content, url] per row
+#   manifest.json      current generation, written last so readers never see a partial export
+#   export.lock        flock held by the process exporting, so exports never interleave
+
+MANIFEST = "manifest.json"
+EXPORT_LOCK = "export.lock"
+EXPORT_FETCH_SIZE = 1000
+
+logger = logging.getLogger("mmap_index")
+
+
+def _path(directory, name, generation, ext="npy"):
+    return os.path.join(directory, f"{name}-{generation}.{ext}")
+
+
+def _read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _publish_file(path, write):
+    """Call write(temporary path) and move the result to path, so it appears complete or not at all."""
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _remove_generations_before(directory, generation):
+    for name in ("vectors", "norms", "ids", "docs"):
+        for stale in glob.glob(os.path.join(directory, f"{name}-*.*")):
+            stem = os.path.basename(stale)[len(name) + 1:].split(".", 1)[0]
+            if stem.isdigit() and int(stem) < generation:
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+
+
+def _fetch_rows(cur, row_ids=None):
+    """Yield (id, content, url, embedding list) for rows with an embedding."""
+    sql = f"SELECT id, content, url, embedding::real[] FROM {config.TABLE_NAME} WHERE embedding IS NOT NULL"
+    if row_ids is not None:
+        cur.execute(sql + " AND id = ANY(%s)", (list(row_ids),))
+    else:
+        cur.execute(sql + " ORDER BY id")
+    while True:
+        rows = cur.fetchmany(EXPORT_FETCH_SIZE)
+        if not rows:
+            break
+        yield from rows
+
+
+def export_index(directory=None, dtype=None):
+    """
+    Export all embeddings of config.TABLE_NAME to a new generation of memory-mappable
+    files and publish it through the manifest. Exports from different processes are
+    serialized with a lock file, and generations older than the previous one are
+    removed (workers that still map the previous one keep a valid view until they
+    reload; on POSIX, even removed files stay readable while mapped).
+    Returns the manifest.
+    """
+    directory = directory or config.MMAP_INDEX_DIR
+    dtype = np.dtype(dtype or config.MMAP_INDEX_DTYPE)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, EXPORT_LOCK), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            return _export_locked(directory, dtype)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _export_locked(directory, dtype):
+    """export_index body; the caller holds the export lock."""
+    ids, docs, chunks, chunk = [], [], [], []
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        try:
+            for row_id, content, url, embedding in _fetch_rows(cur):
+                ids.append(row_id)
+                docs.append([content, url])
+                chunk.append(embedding)
+                if len(chunk) >= EXPORT_FETCH_SIZE:
+                    chunks.append(np.asarray(chunk, dtype=np.float32))
+                    chunk = []
+        finally:
+            cur.close()
+    if chunk:
+        chunks.append(np.asarray(chunk, dtype=np.float32))
+    vectors = np.concatenate(chunks) if chunks else np.empty((0, config.EMBEDDING_DIM), dtype=np.float32)
+
+    previous = _read_manifest(directory)
+    generation = (previous["generation"] + 1) if previous else 1
+
+    def write_matrix(path):
+        matrix = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=vectors.shape)
+        matrix[:] = vectors
+        matrix.flush()
+        del matrix
+
+    def write_docs(path):
+        with open(path, "w") as f:
+            json.dump(docs, f)
+
+    def save(array):
+        def write(path):
+            with open(path, "wb") as f:
+                np.save(f, array)
+        return write
+
+    _publish_file(_path(directory, "vectors", generation), write_matrix)
+    # Norms of the stored (possibly float16) vectors, so scores match what is searched
+    stored = vectors.astype(dtype).astype(np.float32)
+    _publish_file(_path(directory, "norms", generation), save(np.einsum("ij,ij->i", stored, stored)))
+    _publish_file(_path(directory, "ids", generation), save(np.asarray(ids, dtype=np.int64)))
+    _publish_file(_path(directory, "docs", generation, "json"), write_docs)
+
+    manifest = {
+        "generation": generation,
+        "rows": len(ids),
+        "dim": int(vectors.shape[1]),
+        "dtype": dtype.name,
+        "table": config.TABLE_NAME,
+        "exported_at": time.time(),
+    }
+
+    def write_manifest(path):
+        with open(path, "w") as f:
+            json.dump(manifest, f)
+
+    _publish_file(os.path.join(directory, MANIFEST), write_manifest)
+    _remove_generations_before(directory, generation - 1)
+    return manifest
+
+
+def _scores(matrix, norms, query, query_norm, distance):
+    """Distance of every row to query (smaller is closer), matching pgvector's operators."""
+    dots = matrix @ query
+    if distance == "l2":
+        return np.sqrt(np.maximum(norms - 2.0 * dots + query_norm, 0.0))
+    if distance == "cosine":
+        return 1.0 - dots / np.maximum(np.sqrt(norms) * np.sqrt(query_norm), 1e-12)
+    if distance == "ip":
+        return -dots
+    raise ValueError(f"Unknown distance '{distance}'")
+
+
+def _top_k(scores, k):
+    if k >= len(scores):
+        return np.argsort(scores, kind="stable")
+    candidates = np.argpartition(scores, k)[:k]
+    return candidates[np.argsort(scores[candidates], kind="stable")]
+
+
+class MmapVectorIndex:
+    """
+    Memory-mapped snapshot of the documents table plus an in-memory overlay of rows
+    added, replaced or deleted since the snapshot. Search covers both. /db mutations
+    in this process are applied to the overlay by a background thread (so the request
+    making the change never waits for it) as soon as they commit; after
+    config.MMAP_INDEX_COMPACT_AFTER overlay changes that thread re-exports the
+    snapshot, which other workers pick up on their next search.
+    """
+
+    def __init__(self, directory=None, distance=None):
+        self.directory = directory or config.MMAP_INDEX_DIR
+        self.distance = distance or config.VECTOR_DISTANCE
+        self._lock = threading.Lock()
+        self._generation = None
+        self._matrix = None
+        self._norms = None
+        self._ids = None
+        self._docs = None
+        self._positions = {}
+        self._overlay = {}      # id -> (vector, norm, content, url)
+        self._removed = set()   # snapshot ids hidden by a delete or replace
+        self._pending = 0
+        self._version = 0       # bumped whenever search results may change
+        self._manifest_mtime = None
+        self._updates = queue.Queue()
+        self._worker = None
+        self._stats = {"searches": 0, "reloads": 0, "exports": 0, "overlay_updates": 0, "update_errors": 0}
+
+    def load(self, export_if_missing=True):
+        """Map the current generation, exporting one first if none exists."""
+        mtime = self._manifest_mtime_ns()
+        manifest = _read_manifest(self.directory)
+        if manifest is None:
+            if not export_if_missing:
+                raise FileNotFoundError(f"No vector index in {self.directory}")
+            manifest = self._export()
+            mtime = self._manifest_mtime_ns()
+        self._map(manifest, mtime)
+        return self
+
+    def _manifest_mtime_ns(self):
+        try:
+            return os.stat(os.path.join(self.directory, MANIFEST)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _map(self, manifest, mtime=None):
+        generation = manifest["generation"]
+        matrix = np.load(_path(self.directory, "vectors", generation), mmap_mode="r")
+        norms = np.load(_path(self.directory, "norms", generation))
+        ids = np.load(_path(self.directory, "ids", generation))
+        with open(_path(self.directory, "docs", generation, "json")) as f:
+            docs = json.load(f)
+        with self._lock:
+            self._generation = generation
+            self._matrix, self._norms, self._ids, self._docs = matrix, norms, ids, docs
+            self._positions = {int(row_id): position for position, row_id in enumerate(ids)}
+            # A fresh export contains every change made so far
+            self._overlay.clear()
+            self._removed.clear()
+            self._pending = 0
+            self._version += 1
+            self._manifest_mtime = mtime
+            self._stats["reloads"] += 1
+
+    def _export(self):
+        manifest = export_index(self.directory)
+        with self._lock:
+            self._stats["exports"] += 1
+        return manifest
+
+    @property
+    def version(self):
+        """Changes whenever the overlay or the mapped generation changes."""
+        return self._version
+
+    def refresh(self):
+        """
+        Reload if another process published a newer generation. The manifest is only
+        re-read when its modification time changes.
+        """
+        mtime = self._manifest_mtime_ns()
+        if mtime is None or mtime == self._manifest_mtime:
+            return
+        manifest = _read_manifest(self.directory)
+        if manifest is None:
+            return
+        if manifest["generation"] != self._generation:
+            self._map(manifest, mtime)
+        else:
+            self._manifest_mtime = mtime
+
+    def apply_mutation(self, action, row_ids):
+        """
+        Mutation listener (see db_command.add_mutation_listener): queue the change for
+        the background updater, which runs after the mutating request has released its
+        connection.
+        """
+        if not row_ids or self._matrix is None:
+            return
+        self._ensure_worker()
+        self._updates.put((action, list(row_ids)))
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run_updates, name="mmap-index-updater", daemon=True)
+                self._worker.start()
+
+    def apply_remote_mutation(self, action, row_ids):
+        """
+        retrieval_cache remote listener: apply a change committed by another worker. When
+        its rows are unknown (row_ids None), the index is resynchronised instead: ingest
+        runs export before they notify, so their generation is just mapped; otherwise a
+        newer generation is mapped if one was published meanwhile, else one is exported.
+        """
+        if self._matrix is None:
+            return
+        if row_ids is not None:
+            self.apply_mutation(action, row_ids)
+            return
+        if action in ("ingest", "sync"):
+            self.refresh()
+            return
+        self._ensure_worker()
+        self._updates.put(("resync", self._generation))
+
+    def _resync(self, generation):
+        manifest = _read_manifest(self.directory)
+        if manifest is None or manifest["generation"] == generation:
+            manifest = self._export()
+        self._map(manifest, self._manifest_mtime_ns())
+
+    def _run_updates(self):
+        while True:
+            action, row_ids = self._updates.get()
+            try:
+                if action == "resync":
+                    self._resync(row_ids)
+                else:
+                    self._apply(action, row_ids)
+            except Exception as e:
+                with self._lock:
+                    self._stats["update_errors"] += 1
+                logger.error("Applying %s of rows %s to the vector index failed: %s", action, row_ids, e)
+
+    def _apply(self, action, row_ids):
+        """Re-read added or replaced rows into the overlay, hide deleted ones, compact if due."""
+        fetched = {}
+        if action in ("add", "replace"):
+            with db_pool.connection() as conn:
+                cur = conn.cursor()
+                try:
+                    for row_id, content, url, embedding in _fetch_rows(cur, row_ids):
+                        vector = np.asarray(embedding, dtype=np.float32)
+                        fetched[row_id] = (vector, float(vector @ vector), content, url)
+                finally:
+                    cur.close()
+        with self._lock:
+            for row_id in row_ids:
+                if row_id in self._positions:
+                    self._removed.add(row_id)
+                self._overlay.pop(row_id, None)
+                if row_id in fetched:
+                    self._overlay[row_id] = fetched[row_id]
+            self._pending += len(row_ids)
+            self._version += 1
+            self._stats["overlay_updates"] += len(row_ids)
+            compact = self._pending >= config.MMAP_INDEX_COMPACT_AFTER
+        if compact:
+            manifest = self._export()
+            self._map(manifest, self._manifest_mtime_ns())
+
+    def search(self, embedding, top_n=3):
+        """Return the top_n closest rows as {id, content, url} dicts, closest first."""
+        self.refresh()
+        query = np.asarray(embedding, dtype=np.float32)
+        query_norm = float(query @ query)
+        with self._lock:
+            matrix, norms, ids, docs = self._matrix, self._norms, self._ids, self._docs
+            overlay = list(self._overlay.items())
+            removed = [self._positions[row_id] for row_id in self._removed]
+            self._stats["searches"] += 1
+
+        # float16 snapshots are upcast by the product; scores are always float32
+        scores = _scores(matrix, norms, query, query_norm, self.distance).astype(np.float32)
+        if removed:
+            scores[removed] = np.inf
+        candidates = [(float(scores[p]), int(ids[p]), docs[p][0], docs[p][1])
+                      for p in _top_k(scores, top_n) if np.isfinite(scores[p])]
+        if overlay:
+            vectors = np.stack([item[0] for _, item in overlay])
+            overlay_norms = np.asarray([item[1] for _, item in overlay], dtype=np.float32)
+            overlay_scores = _scores(vectors, overlay_norms, query, query_norm, self.distance)
+            for (row_id, (_, _, content, url)), score in zip(overlay, overlay_scores):
+                candidates.append((float(score), row_id, content, url))
+            candidates.sort(key=lambda candidate: candidate[0])
+        return [{"id": row_id, "content": content, "url": url}
+                for _, row_id, content, url in candidates[:top_n]]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "generation": self._generation,
+                "rows": 0 if self._ids is None else len(self._ids),
+                "dtype": None if self._matrix is None else self._matrix.dtype.name,
+                "overlay_rows": len(self._overlay),
+                "removed_rows": len(self._removed),
+                "queued_updates": self._updates.qsize(),
+            })
+        return stats
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """Return the process-wide index, mapping (and if needed exporting) it on first use."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = MmapVectorIndex().load()
+    return _index
+
+
+def on_mutation(action, row_ids):
+    """db_command mutation listener that keeps the loaded index current."""
+    if _index is not None:
+        _index.apply_mutation(action, row_ids)
+
+
+def on_remote_mutation(action, row_ids):
+    """retrieval_cache remote listener: apply changes made by other workers."""
+    if _index is not None:
+        _index.apply_remote_mutation(action, row_ids)
+
+
+def index_version():
+    """Version of the loaded index (None before first use), without touching the files."""
+    return _index.version if _index is not None else None
+
+
+def index_stats():
+    return _index.stats() if _index is not None else None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the documents table to the memory-mapped vector index.")
+    parser.add_argument("--dir", default=None, help="index directory (default config.MMAP_INDEX_DIR)")
+    parser.add_argument("--dtype", choices=["float32", "float16"], default=None,
+                        help="stored precision (default config.MMAP_INDEX_DTYPE)")
+    args = parser.parse_args()
+    print(export_index(args.dir, args.dtype))
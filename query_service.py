@@ -1,38 +1,119 @@
+import asyncio
 import json
-import requests
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+import time
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, conint
 from typing import Optional, List, Any
 import logging
-import uuid
 
 import config
-from retrieval import get_relevant_context
+from retrieval import aget_relevant_context, aget_relevant_context_batch
+import db_command
 from db_command import router as db_command_router
-from conversation_hist import ConversationManager  
-from llm_calls import call_llm1, call_llm2, call_llm3
-
-session_id = str(uuid.uuid4())
+from conversation_hist import ConversationManagerPool
+import db_pool
+import embeddings
+import llm_calls
+import metrics
+import structured_logging
+from structured_logging import PAYLOAD
+import intent_router
+import mmap_index
+import retrieval_cache
+import context_packing
+from llm_calls import acall_llm2, acall_llm3, astream_llm3
 
 logger = logging.getLogger("query_service")
-logger.setLevel(logging.DEBUG)
-ch = logging.StreamHandler()
-fh = logging.FileHandler("logs/query_service.log")
-logger.addHandler(ch)
-logger.addHandler(fh)
+# Queue-based JSON logging (records are written by a listener thread, not the request)
+structured_logging.setup_logging(["query_service", "llm_calls", "intent_router", "db_command", "retrieval_cache",
+                                  "context_packing", "embeddings"])
 
 app = FastAPI(title="Dune helper Pipeline")
 app.include_router(db_command_router, prefix="/db")
+# Knowledge base mutations make cached LLM #2 answers stale
+db_command.add_mutation_listener(llm_calls.invalidate_knowledge_base_cache)
+# ...and must be applied to the in-process vector index when it serves retrieval
+if config.RETRIEVAL_BACKEND == "mmap":
+    db_command.add_mutation_listener(mmap_index.on_mutation)
+    # ...including changes made by other workers (see retrieval_cache NOTIFY payloads)
+    retrieval_cache.add_remote_listener(mmap_index.on_remote_mutation)
+# Cached retrieval results are versioned; other workers hear about changes via NOTIFY
+db_command.add_precommit_hook(retrieval_cache.before_commit)
+db_command.add_mutation_listener(retrieval_cache.on_mutation)
+retrieval_cache.add_remote_listener(llm_calls.invalidate_knowledge_base_cache)
 
-# Instantiate your ConversationManager once
-CONNECTION_STRING = f"postgresql://{config.DB_USER}:{config.DB_PASSWORD}@{config.DB_HOST}:{config.DB_PORT}/{config.DB_NAME}"
-conversation_manager = ConversationManager(
-    connection_string=CONNECTION_STRING,
+# One ConversationManager per client session, created on demand
+conversation_managers = ConversationManagerPool(
     table_name="conversation_history",
-    session_id=str(uuid.uuid4()),
     logger=logger
 )
 
+@app.middleware("http")
+async def request_id_middleware(request: Request, call_next):
+    """Tag every log record of a request with its id (from X-Request-ID or a new one)."""
+    request_id = structured_logging.set_request_id(request.headers.get("X-Request-ID"))
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+@app.on_event("startup")
+async def open_db_pools():
+    # Load the embedding model in the background; the server accepts requests meanwhile
+    embeddings.start_warm_up()
+    await db_pool.get_async_pool().open()
+    retrieval_cache.start_listener()
+    await asyncio.to_thread(conversation_managers.create_tables)
+    if config.RETRIEVAL_BACKEND == "mmap":
+        await asyncio.to_thread(mmap_index.get_index)
+
+@app.on_event("shutdown")
+async def close_db_pools():
+    retrieval_cache.stop_listener()
+    await db_pool.aclose_pools()
+
+@app.get("/pool-stats")
+def pool_stats_endpoint():
+    """Connection pool size and usage counters."""
+    return db_pool.pool_stats()
+
+@app.get("/session-stats")
+def session_stats_endpoint():
+    """Number of in-memory conversation sessions and eviction counters."""
+    return conversation_managers.stats()
+
+def collect_runtime_stats():
+    """Cache, embedding batcher, session and connection pool statistics for /metrics."""
+    lines = []
+    lines += metrics.stats_lines("llm_cache", [({}, llm_calls.cache_stats())])
+    embedding_stats = embeddings.cache_stats()
+    lines += metrics.stats_lines("embedding_cache", [({}, dict(embedding_stats, **embedding_stats["memory"]))])
+    batch_stats = embeddings.batch_stats()
+    if batch_stats:
+        lines += metrics.stats_lines("embedding_batcher", [({}, batch_stats)])
+    retrieval_stats = retrieval_cache.cache_stats()
+    lines += metrics.stats_lines("retrieval_cache", [({}, retrieval_stats)])
+    lines += metrics.gauge_lines("retrieval_cache_listener_connected", "1 while LISTEN for knowledge base changes is active.",
+                                 [({}, int(retrieval_stats["listener_connected"]))])
+    lines += metrics.stats_lines("sessions", [({}, conversation_managers.stats())])
+    lines += metrics.stats_lines("logging", [({}, structured_logging.logging_stats())])
+    lines += metrics.stats_lines("db_pool", [({"pool": name}, stats) for name, stats in db_pool.pool_stats().items()])
+    return lines
+
+metrics.add_collector(collect_runtime_stats)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics_endpoint():
+    """Prometheus text-format metrics: stage latencies, OpenAI tokens and cost, caches, pools."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache-stats")
+def cache_stats_endpoint():
+    """Hit/miss counters of the in-process caches."""
+    return {"embeddings": embeddings.cache_stats(), "embedding_batches": embeddings.batch_stats(),
+            "llm": llm_calls.cache_stats(), "retrieval": retrieval_cache.cache_stats(),
+            "mmap_index": mmap_index.index_stats()}
+
 class IntentResponse(BaseModel):
     intent: str
     action: Optional[str] = None
@@ -40,6 +121,16 @@ class IntentResponse(BaseModel):
     new_feature: Optional[str] = None
     refined_query: Optional[str] = None
 
+class SinglePassOutput(BaseModel):
+    """Arguments of the single-pass db_operation function call (LLM #1 + LLM #2 fields)."""
+    intent: str
+    action: Optional[str] = None
+    old_feature: Optional[str] = None
+    new_feature: Optional[str] = None
+    row_ids: List[int] = []
+    new_content: Optional[str] = None
+    call_to_db: bool = False
+
 class SecondLLMOutput(BaseModel):
     new_content: Optional[str] = None
     call_to_db: bool
@@ -52,174 +143,578 @@ class PipelineResponse(BaseModel):
     new_content: Optional[str] = None
     call_to_db: bool
     final_user_response: str
+    session_id: Optional[str] = None
+    timings: Optional[dict] = None   # seconds per pipeline stage, when requested
+    mode: Optional[str] = None       # pipeline mode that produced the response
 
-@app.post("/query", response_model=PipelineResponse)
-def query_endpoint(user_query: str):
-    # 1) Store user query
+def extract_row_ids(rows):
+    """
+    Return the ids of retrieved rows. Rows are expected to be dicts with an 'id'
+    field; anything else is treated as the id itself.
+    """
+    row_ids = []
+    for row in rows:
+        if isinstance(row, dict) and "id" in row:
+            row_ids.append(row["id"])
+        else:
+            row_ids.append(row)
+    return row_ids
 
-    logger.debug("Stored user query: %s", user_query)
-    
+def run_db_action(db_action, new_content, rows):
+    """
+    Execute an add/replace/delete action in-process through the db_command service
+    layer, in a single transaction on a pooled connection. Returns the changed ids.
+    """
+    row_ids = []
+    if db_action in ("replace", "delete"):
+        if not rows:
+            logger.error("No rows available for %s.", db_action)
+            raise HTTPException(status_code=500, detail=f"No rows available for {db_action}")
+        row_ids = extract_row_ids(rows)
+        logger.debug("Row IDs extracted for %s: %s", db_action, row_ids, extra=PAYLOAD)
+
+    try:
+        # Encode before checking out a connection, so the pool is not held during inference
+        vectors = db_command.embed_contents([new_content]) if db_action in ("add", "replace") else None
+        with db_pool.connection() as conn:
+            changed_ids = db_command.apply_action(conn, db_action, new_content, row_ids, vectors)
+            db_command.commit_mutation(conn, db_action, changed_ids)
+    except Exception as e:
+        logger.error("DB %s operation failed: %s", db_action, str(e))
+        raise HTTPException(status_code=500, detail=f"DB {db_action} operation failed")
+    logger.debug("DB %s changed ids: %s", db_action, changed_ids)
+    return changed_ids
+
+class PipelineState(BaseModel):
+    """
+    Result of the pipeline stages that run before LLM #3. final_user_response is
+    already set when the pipeline ended early with a fallback message; otherwise
+    LLM #3 is called with llm3_context (None means chat history only).
+    """
+    intent: str = ""
+    action: Optional[str] = None
+    changed_ids: List[Any] = []
+    retrieved_rows: List[Any] = []
+    new_content: Optional[str] = None
+    call_to_db: bool = False
+    llm3_context: Optional[dict] = None
+    final_user_response: Optional[str] = None
+    mode: Optional[str] = None
+
+    def to_response(self, session_id: str, timings: Optional[dict] = None) -> PipelineResponse:
+        return PipelineResponse(
+            intent=self.intent,
+            action=self.action,
+            Changed_ids=self.changed_ids,
+            retrieved_rows=self.retrieved_rows,
+            new_content=self.new_content,
+            call_to_db=self.call_to_db,
+            final_user_response=self.final_user_response,
+            session_id=session_id,
+            timings=timings,
+            mode=self.mode
+        )
+
+async def _no_emit(event: str, data: dict) -> None:
+    pass
+
+def get_conversation_manager(session_id: Optional[str]):
+    """Resolve (session_id, ConversationManager), generating a session id if none is given."""
+    try:
+        session_id = ConversationManagerPool.normalize_session_id(session_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="session_id must be a UUID")
+    return session_id, conversation_managers.get(session_id)
+
+async def check_and_store_query(user_query: str, conversation_manager, emit=_no_emit) -> bool:
+    """
+    Return True when a similar previous query exists (the pipeline then goes straight
+    to LLM #3); otherwise store the user query and return False.
+    """
     # Check if a similar query exists
-    if conversation_manager.has_relevant_previous_query(user_query):
+    with metrics.timed("similarity_check"):
+        similar = await conversation_manager.ahas_relevant_previous_query(user_query)
+    if similar:
         logger.debug("Found relevant previous query. Skipping to LLM #3.")
+        await emit("similar_query", {"skipped_to_llm3": True})
+        return True
+    # Store user query
+    with metrics.timed("store_query"):
+        await conversation_manager.aadd_user_message(user_query)
+    logger.debug("Stored user query: %s", user_query)
+    return False
+
+async def run_intent_stage(user_query: str, conversation_manager, emit=_no_emit, llm1_task=None):
+    """
+    Similarity check, storing the user query and LLM #1 (answered by the local
+    intent router instead when it is confident).
+    Returns (early_state, parsed1, intent_data); when early_state is not None the
+    pipeline goes straight to LLM #3 or has already produced a fallback answer.
+    llm1_task is an LLM #1 call already started speculatively; the caller cancels it
+    if it is not needed.
+    """
+    if await check_and_store_query(user_query, conversation_manager, emit):
         # Directly call LLM #3 if a similar query was found.
-        llm3_raw = call_llm3(user_query, conversation_manager)
-        logger.debug("LLM #3 raw output (from similar query branch): %s", llm3_raw)
-        conversation_manager.add_ai_message(llm3_raw)
-        return PipelineResponse(
-            intent="",
-            action=None,
-            Changed_ids=[],
-            retrieved_rows=[],
-            new_content=None,
-            call_to_db=False,
-            final_user_response=llm3_raw
-        )
-    conversation_manager.add_user_message(user_query)
+        return PipelineState(), None, None
     # STEP 1: LLM #1 
     try:
-        parsed1 = call_llm1(user_query)
-        logger.debug("LLM #1 parsed output: %s", parsed1)
+        with metrics.timed("llm1"):
+            parsed1 = await (llm1_task if llm1_task is not None else intent_router.aresolve_intent(user_query))
+        logger.debug("LLM #1 parsed output: %s", parsed1, extra=PAYLOAD)
         # Validate LLM #1 response using Pydantic
         intent_data = IntentResponse.parse_obj(parsed1)
     except Exception as e:
         logger.error("LLM #1 response validation failed: %s", str(e))
         fallback_message = "I'm having trouble understanding your request. Could you please rephrase or provide more details?"
-        conversation_manager.add_ai_message(fallback_message)
-        return PipelineResponse(
-            intent="fallback",
-            action=None,
-            Changed_ids=[],
-            retrieved_rows=[],
-            new_content=None,
-            call_to_db=False,
-            final_user_response=fallback_message
-        )
-    
-    #  STEP 2: Retrieval 
-    rows = []
+        await conversation_manager.aadd_ai_message(fallback_message)
+        return PipelineState(intent="fallback", final_user_response=fallback_message), None, None
+    await emit("intent", {
+        "intent": intent_data.intent,
+        "action": intent_data.action,
+        "refined_query": intent_data.refined_query
+    })
+    return None, parsed1, intent_data
+
+def retrieval_query_for(user_query: str, intent_data: IntentResponse) -> Optional[str]:
+    """Return the text to retrieve with, or None when the action needs no retrieval."""
     if intent_data.action and intent_data.action.lower() in ("retrieve", "replace", "delete"):
         if intent_data.refined_query:
             logger.debug("Using refined query for retrieval: %s", intent_data.refined_query)
-            rows = get_relevant_context(intent_data.refined_query)
-        else:
-            logger.debug("Using original user query for retrieval: %s", user_query)
-            rows = get_relevant_context(user_query)
-        logger.debug("Retrieved rows: %s", rows)
-    
+            return intent_data.refined_query
+        logger.debug("Using original user query for retrieval: %s", user_query)
+        return user_query
+    return None
+
+async def run_post_retrieval_stages(parsed1: dict, intent_data: IntentResponse, rows, conversation_manager,
+                                    emit=_no_emit, query: str = None) -> PipelineState:
+    """
+    LLM #2 and the optional DB action; returns the state LLM #3 is called with.
+    LLM #2 and LLM #3 see the rows packed to their passages most relevant to query
+    (the retrieval query) within config.CONTEXT_TOKEN_BUDGET.
+    """
+    with metrics.timed("context_packing"):
+        context, _ = await context_packing.apack_rows(query, rows)
+
     # STEP 3: LLM #2
     user_input_llm2 = {
         "intent": intent_data.intent,
         "action": intent_data.action,
         "old_feature": parsed1.get("old_feature"),
         "new_feature": parsed1.get("new_feature"),
-        "retrieved_context": rows
+        "retrieved_context": context
     }
-    logger.debug("LLM #2 input: %s", user_input_llm2)
+    logger.debug("LLM #2 input: %s", user_input_llm2, extra=PAYLOAD)
     try:
-        parsed2 = call_llm2(user_input_llm2)
-        logger.debug("LLM #2 parsed output: %s", parsed2)
+        with metrics.timed("llm2"):
+            parsed2 = await acall_llm2(user_input_llm2)
+        logger.debug("LLM #2 parsed output: %s", parsed2, extra=PAYLOAD)
         # Validate LLM #2 response using Pydantic
         second_data = SecondLLMOutput.parse_obj(parsed2)
     except Exception as e:
         logger.error("LLM #2 response validation failed: %s", str(e))
         fallback_message = "I'm having trouble processing your request. Could you please rephrase or provide more details?"
-        conversation_manager.add_ai_message(fallback_message)
-        return PipelineResponse(
+        await conversation_manager.aadd_ai_message(fallback_message)
+        return PipelineState(
             intent=intent_data.intent,
             action=intent_data.action,
-            Changed_ids=[],
             retrieved_rows=rows,
-            new_content=None,
-            call_to_db=False,
             final_user_response=fallback_message
         )
-    
+    return await apply_decision(intent_data, second_data, rows, emit, context)
+
+async def apply_decision(intent_data, second_data, rows, emit=_no_emit, context=None) -> PipelineState:
+    """
+    Run the DB action decided by LLM #2 (or the single-pass call), if any, and build
+    the state LLM #3 is called with. context is the (packed) form of rows given to
+    LLM #3; defaults to rows.
+    """
     # STEP 4: (Optional) Execute DB actions if needed
     changed_ids = []
     if second_data.call_to_db:
         logger.debug("DB action required. Execute DB actions here.")
-        # Determine the DB action from the intent. Default to "add" if not specified.
         db_action = intent_data.action.lower() if intent_data.action else None
         logger.debug("Determined DB action: %s", db_action)
+        # The write path uses the thread-safe pool, so run it off the event loop
+        with metrics.timed("db_action"):
+            changed_ids = await asyncio.to_thread(run_db_action, db_action, second_data.new_content, rows)
+        await emit("db_action", {"action": db_action, "changed_ids": changed_ids})
 
-        if db_action == "add":
-            payload = {"new_content": second_data.new_content}
-            logger.debug("Sending DB add request with payload: %s", payload)
-            response = requests.post("http://localhost:8000/db/add", json=payload)
-            logger.debug("DB add response: %s", response.text)
-            if response.ok:
-                new_id = response.json().get("new_id")
-                changed_ids.append(new_id)
-            else:
-                raise HTTPException(status_code=500, detail="DB add operation failed")
-                
-        elif db_action == "replace":
-            # Assume that retrieved rows contain an 'id' field if available, otherwise treat the row as an ID.
-            if rows and isinstance(rows, list) and len(rows) > 0:
-                row_ids = []
-                for row in rows:
-                    if isinstance(row, dict) and "id" in row:
-                        row_ids.append(row["id"])
-                    else:
-                        row_ids.append(row)
-                logger.debug("Row IDs extracted for replacement: %s", row_ids)
-            else:
-                logger.error("No rows available for replacement.")
-                raise HTTPException(status_code=500, detail="No rows available for replacement")
-            payload = {"row_ids": row_ids, "new_content": second_data.new_content}
-            logger.debug("Sending DB replace request with payload: %s", payload)
-            response = requests.post("http://localhost:8000/db/replace", json=payload)
-            logger.debug("DB replace response: %s", response.text)
-            if response.ok:
-                updated_id = response.json().get("updated_id")
-                changed_ids.append(updated_id)
-            else:
-                raise HTTPException(status_code=500, detail="DB replace operation failed")
-                
-        elif db_action == "delete":
-            if rows and isinstance(rows, list) and len(rows) > 0:
-                row_ids = []
-                for row in rows:
-                    if isinstance(row, dict) and "id" in row:
-                        row_ids.append(row["id"])
-                    else:
-                        row_ids.append(row)
-                logger.debug("Row IDs extracted for deletion: %s", row_ids)
-            else:
-                logger.error("No rows available for deletion.")
-                raise HTTPException(status_code=500, detail="No rows available for deletion")
-            payload = {"row_ids": row_ids}
-            logger.debug("Sending DB delete request with payload: %s", payload)
-            response = requests.post("http://localhost:8000/db/delete", json=payload)
-            logger.debug("DB delete response: %s", response.text)
-            if response.ok:
-                deleted_ids = response.json().get("deleted_ids", [])
-                changed_ids.extend(deleted_ids)
-            else:
-                raise HTTPException(status_code=500, detail="DB delete operation failed")
-
-    
-    # STEP 5: LLM #3 
+    # STEP 5: LLM #3 input
     third_input = {
         "intent": intent_data.intent,
         "action": intent_data.action,
         "row_ids": changed_ids,
-        "context": rows,
+        "context": rows if context is None else context,
         "new_content": second_data.new_content
     }
-    logger.debug("LLM #3 additional context: %s", third_input)
-    llm3_raw = call_llm3(user_query, conversation_manager, third_input)
-    logger.debug("LLM #3 raw output: %s", llm3_raw)
-    conversation_manager.add_ai_message(llm3_raw)
-    #if you want to clear chats
-    #conversation_manager.clear_session()
-    return PipelineResponse(
+    logger.debug("LLM #3 additional context: %s", third_input, extra=PAYLOAD)
+    return PipelineState(
         intent=intent_data.intent,
         action=intent_data.action,
-        Changed_ids=changed_ids,
+        changed_ids=changed_ids,
         retrieved_rows=rows,
         new_content=second_data.new_content,
         call_to_db=second_data.call_to_db,
-        final_user_response=llm3_raw
+        llm3_context=third_input
+    )
+
+def _discard(task) -> None:
+    """Cancel a speculative task that is no longer needed (or consume its result)."""
+    if task is None:
+        return
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled():
+        task.exception()
+
+async def retrieve(retrieval_query: str, user_query: str, speculative=None):
+    """
+    Rows for retrieval_query. A speculative retrieval started on the raw user_query is
+    reused when retrieval_query is the raw query, or when their embeddings are within
+    config.SPECULATIVE_REUSE_DISTANCE (cosine); otherwise it is cancelled.
+    Returns (rows, reused).
+    """
+    if speculative is not None:
+        reuse = retrieval_query == user_query
+        if not reuse:
+            raw, refined = await embeddings.aencode([user_query, retrieval_query])
+            distance = embeddings.cosine_distance(raw, refined)
+            reuse = distance <= config.SPECULATIVE_REUSE_DISTANCE
+            logger.debug("Refined/raw query embedding distance %.4f, reuse=%s", distance, reuse)
+        if reuse:
+            try:
+                return await speculative, True
+            except Exception as e:
+                logger.error("Speculative retrieval failed, retrying: %s", str(e))
+        else:
+            _discard(speculative)
+    return await aget_relevant_context(retrieval_query), False
+
+async def run_single_pass_stages(user_query: str, conversation_manager, emit=_no_emit) -> PipelineState:
+    """
+    Single-pass mode: similarity check, retrieval on the user query, then one
+    function-calling request that returns intent, action, new_content and call_to_db
+    together (instead of LLM #1 and LLM #2), then the optional DB action.
+    """
+    if await check_and_store_query(user_query, conversation_manager, emit):
+        return PipelineState(mode="single_pass")
+
+    with metrics.timed("retrieval"):
+        rows = await aget_relevant_context(user_query)
+    logger.debug("Retrieved rows: %s", rows, extra=PAYLOAD)
+    await emit("retrieved", {"rows": [{"id": row["id"], "url": row["url"]} for row in rows], "speculative": False})
+
+    with metrics.timed("context_packing"):
+        context, _ = await context_packing.apack_rows(user_query, rows)
+
+    try:
+        with metrics.timed("single_pass"):
+            parsed = await llm_calls.acall_single_pass(user_query, context)
+        logger.debug("Single-pass parsed output: %s", parsed, extra=PAYLOAD)
+        decision = SinglePassOutput.parse_obj(parsed)
+    except Exception as e:
+        logger.error("Single-pass response validation failed: %s", str(e))
+        fallback_message = "I'm having trouble processing your request. Could you please rephrase or provide more details?"
+        await conversation_manager.aadd_ai_message(fallback_message)
+        return PipelineState(intent="fallback", retrieved_rows=rows, final_user_response=fallback_message,
+                             mode="single_pass")
+    await emit("intent", {"intent": decision.intent, "action": decision.action, "refined_query": None})
+
+    # Rows to change: the retrieved rows the model picked, or all of them (as in two-pass mode)
+    action = decision.action.lower() if decision.action else None
+    if action in ("replace", "delete") and decision.row_ids:
+        chosen = [row for row in rows if row["id"] in decision.row_ids]
+        rows_for_action = chosen or rows
+    else:
+        rows_for_action = rows
+    if action not in ("retrieve", "replace", "delete"):
+        # Context is only passed on for actions that use it, as in two-pass mode
+        rows = context = []
+    state = await apply_decision(decision, decision, rows_for_action, emit)
+    state.retrieved_rows = rows
+    if state.llm3_context is not None:
+        state.llm3_context["context"] = context
+    state.mode = "single_pass"
+    return state
+
+def resolve_mode(mode: Optional[str]) -> str:
+    """Pipeline mode for a request: the given mode or config.PIPELINE_MODE."""
+    mode = mode or config.PIPELINE_MODE
+    if mode not in PIPELINE_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {list(PIPELINE_MODES)}")
+    return mode
+
+async def run_pipeline(user_query: str, conversation_manager, mode: Optional[str] = None,
+                       emit=_no_emit) -> PipelineState:
+    """Run the pipeline up to LLM #3 in the requested mode."""
+    mode = resolve_mode(mode)
+    state = await PIPELINE_MODES[mode](user_query, conversation_manager, emit)
+    state.mode = mode
+    return state
+
+async def run_pipeline_stages(user_query: str, conversation_manager, emit=_no_emit) -> PipelineState:
+    """
+    Run every pipeline step up to (not including) LLM #3. emit(event, data) is
+    awaited as each stage finishes, so callers can report progress.
+
+    With config.SPECULATIVE_RETRIEVAL, LLM #1 and a retrieval on the raw user query
+    start alongside the similarity check; work that turns out to be unneeded is
+    cancelled.
+    """
+    llm1_task = speculative = None
+    if config.SPECULATIVE_RETRIEVAL:
+        llm1_task = asyncio.ensure_future(intent_router.aresolve_intent(user_query))
+        speculative = asyncio.ensure_future(aget_relevant_context(user_query))
+    try:
+        early_state, parsed1, intent_data = await run_intent_stage(user_query, conversation_manager, emit, llm1_task)
+        if early_state is not None:
+            return early_state
+
+        #  STEP 2: Retrieval 
+        rows = []
+        retrieval_query = retrieval_query_for(user_query, intent_data)
+        if retrieval_query is not None:
+            with metrics.timed("retrieval"):
+                rows, reused = await retrieve(retrieval_query, user_query, speculative)
+            logger.debug("Retrieved rows (speculative=%s): %s", reused, rows, extra=PAYLOAD)
+            await emit("retrieved", {
+                "rows": [{"id": row["id"], "url": row["url"]} for row in rows],
+                "speculative": reused
+            })
+    finally:
+        _discard(llm1_task)
+        _discard(speculative)
+
+    return await run_post_retrieval_stages(parsed1, intent_data, rows, conversation_manager, emit,
+                                           query=retrieval_query)
+
+PIPELINE_MODES = {"two_pass": run_pipeline_stages, "single_pass": run_single_pass_stages}
+
+async def finish_with_llm3(user_query: str, conversation_manager, state: PipelineState) -> PipelineState:
+    """Call LLM #3 (unless the pipeline already ended with a fallback) and store the answer."""
+    if state.final_user_response is None:
+        # STEP 5: LLM #3 
+        with metrics.timed("llm3"):
+            llm3_raw = await acall_llm3(user_query, conversation_manager, state.llm3_context)
+        logger.debug("LLM #3 raw output: %s", llm3_raw, extra=PAYLOAD)
+        await conversation_manager.aadd_ai_message(llm3_raw)
+        state.final_user_response = llm3_raw
+    return state
+
+@app.post("/query", response_model=PipelineResponse)
+async def query_endpoint(user_query: str, session_id: Optional[str] = None, include_timings: bool = False,
+                         mode: Optional[str] = None):
+    """
+    Run the pipeline for one user query. Pass the session_id returned by a previous
+    call to continue that conversation; omit it to start a new one.
+    With include_timings (or config.INCLUDE_TIMINGS) the response carries the
+    seconds spent in each pipeline stage. mode ('two_pass' or 'single_pass')
+    defaults to config.PIPELINE_MODE.
+    """
+    session_id, conversation_manager = get_conversation_manager(session_id)
+    resolve_mode(mode)
+    timings = metrics.start_request()
+    with metrics.timed("total"):
+        state = await run_pipeline(user_query, conversation_manager, mode)
+        state = await finish_with_llm3(user_query, conversation_manager, state)
+    #if you want to clear chats
+    #conversation_manager.clear_session()
+    return state.to_response(session_id, timings if include_timings or config.INCLUDE_TIMINGS else None)
+
+def _sse(event: str, data) -> str:
+    """Format one server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+async def stream_pipeline(user_query: str, session_id: str, conversation_manager, mode: Optional[str] = None):
+    """
+    Yield server-sent events for one query: a stage event as each pipeline step
+    finishes, then LLM #3 tokens as they arrive, then a final "done" event with
+    the full PipelineResponse. The AI message is stored once the stream ends.
+    """
+    queue = asyncio.Queue()
+
+    async def emit(event, data):
+        await queue.put((event, data))
+
+    async def produce():
+        timings = metrics.start_request()
+        started = time.perf_counter()
+        try:
+            state = await run_pipeline(user_query, conversation_manager, mode, emit)
+            if state.final_user_response is None:
+                tokens = []
+                with metrics.timed("llm3"):
+                    async for token in astream_llm3(user_query, conversation_manager, state.llm3_context):
+                        tokens.append(token)
+                        await emit("token", {"text": token})
+                state.final_user_response = "".join(tokens).strip()
+                logger.debug("LLM #3 streamed output: %s", state.final_user_response, extra=PAYLOAD)
+                await conversation_manager.aadd_ai_message(state.final_user_response)
+            metrics.record_stage("total", time.perf_counter() - started)
+            await emit("done", state.to_response(session_id, timings).dict())
+        except HTTPException as e:
+            await emit("error", {"status_code": e.status_code, "detail": e.detail})
+        except Exception as e:
+            logger.error("Streaming pipeline failed: %s", str(e))
+            await emit("error", {"status_code": 500, "detail": str(e)})
+        finally:
+            await queue.put(None)
+
+    task = asyncio.create_task(produce())
+    try:
+        yield _sse("session", {"session_id": session_id})
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            yield _sse(*item)
+    finally:
+        # Client went away before the end: stop the remaining work
+        if not task.done():
+            task.cancel()
+
+@app.api_route("/query/stream", methods=["GET", "POST"])
+async def query_stream_endpoint(user_query: str, session_id: Optional[str] = None, mode: Optional[str] = None):
+    """
+    Streaming variant of /query using server-sent events. Events: session, similar_query,
+    intent, retrieved, db_action, token (LLM #3 output), done (PipelineResponse), error.
+    """
+    session_id, conversation_manager = get_conversation_manager(session_id)
+    resolve_mode(mode)
+    return StreamingResponse(
+        stream_pipeline(user_query, session_id, conversation_manager, mode),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
+
+class BatchQueryItem(BaseModel):
+    user_query: str
+    session_id: Optional[str] = None
+
+class BatchQueryRequest(BaseModel):
+    queries: List[BatchQueryItem]
+    max_concurrency: Optional[conint(ge=1)] = None
+
+async def query_batch(items: List[BatchQueryItem], max_concurrency: Optional[int] = None):
+    """
+    Python API for running many queries at once. Yields (index, PipelineResponse)
+    or (index, Exception) as each item finishes, in completion order.
+
+    All user queries are encoded in one embedding call up front, retrieval for each
+    wave (see below) is one database round trip, and the LLM #1/#2/#3 calls of the items
+    run concurrently, at most max_concurrency (config.BATCH_MAX_CONCURRENCY) at a time.
+    Items without a session_id each get a new session. Items sharing a session run one
+    after another, in input order: the batch is processed in waves, wave k holding the
+    k-th item of every session, so history writes and the repeat-query check of a
+    session never interleave.
+    """
+    semaphore = asyncio.Semaphore(config.BATCH_MAX_CONCURRENCY if max_concurrency is None else max_concurrency)
+    resolved = [get_conversation_manager(item.session_id) for item in items]
+    # Warm the embedding cache for the similarity check and stored query embeddings
+    await embeddings.aencode([item.user_query for item in items])
+
+    waves = []
+    session_items = {}
+    for index, (session_id, _) in enumerate(resolved):
+        wave = session_items.get(session_id, 0)
+        session_items[session_id] = wave + 1
+        if wave == len(waves):
+            waves.append([])
+        waves[wave].append(index)
+
+    async def intent_phase(index):
+        structured_logging.set_item_request_id(index)
+        async with semaphore:
+            return await run_intent_stage(items[index].user_query, resolved[index][1])
+
+    async def answer_phase(index, state):
+        user_query = items[index].user_query
+        session_id, conversation_manager = resolved[index]
+        async with semaphore:
+            state = await finish_with_llm3(user_query, conversation_manager, state)
+        # Batches always run in two-pass mode (retrieval is batched after LLM #1)
+        state.mode = "two_pass"
+        return index, state.to_response(session_id)
+
+    async def post_retrieval_phase(index, parsed1, intent_data, rows, retrieval_query=None):
+        async with semaphore:
+            state = await run_post_retrieval_stages(parsed1, intent_data, rows, resolved[index][1],
+                                                    query=retrieval_query)
+        return await answer_phase(index, state)
+
+    async def guarded(index, coro):
+        structured_logging.set_item_request_id(index)
+        try:
+            return await coro
+        except Exception as e:
+            logger.error("Batch item %d failed: %s", index, str(e))
+            return index, e
+
+    async def run_wave(indexes):
+        """One wave (at most one item per session): yields (index, result) as items finish."""
+        intent_results = await asyncio.gather(
+            *[intent_phase(index) for index in indexes], return_exceptions=True
+        )
+
+        tasks = []
+        to_retrieve = {}
+        for index, result in zip(indexes, intent_results):
+            if isinstance(result, Exception):
+                yield index, result
+                continue
+            early_state, parsed1, intent_data = result
+            if early_state is not None:
+                tasks.append(asyncio.ensure_future(guarded(index, answer_phase(index, early_state))))
+                continue
+            retrieval_query = retrieval_query_for(items[index].user_query, intent_data)
+            if retrieval_query is None:
+                tasks.append(asyncio.ensure_future(guarded(index, post_retrieval_phase(index, parsed1, intent_data, []))))
+            else:
+                to_retrieve[index] = (retrieval_query, parsed1, intent_data)
+
+        if to_retrieve:
+            indexes = list(to_retrieve)
+            try:
+                batch_rows = await aget_relevant_context_batch([to_retrieve[index][0] for index in indexes])
+            except Exception as e:
+                logger.error("Batch retrieval failed: %s", str(e))
+                for index in indexes:
+                    yield index, e
+            else:
+                for index, rows in zip(indexes, batch_rows):
+                    retrieval_query, parsed1, intent_data = to_retrieve[index]
+                    tasks.append(asyncio.ensure_future(guarded(
+                        index, post_retrieval_phase(index, parsed1, intent_data, rows, retrieval_query)
+                    )))
+
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+
+    for wave in waves:
+        async for result in run_wave(wave):
+            yield result
+
+@app.post("/query/batch")
+async def query_batch_endpoint(body: BatchQueryRequest):
+    """
+    Run many queries in one request. Results stream back as newline-delimited JSON,
+    one line per item as it completes: {"index": i, "response": {...}} or
+    {"index": i, "error": "..."}.
+    """
+    if not body.queries:
+        raise HTTPException(status_code=400, detail="No queries provided")
+    for item in body.queries:
+        try:
+            ConversationManagerPool.normalize_session_id(item.session_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="session_id must be a UUID")
+
+    async def lines():
+        async for index, result in query_batch(body.queries, body.max_concurrency):
+            if isinstance(result, Exception):
+                detail = result.detail if isinstance(result, HTTPException) else str(result)
+                yield json.dumps({"index": index, "error": detail}) + "\n"
+            else:
+                yield json.dumps({"index": index, "response": result.dict()}, default=str) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
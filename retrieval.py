@@ -1,42 +1,265 @@
-
-import psycopg2
+from psycopg.rows import dict_row
 from psycopg2.extras import RealDictCursor
 import config
+import db_pool
+import embeddings
+import ann_index
+import mmap_index
+import retrieval_cache
 
-def get_connection():
-    return psycopg2.connect(
-        host=config.DB_HOST,
-        port=config.DB_PORT,
-        dbname=config.DB_NAME,
-        user=config.DB_USER,
-        password=config.DB_PASSWORD
-    )
+QUERY_SQL = """
+SELECT id, content, url
+FROM {table}
+ORDER BY embedding {operator} %s::vector
+LIMIT %s;
+"""
+
+# One round trip for many queries: each query vector is matched against the table
+# in a LATERAL subquery, so every query still gets its own index scan.
+BATCH_QUERY_SQL = """
+SELECT q.idx, d.id, d.content, d.url, d.distance
+FROM unnest(%s::int[], %s::text[]) AS q(idx, query_embedding)
+CROSS JOIN LATERAL (
+    SELECT id, content, url, embedding {operator} q.query_embedding::vector AS distance
+    FROM {table}
+    ORDER BY embedding {operator} q.query_embedding::vector
+    LIMIT %s
+) d
+ORDER BY q.idx, d.distance;
+"""
+
+# Quantized storage modes: a coarse top-k over the quantized column (served by its
+# index), re-ranked on the full-precision embedding. {coarse} orders by the quantized
+# distance to the query.
+RERANK_QUERY_SQL = """
+SELECT id, content, url
+FROM (
+    SELECT id, content, url, embedding
+    FROM {table}
+    ORDER BY {coarse}
+    LIMIT %s
+) candidates
+ORDER BY embedding {operator} %s::vector
+LIMIT %s;
+"""
+
+BATCH_RERANK_QUERY_SQL = """
+SELECT q.idx, d.id, d.content, d.url, d.distance
+FROM unnest(%s::int[], %s::text[]) AS q(idx, query_embedding)
+CROSS JOIN LATERAL (
+    SELECT id, content, url, embedding {operator} q.query_embedding::vector AS distance
+    FROM (
+        SELECT id, content, url, embedding
+        FROM {table}
+        ORDER BY {coarse}
+        LIMIT %s
+    ) candidates
+    ORDER BY distance
+    LIMIT %s
+) d
+ORDER BY q.idx, d.distance;
+"""
+
+def coarse_order(query: str, storage: str = None, distance: str = None) -> str:
+    """ORDER BY expression over the quantized column of a storage mode for a query vector expression."""
+    storage = ann_index.storage_mode(storage)
+    column = ann_index.storage_column(storage)
+    if storage == "binary":
+        return f"{column} {ann_index.HAMMING_OPERATOR} binary_quantize({query}::vector)"
+    dim = int(config.EMBEDDING_DIM)
+    return f"{column} {ann_index.distance_operator(distance)} {query}::halfvec({dim})"
+
+def rerank_candidates(top_n: int, candidates: int = None) -> int:
+    return max(candidates or config.RERANK_CANDIDATES, top_n)
+
+def quantized_search_settings(ef_search, probes, candidates):
+    """HNSW must keep at least `candidates` results for the coarse LIMIT to be filled."""
+    if ef_search is None and config.VECTOR_INDEX_TYPE == "hnsw":
+        ef_search = config.HNSW_EF_SEARCH or ann_index.DEFAULT_EF_SEARCH
+        # Only worth a set_config when the server default is too small
+        ef_search = candidates if candidates > ef_search else config.HNSW_EF_SEARCH
+    return ann_index.search_settings(ef_search, probes)
 
 def get_query_embedding(query: str):
-    emb = config.embedding_model.encode(query)
+    emb = embeddings.encode(query)
     return emb.tolist() if hasattr(emb, 'tolist') else list(emb)
 
-def get_relevant_context(refined_query: str, top_n: int = 3):
+def build_query_sql(distance: str = None) -> str:
+    """Nearest-neighbour query using the operator that matches the ANN index's distance."""
+    return QUERY_SQL.format(table=config.TABLE_NAME, operator=ann_index.distance_operator(distance))
+
+def use_mmap_backend() -> bool:
+    """True when config.RETRIEVAL_BACKEND selects the in-process memory-mapped index."""
+    return config.RETRIEVAL_BACKEND == "mmap"
+
+def build_search(embedding_str: str, top_n: int, ef_search: int = None, probes: int = None, distance: str = None,
+                 storage: str = None, candidates: int = None):
+    """
+    Return (settings_sql, settings_params, query_sql, query_params) for one query,
+    using a coarse quantized search plus exact re-rank for the halfvec/binary modes.
+    """
+    if ann_index.storage_mode(storage) == "vector":
+        settings_sql, settings_params = ann_index.search_settings(ef_search, probes)
+        return settings_sql, settings_params, build_query_sql(distance), (embedding_str, top_n)
+    candidates = rerank_candidates(top_n, candidates)
+    settings_sql, settings_params = quantized_search_settings(ef_search, probes, candidates)
+    query_sql = RERANK_QUERY_SQL.format(
+        table=config.TABLE_NAME, coarse=coarse_order("%s", storage, distance),
+        operator=ann_index.distance_operator(distance)
+    )
+    return settings_sql, settings_params, query_sql, (embedding_str, candidates, embedding_str, top_n)
+
+def search_pgvector(embedding, top_n: int = 3, ef_search: int = None, probes: int = None, distance: str = None,
+                    storage: str = None, candidates: int = None):
+    """Nearest rows to an already computed embedding, searched in Postgres."""
+    embedding_str = embeddings.to_vector_literal(embedding)
+    settings_sql, settings_params, query_sql, query_params = build_search(
+        embedding_str, top_n, ef_search, probes, distance, storage, candidates
+    )
+
+    if settings_sql:
+        # psycopg2 sends both statements as one query string: one round trip
+        query_sql = f"{settings_sql};\n{query_sql}"
+        query_params = tuple(settings_params) + tuple(query_params)
+
+    with db_pool.connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        try:
+            cur.execute(query_sql, query_params)
+            rows = cur.fetchall()
+        finally:
+            cur.close()
+
+    return rows  # list of dicts with {id, content, url}
+
+async def _afetch(settings_sql, settings_params, query_sql, query_params):
+    """
+    Run the optional settings statement and the search on the async pool. Both are
+    sent in one pipeline, so the settings cost no extra round trip.
+    """
+    async with db_pool.get_async_pool().connection() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            if settings_sql:
+                async with conn.pipeline():
+                    await cur.execute(settings_sql, settings_params)
+                    await cur.execute(query_sql, query_params)
+            else:
+                await cur.execute(query_sql, query_params)
+            return await cur.fetchall()
+
+def search_mmap(embedding, top_n: int = 3):
+    """Nearest rows to an already computed embedding, searched in the in-process index."""
+    return mmap_index.get_index().search(embedding, top_n)
+
+def search_params(ef_search: int = None, probes: int = None, distance: str = None) -> tuple:
+    """Settings that change the result of a search; part of the retrieval cache key."""
+    if use_mmap_backend():
+        # Overlay updates and reloads land shortly after the commit that bumps the
+        # cache version, so results are also keyed by the index's own version. It is
+        # read without refreshing (this runs on the event loop); the search refreshes
+        # first, so an entry is never older than the version in its key.
+        return ("mmap", mmap_index.index_version())
+    return ("pgvector", ann_index.storage_mode(), distance or config.VECTOR_DISTANCE, ef_search, probes)
+
+def get_relevant_context(refined_query: str, top_n: int = 3, ef_search: int = None, probes: int = None,
+                         distance: str = None):
     """
     Searches for the top relevant content from the database using pgvector similarity.
     Returns a list of dicts with keys {id, content, url}.
+
+    ef_search (HNSW) and probes (IVFFlat) trade recall for latency for this query only;
+    they default to config.HNSW_EF_SEARCH / config.IVFFLAT_PROBES. distance defaults to
+    config.VECTOR_DISTANCE and should match the index's operator class.
+    With a quantized config.STORAGE_MODE, config.RERANK_CANDIDATES rows are fetched
+    from the quantized index and re-ranked on the full-precision embedding.
+    With RETRIEVAL_BACKEND = 'mmap' the search runs in-process instead (exact, so
+    ef_search/probes do not apply).
+    Results are cached per query embedding until the knowledge base changes
+    (see retrieval_cache.py).
     """
     embedding = get_query_embedding(refined_query)
-    embedding_str = f'[{",".join(map(str, embedding))}]'
-    
-    conn = get_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    query_sql = f"""
-    SELECT id, content, url
-    FROM {config.TABLE_NAME}
-    ORDER BY embedding <-> %s
-    LIMIT %s;
-    """
-    try:
-        cur.execute(query_sql, (embedding_str, top_n))
-        rows = cur.fetchall()
-    finally:
-        cur.close()
-        conn.close()
+    key = retrieval_cache.cache_key(embedding, top_n, search_params(ef_search, probes, distance))
+    rows = retrieval_cache.get(key)
+    if rows is not None:
+        return rows
+    version = retrieval_cache.current_version()
+    if use_mmap_backend():
+        rows = search_mmap(embedding, top_n)
+    else:
+        rows = search_pgvector(embedding, top_n, ef_search, probes, distance)
+    retrieval_cache.put(key, rows, version)
+    return rows
 
+async def aget_relevant_context(refined_query: str, top_n: int = 3, ef_search: int = None, probes: int = None,
+                                distance: str = None):
+    """
+    Async version of get_relevant_context: the query is encoded through the embedding
+    micro-batcher and the search runs on the shared asyncio connection pool.
+    """
+    embedding = (await embeddings.aencode(refined_query)).tolist()
+    key = retrieval_cache.cache_key(embedding, top_n, search_params(ef_search, probes, distance))
+    rows = retrieval_cache.get(key)
+    if rows is not None:
+        return rows
+    version = retrieval_cache.current_version()
+    if use_mmap_backend():
+        rows = await embeddings.run_in_executor(search_mmap, embedding, top_n)
+        retrieval_cache.put(key, rows, version)
+        return rows
+    embedding_str = embeddings.to_vector_literal(embedding)
+    settings_sql, settings_params, query_sql, query_params = build_search(
+        embedding_str, top_n, ef_search, probes, distance
+    )
+
+    rows = await _afetch(settings_sql, settings_params, query_sql, query_params)
+    retrieval_cache.put(key, rows, version)
     return rows  # list of dicts with {id, content, url}
+
+async def aget_relevant_context_batch(queries: list, top_n: int = 3, ef_search: int = None, probes: int = None,
+                                      distance: str = None):
+    """
+    Batch version of aget_relevant_context: all queries are encoded in one
+    embedding call and the ones not in the retrieval cache are searched in one
+    database round trip.
+    Returns one list of {id, content, url} dicts per query, in input order.
+    """
+    if not queries:
+        return []
+    vectors = await embeddings.aencode(list(queries))
+    params = search_params(ef_search, probes, distance)
+    keys = [retrieval_cache.cache_key(vector, top_n, params) for vector in vectors]
+    results = [retrieval_cache.get(key) for key in keys]
+    pending = [index for index, rows in enumerate(results) if rows is None]
+    if not pending:
+        return results
+    version = retrieval_cache.current_version()
+    if use_mmap_backend():
+        index = mmap_index.get_index()
+        found = await embeddings.run_in_executor(lambda: [index.search(vectors[i], top_n) for i in pending])
+        for i, rows in zip(pending, found):
+            results[i] = rows
+            retrieval_cache.put(keys[i], rows, version)
+        return results
+    literals = [embeddings.to_vector_literal(vectors[i]) for i in pending]
+    operator = ann_index.distance_operator(distance)
+    if ann_index.storage_mode() == "vector":
+        settings_sql, settings_params = ann_index.search_settings(ef_search, probes)
+        query_sql = BATCH_QUERY_SQL.format(table=config.TABLE_NAME, operator=operator)
+        query_params = (pending, literals, top_n)
+    else:
+        candidates = rerank_candidates(top_n)
+        settings_sql, settings_params = quantized_search_settings(ef_search, probes, candidates)
+        query_sql = BATCH_RERANK_QUERY_SQL.format(
+            table=config.TABLE_NAME, coarse=coarse_order("q.query_embedding", distance=distance), operator=operator
+        )
+        query_params = (pending, literals, candidates, top_n)
+
+    rows = await _afetch(settings_sql, settings_params, query_sql, query_params)
+    for i in pending:
+        results[i] = []
+    for row in rows:
+        row.pop("distance")
+        results[row.pop("idx")].append(row)
+    for i in pending:
+        retrieval_cache.put(keys[i], results[i], version)
+    return results
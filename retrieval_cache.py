@@ -0,0 +1,230 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+import numpy as np
+import config
+import db_pool
+from cache import LRUCache
+
+# Cache of retrieval results keyed on the query embedding (optionally quantized, so
+# near-duplicate queries share an entry), top_n and the search settings. Every entry
+# records the knowledge base version it was computed at; the version is bumped by
+# db_command mutations in this process and, through Postgres NOTIFY on
+# config.RETRIEVAL_CACHE_CHANNEL, by mutations in every other worker (and by
+# `database.py` ingest runs). The NOTIFY is sent in the mutation's own transaction,
+# so it is delivered exactly when the change commits. Entries from an older version
+# are never served.
+
+logger = logging.getLogger("retrieval_cache")
+
+# Identifies this process in NOTIFY payloads, so it skips its own notifications
+_origin = uuid.uuid4().hex
+
+_version = 0
+_version_lock = threading.Lock()
+_remote_listeners = []
+_listener_thread = None
+_stop = threading.Event()
+
+_stats = {
+    "stale": 0, "local_bumps": 0, "remote_bumps": 0, "notify_errors": 0, "reconnects": 0,
+    "notify_lag_ms_total": 0.0, "notify_lag_ms_max": 0.0, "hit_age_s_total": 0.0,
+}
+_state = {"listener_connected": False, "last_bump": None}
+
+_cache = LRUCache(config.RETRIEVAL_CACHE_SIZE, ttl=config.RETRIEVAL_CACHE_TTL)
+
+# Postgres rejects NOTIFY payloads of 8000 bytes or more; larger id lists are left out
+MAX_PAYLOAD_BYTES = 7900
+
+
+def current_version() -> int:
+    return _version
+
+
+def _bump(remote: bool) -> int:
+    global _version
+    with _version_lock:
+        _version += 1
+        _stats["remote_bumps" if remote else "local_bumps"] += 1
+        _state["last_bump"] = time.time()
+        return _version
+
+
+def cache_key(embedding, top_n: int, params=()) -> tuple:
+    """
+    (embedding digest, top_n, params). With config.RETRIEVAL_CACHE_QUANTIZATION set,
+    every component is rounded to a multiple of that step before hashing, so
+    embeddings that differ by less than the step map to the same key.
+    """
+    vector = np.asarray(embedding, dtype=np.float32)
+    step = config.RETRIEVAL_CACHE_QUANTIZATION
+    if step:
+        vector = np.round(vector / step).astype(np.int32)
+    digest = hashlib.blake2b(vector.tobytes(), digest_size=16).hexdigest()
+    return digest, int(top_n), tuple(params)
+
+
+def get(key):
+    """Cached rows for key, or None on a miss or when the entry predates the current version."""
+    if not config.RETRIEVAL_CACHE_ENABLED:
+        return None
+    entry = _cache.get(key)
+    if entry is None:
+        return None
+    version, stored_at, rows = entry
+    if version != _version:
+        _cache.pop(key)
+        _stats["stale"] += 1
+        return None
+    _stats["hit_age_s_total"] += time.time() - stored_at
+    return [dict(row) for row in rows]
+
+
+def put(key, rows, version: int) -> None:
+    """
+    Store rows computed at `version` (read with current_version() before searching, so
+    a mutation that lands during the search makes the entry stale instead of wrong).
+    """
+    if config.RETRIEVAL_CACHE_ENABLED and version == _version:
+        _cache.set(key, (version, time.time(), [dict(row) for row in rows]))
+
+
+def notify(conn, action: str, count: int = 0, row_ids=None) -> None:
+    """
+    Queue a NOTIFY for the other workers in conn's transaction (sent when it commits).
+    The changed row ids are included when they fit in the payload; otherwise they are
+    null and receivers treat the change as unknown.
+    """
+    message = {"origin": _origin, "action": action, "count": count, "ts": time.time(), "row_ids": None}
+    if row_ids:
+        message["row_ids"] = [int(row_id) for row_id in row_ids]
+    payload = json.dumps(message)
+    if len(payload.encode("utf-8")) > MAX_PAYLOAD_BYTES:
+        message["row_ids"] = None
+        payload = json.dumps(message)
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_notify(%s, %s)", (config.RETRIEVAL_CACHE_CHANNEL, payload))
+
+
+def publish(action: str, count: int = 0) -> None:
+    """NOTIFY the other workers on a connection of its own (for changes made outside /db)."""
+    try:
+        with db_pool.connection() as conn:
+            notify(conn, action, count)
+            conn.commit()
+    except Exception as e:
+        _stats["notify_errors"] += 1
+        logger.error("Knowledge base change notification failed: %s", e)
+
+
+def before_commit(conn, action, row_ids):
+    """db_command pre-commit hook: NOTIFY the other workers in the mutation's transaction."""
+    notify(conn, action, len(row_ids or []), row_ids)
+
+
+def on_mutation(action, row_ids):
+    """db_command mutation listener: invalidate this process's entries once the change is committed."""
+    version = _bump(remote=False)
+    logger.debug("Knowledge base version %d after %s of %d rows", version, action, len(row_ids or []))
+
+
+def add_remote_listener(callback) -> None:
+    """
+    Register callback(action, row_ids) to run when another process reports a knowledge
+    base change. row_ids is None when the changed rows are unknown (ingest runs, id
+    lists too large for a NOTIFY, notifications missed while reconnecting).
+    """
+    _remote_listeners.append(callback)
+
+
+def _handle_notification(payload: str) -> None:
+    try:
+        message = json.loads(payload)
+    except ValueError:
+        message = {}
+    if message.get("origin") == _origin:
+        return
+    if "ts" in message:
+        lag_ms = max(0.0, (time.time() - float(message["ts"])) * 1000)
+        _stats["notify_lag_ms_total"] += lag_ms
+        _stats["notify_lag_ms_max"] = max(_stats["notify_lag_ms_max"], lag_ms)
+    version = _bump(remote=True)
+    logger.debug("Knowledge base version %d after remote %s", version, message.get("action"))
+    _call_remote_listeners(message.get("action"), message.get("row_ids"))
+
+
+def _call_remote_listeners(action, row_ids) -> None:
+    for callback in _remote_listeners:
+        try:
+            callback(action, row_ids)
+        except Exception as e:
+            logger.error("Remote change listener %r failed: %s", callback, e)
+
+
+def _listen():
+    connected_before = False
+    while not _stop.is_set():
+        try:
+            conn = db_pool.dedicated_connection()
+            try:
+                conn.execute(f"LISTEN {config.RETRIEVAL_CACHE_CHANNEL}")
+                _state["listener_connected"] = True
+                if connected_before:
+                    # Notifications sent while disconnected are lost: assume a change
+                    _stats["reconnects"] += 1
+                    _bump(remote=True)
+                    _call_remote_listeners("reconnect", None)
+                connected_before = True
+                # Wake up every RETRIEVAL_CACHE_LISTEN_TIMEOUT seconds to check the stop flag
+                while not _stop.is_set():
+                    for message in conn.notifies(timeout=config.RETRIEVAL_CACHE_LISTEN_TIMEOUT):
+                        _handle_notification(message.payload)
+            finally:
+                _state["listener_connected"] = False
+                conn.close()
+        except Exception as e:
+            logger.error("Knowledge base change listener disconnected: %s", e)
+            _stop.wait(config.RETRIEVAL_CACHE_RECONNECT_DELAY)
+
+
+def start_listener() -> None:
+    """Start the LISTEN thread (once per process) when the cache is enabled."""
+    global _listener_thread
+    if not config.RETRIEVAL_CACHE_ENABLED or _listener_thread is not None:
+        return
+    _listener_thread = threading.Thread(target=_listen, name="kb-change-listener", daemon=True)
+    _listener_thread.start()
+
+
+def stop_listener() -> None:
+    """Stop the LISTEN thread (within config.RETRIEVAL_CACHE_LISTEN_TIMEOUT seconds)."""
+    _stop.set()
+
+
+def clear() -> None:
+    _cache.clear()
+
+
+def cache_stats() -> dict:
+    """
+    Hit rate, entries dropped as stale, version bumps (local and from other workers),
+    notification lag and the mean age of served entries.
+    """
+    stats = _cache.stats()
+    stats.update(_stats)
+    # Stale entries are found by the LRU lookup but not served: count them as misses
+    stats["hits"] -= _stats["stale"]
+    stats["misses"] += _stats["stale"]
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    remote = _stats["remote_bumps"] - _stats["reconnects"]
+    stats["notify_lag_ms_avg"] = _stats["notify_lag_ms_total"] / remote if remote > 0 else 0.0
+    stats["hit_age_s_avg"] = _stats["hit_age_s_total"] / stats["hits"] if stats["hits"] else 0.0
+    stats["version"] = _version
+    stats["listener_connected"] = _state["listener_connected"]
+    stats["seconds_since_change"] = time.time() - _state["last_bump"] if _state["last_bump"] else None
+    return stats
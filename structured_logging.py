@@ -0,0 +1,192 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+import uuid
+import config
+
+# Non-blocking structured logging. Request code only caps the record's arguments and
+# puts it on a bounded queue; a listener thread formats the JSON lines and writes
+# them to the console and a size-rotated file. Every line carries the request id of
+# the request that logged it. Heavy payload records (retrieved rows, LLM inputs and
+# outputs, marked with extra=PAYLOAD) are kept only for a sample of requests.
+
+# Pass as extra= on log calls that dump large payloads so they are sampled
+PAYLOAD = {"payload": True}
+
+_request_id = contextvars.ContextVar("request_id", default=None)
+_payload_sampled = contextvars.ContextVar("payload_sampled", default=True)
+
+_listener = None
+_stats = {"enqueued": 0, "dropped": 0, "payloads_skipped": 0}
+
+
+def set_request_id(request_id=None, sampled=None) -> str:
+    """
+    Set the request id logged with every record of the current context (a new one if
+    not given) and decide whether this request's payload records are kept.
+    """
+    request_id = request_id or uuid.uuid4().hex[:16]
+    _request_id.set(request_id)
+    if sampled is None:
+        sampled = random.random() < config.LOG_PAYLOAD_SAMPLE_RATE
+    _payload_sampled.set(sampled)
+    return request_id
+
+
+def set_item_request_id(index) -> str:
+    """Request id "<request id>.<index>" for one item of a batch request (same sampling)."""
+    request_id = f"{_request_id.get() or uuid.uuid4().hex[:16]}.{index}"
+    _request_id.set(request_id)
+    return request_id
+
+
+def get_request_id():
+    return _request_id.get()
+
+
+def cap_value(value, max_chars=None, max_items=None, depth=0):
+    """
+    Size-capped copy of a log argument: long strings are cut, containers keep their
+    first max_items entries, nesting is limited. Cheap to compute, since large values
+    are never fully stringified.
+    """
+    max_chars = max_chars or config.LOG_MAX_FIELD_CHARS
+    max_items = max_items or config.LOG_MAX_ITEMS
+    if isinstance(value, str):
+        if len(value) > max_chars:
+            return f"{value[:max_chars]}...<{len(value) - max_chars} more chars>"
+        return value
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if depth >= 4:
+        return f"<{type(value).__name__}>"
+    if isinstance(value, dict):
+        capped = {str(key): cap_value(item, max_chars, max_items, depth + 1)
+                  for key, item in list(value.items())[:max_items]}
+        if len(value) > max_items:
+            capped["..."] = f"<{len(value) - max_items} more items>"
+        return capped
+    if isinstance(value, (list, tuple, set)):
+        items = list(value)
+        capped = [cap_value(item, max_chars, max_items, depth + 1) for item in items[:max_items]]
+        if len(items) > max_items:
+            capped.append(f"<{len(items) - max_items} more items>")
+        return capped
+    if hasattr(value, "dict") and callable(value.dict):
+        # pydantic models
+        return cap_value(value.dict(), max_chars, max_items, depth + 1)
+    return cap_value(str(value), max_chars, max_items, depth + 1)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line: ts, level, logger, request_id, msg, plus any fields
+    passed as extra={"fields": {...}}.
+    """
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", None),
+            "msg": cap_value(record.getMessage(), config.LOG_MAX_MESSAGE_CHARS),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(cap_value(fields))
+        if record.exc_info:
+            entry["exc_info"] = cap_value(self.formatException(record.exc_info), config.LOG_MAX_MESSAGE_CHARS)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that does the minimum in the calling thread: attach the request id,
+    drop unsampled payload records, cap arguments, and never block on a full queue
+    (the record is dropped and counted instead).
+    """
+
+    def filter(self, record):
+        if getattr(record, "payload", False) and not _payload_sampled.get():
+            _stats["payloads_skipped"] += 1
+            return False
+        return super().filter(record)
+
+    def prepare(self, record):
+        record.request_id = _request_id.get()
+        if record.args:
+            if isinstance(record.args, dict):
+                record.args = cap_value(record.args)
+            else:
+                record.args = tuple(cap_value(arg) for arg in record.args)
+        if isinstance(record.msg, str):
+            record.msg = cap_value(record.msg, config.LOG_MAX_MESSAGE_CHARS)
+        # Formatting (and exception rendering) happens in the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            _stats["enqueued"] += 1
+        except queue.Full:
+            _stats["dropped"] += 1
+
+
+def setup_logging(logger_names, log_file=None, level=None):
+    """
+    Route the named loggers through one bounded queue to a listener thread writing
+    JSON lines (or plain text with config.LOG_JSON = False) to stderr and a rotating
+    file. Safe to call more than once; later calls only attach more loggers.
+    """
+    global _listener
+    level = getattr(logging, (level or config.LOG_LEVEL).upper())
+    if _listener is None:
+        log_file = log_file or config.LOG_FILE
+        directory = os.path.dirname(log_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        formatter = JsonFormatter() if config.LOG_JSON else logging.Formatter(
+            "%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"
+        )
+        handlers = [
+            logging.StreamHandler(),
+            logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=config.LOG_FILE_MAX_BYTES, backupCount=config.LOG_FILE_BACKUPS, encoding="utf-8"
+            ),
+        ]
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        log_queue = queue.Queue(maxsize=config.LOG_QUEUE_SIZE)
+        _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.queue_handler = StructuredQueueHandler(log_queue)
+        _listener.start()
+        atexit.register(stop_logging)
+
+    for name in logger_names:
+        logger = logging.getLogger(name)
+        logger.setLevel(level)
+        if _listener.queue_handler not in logger.handlers:
+            logger.addHandler(_listener.queue_handler)
+        logger.propagate = False
+
+
+def stop_logging():
+    """Flush queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def logging_stats():
+    """Records enqueued, dropped on a full queue, and payload records skipped by sampling."""
+    stats = dict(_stats)
+    stats["queue_depth"] = _listener.queue.qsize() if _listener is not None else 0
+    return stats